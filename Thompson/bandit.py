@@ -1,140 +1,437 @@
 import numpy as np
+import glob
 import json
+import logging
 import os
+import threading
+import time
 from typing import Dict, List, Optional
 from datetime import datetime
+import metrics
+from forgetting import make_forgetting
+from journal import RewardJournal
+from shared_state import COMPACT_LOCK, SharedArmTable, StripedLock
 
-class Arm:
-    """Beta-Bernoulli Thompson arm."""
-    __slots__ = ("alpha", "beta", "total_reward", "num_pulls")
+logger = logging.getLogger(__name__)
 
-    def __init__(self, alpha: float = 1.0, beta: float = 1.0):
-        self.alpha = alpha
-        self.beta = beta
-        self.total_reward = 0.0
-        self.num_pulls = 0
+class ThompsonBandit:
+    """Beta-Bernoulli Thompson sampling bandit.
 
-    def sample(self) -> float:
-        return np.random.beta(self.alpha, self.beta)
+    Posterior parameters live in contiguous NumPy arrays indexed by arm slot
+    (struct-of-arrays), so all posteriors are sampled with a single vectorized
+    ``Generator.beta`` call instead of one Python call per arm.
 
-    def update(self, reward: int):
-        """reward ∈ {0,1}"""
-        self.alpha += reward
-        self.beta += 1 - reward
-        self.total_reward += reward
-        self.num_pulls += 1
+    Rewards are appended to a write-behind journal rather than rewriting the
+    whole state file; every ``snapshot_every`` journaled events the state is
+    compacted into a snapshot; the previous one is kept under a timestamped
+    name in ``SNAPSHOT_DIR`` and only ``snapshot_retention`` of those are kept.
+    Timestamped files directly in ``BACKUP_DIR`` (checked in) are never pruned.
 
+    Updates are serialized per arm with striped locks, so concurrent threadpool
+    handlers never lose an increment. With ``shared=True`` the arrays are views
+    over a memory-mapped file and each stripe is also an ``flock`` on its own
+    file under ``LOCK_DIR``, so several uvicorn worker processes update one
+    set of posterior counts.
+    In that mode the mapped file is the durable state (msync'd every
+    ``flush_interval`` seconds) and the journal is not used.
 
-class ThompsonBandit:
+    ``adaptation`` makes the posteriors non-stationary: "discounted" decays
+    evidence with a ``half_life`` (seconds), "window" only counts rewards
+    from the last ``window`` seconds (see forgetting.py). Journal events carry
+    the timestamp they were applied with, so replay reproduces the same
+    posterior; total_reward and num_pulls stay lifetime counters.
+    """
     BACKUP_DIR = "bandit_backup"
     BACKUP_FILE = "bandit_state.json"
-    
-    def __init__(self, arm_ids: List[str]):
-        self.arms: Dict[str, Arm] = {aid: Arm() for aid in arm_ids}
+    JOURNAL_FILE = "bandit_journal.jsonl"
+    SNAPSHOT_DIR = "snapshots"
+    SHARED_FILE = "bandit_state.mmap"
+    LOCK_DIR = "bandit_state.locks"
+    FIELDS = ["alpha", "beta", "total_reward", "num_pulls"]
+    PRIORS = {"alpha": 1.0, "beta": 1.0}
+
+    def __init__(self, arm_ids: List[str], seed: Optional[int] = None,
+                 flush_interval: float = 1.0, flush_events: int = 64,
+                 snapshot_every: int = 1000, snapshot_retention: int = 48,
+                 shared: bool = False, lock_stripes: int = 16,
+                 adaptation: Optional[str] = None, half_life: float = 7 * 86400.0,
+                 window: float = 7 * 86400.0, window_buckets: int = 168):
+        self.arm_ids: List[str] = list(arm_ids)
+        # arm_id -> slot in the parameter arrays
+        self.arms: Dict[str, int] = {aid: i for i, aid in enumerate(self.arm_ids)}
+        self.rng = np.random.default_rng(seed)
+        self.snapshot_every = snapshot_every
+        self.snapshot_retention = snapshot_retention
+        self.shared = shared
+        self._flush_interval = flush_interval
+        self._flush_events = flush_events
+        self._compact_lock = threading.Lock()
+        self._snapshot_seq = 0
+        # Rewards land under different stripes, so the count has its own lock
+        self._count_lock = threading.Lock()
+        self._rewards_since_snapshot = 0
+        self.forgetting = make_forgetting(adaptation, len(self.arm_ids), half_life, window,
+                                          window_buckets, (self.PRIORS["alpha"], self.PRIORS["beta"]))
+        if self.forgetting is not None and shared:
+            raise ValueError("adaptation is not supported with shared=True")
         # Create backup directory if it doesn't exist
         if not os.path.exists(self.BACKUP_DIR):
             os.makedirs(self.BACKUP_DIR)
-        # Try to load previous state
+        os.makedirs(os.path.join(self.BACKUP_DIR, self.SNAPSHOT_DIR), exist_ok=True)
+        # Arm slot i is guarded by stripe i % lock_stripes; taking every stripe
+        # gives a snapshot that matches the journal position it records
+        self._locks = StripedLock(
+            min(lock_stripes, max(len(self.arm_ids), 1)),
+            os.path.join(self.BACKUP_DIR, self.LOCK_DIR) if shared else None)
+
+        self.journal = None
+        self._table = None
+        if shared:
+            self._table = SharedArmTable(os.path.join(self.BACKUP_DIR, self.SHARED_FILE),
+                                         self.arm_ids, self.FIELDS, self._locks,
+                                         defaults=self.PRIORS, on_create=self._seed_shared)
+            if not self._table.created:
+                logger.info("Attached to shared bandit state at: %s", self._table.path)
+            self._bind_shared()
+            self.journal = None
+            self._table.start_flusher(flush_interval, on_flush=self._maybe_compact_shared)
+        else:
+            n = len(self.arm_ids)
+            self.alpha = np.ones(n, dtype=np.float64)
+            self.beta = np.ones(n, dtype=np.float64)
+            self.total_reward = np.zeros(n, dtype=np.float64)
+            self.num_pulls = np.zeros(n, dtype=np.float64)
+            self._open_journal()
+            # Try to load previous state
+            self.load_state()
+
+    def _open_journal(self):
+        self.journal = RewardJournal(os.path.join(self.BACKUP_DIR, self.JOURNAL_FILE),
+                                     flush_interval=self._flush_interval,
+                                     flush_events=self._flush_events,
+                                     on_flush=self._maybe_compact)
+
+    def _bind_shared(self):
+        self.alpha, self.beta, self.total_reward, self.num_pulls = (
+            self._table.column(f) for f in self.FIELDS)
+
+    def _seed_shared(self, table: SharedArmTable):
+        """Seed a newly created shared file from the snapshot and journal."""
+        self._table = table
+        self._bind_shared()
+        self._open_journal()
         self.load_state()
+        # Fold the journal into a snapshot; from here on the mapped file is durable
+        self.save_state()
+        self.journal.close()
+
+    def _arm_dict(self, i: int) -> dict:
+        return {
+            "alpha": float(self.alpha[i]),
+            "beta": float(self.beta[i]),
+            "total_reward": float(self.total_reward[i]),
+            "num_pulls": int(self.num_pulls[i])
+        }
+
+    def _log_summary(self, source: str, replayed: int, new_arms=()):
+        """One line per load; per-arm values only at DEBUG level."""
+        logger.info("%s: %d arms, %d pulls, %d rewards, %d journaled events replayed%s",
+                    source, len(self.arm_ids), int(self.num_pulls.sum()), int(self.total_reward.sum()),
+                    replayed, f"; new arms: {', '.join(sorted(new_arms))}" if new_arms else "")
+        if logger.isEnabledFor(logging.DEBUG):
+            for aid, i in self.arms.items():
+                logger.debug("  %s: alpha=%.2f beta=%.2f total_reward=%s pulls=%d", aid,
+                             self.alpha[i], self.beta[i], self.total_reward[i], int(self.num_pulls[i]))
 
     def save_state(self):
-        """Save current bandit state to file."""
-        state_data = {
-            "timestamp": datetime.now().isoformat(),
-            "arms": {
-                aid: {
-                    "alpha": arm.alpha,
-                    "beta": arm.beta,
-                    "total_reward": arm.total_reward,
-                    "num_pulls": arm.num_pulls
-                }
-                for aid, arm in self.arms.items()
+        """Compact current bandit state into a snapshot and trim the journal."""
+        started = time.perf_counter()
+        with self._compact_lock, self._locks.exclusive(COMPACT_LOCK):
+            with self._locks.all():
+                seq = self.journal.last_seq if self.journal is not None else self._snapshot_seq
+                arms = {aid: self._arm_dict(i) for aid, i in self.arms.items()}
+                adaptation = (self.forgetting.to_json(self.arm_ids)
+                              if self.forgetting is not None else None)
+                with self._count_lock:
+                    self._rewards_since_snapshot = 0
+            state_data = {
+                "timestamp": datetime.now().isoformat(),
+                "journal_seq": seq,
+                "arms": arms
             }
-        }
-        
-        backup_path = os.path.join(self.BACKUP_DIR, self.BACKUP_FILE)
-        # Create a backup of previous state
-        if os.path.exists(backup_path):
-            backup_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            os.rename(backup_path, 
-                     os.path.join(self.BACKUP_DIR, f"bandit_state_{backup_timestamp}.json"))
-        
-        # Save current state
-        with open(backup_path, 'w') as f:
-            json.dump(state_data, f, indent=4)
+            if adaptation is not None:
+                state_data["adaptation"] = adaptation
+
+            backup_path = os.path.join(self.BACKUP_DIR, self.BACKUP_FILE)
+            tmp_path = backup_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state_data, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+
+            # Keep the previous snapshot under a timestamped name, then swap the
+            # new one in atomically so there is always a complete state file
+            if os.path.exists(backup_path):
+                backup_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                try:
+                    os.link(backup_path, os.path.join(self.BACKUP_DIR, self.SNAPSHOT_DIR,
+                                                      f"bandit_state_{backup_timestamp}.json"))
+                except FileExistsError:
+                    pass
+            os.replace(tmp_path, backup_path)
+
+            self._snapshot_seq = seq
+            if self.journal is not None:
+                self.journal.truncate(seq)
+            self._prune_snapshots()
+        metrics.BANDIT_SAVE_STATE_SECONDS.observe(time.perf_counter() - started)
+
+    def _snapshot_history(self) -> List[str]:
+        """Timestamped snapshots written by save_state, oldest first."""
+        return sorted(glob.glob(os.path.join(self.BACKUP_DIR, self.SNAPSHOT_DIR, "bandit_state_*.json")))
+
+    def _prune_snapshots(self):
+        history = self._snapshot_history()
+        for path in history[:max(len(history) - self.snapshot_retention, 0)]:
+            os.remove(path)
+
+    def _maybe_compact(self, durable_seq: int):
+        if durable_seq - self._snapshot_seq >= self.snapshot_every:
+            self._compact()
+
+    def _maybe_compact_shared(self):
+        # Each worker snapshots after roughly snapshot_every of its own rewards
+        if self._rewards_since_snapshot >= self.snapshot_every:
+            self._compact()
+
+    def _compact(self):
+        if self._compact_lock.locked():
+            return
+        try:
+            self.save_state()
+        except Exception as e:
+            logger.error("Error compacting bandit state: %s", e)
+
+    def flush(self):
+        """Force every reward recorded so far to disk."""
+        if self.journal is not None:
+            self.journal.flush()
+        else:
+            self._table.flush()
+
+    def close(self):
+        """Flush pending rewards and write a final snapshot."""
+        self.flush()
+        self.save_state()
+        if self.journal is not None:
+            self.journal.close()
+        if self._table is not None:
+            self._table.close()
 
     def load_state(self) -> bool:
-        """Load bandit state from file if it exists."""
+        """Load the latest snapshot and replay the journal tail on top of it."""
         try:
             backup_path = os.path.join(self.BACKUP_DIR, self.BACKUP_FILE)
             if not os.path.exists(backup_path):
-                print(f"\nNo bandit state file found at: {backup_path}")
-                print("Starting with fresh bandit state:")
-                print("\nInitial arm values:")
-                for aid, arm in self.arms.items():
-                    print(f"\n{aid}:")
-                    print(f"  α (alpha): {arm.alpha:.2f}")
-                    print(f"  β (beta): {arm.beta:.2f}")
-                    print(f"  Total Reward: {arm.total_reward}")
-                    print(f"  Number of Pulls: {arm.num_pulls}")
-                return False
-                
+                # Fall back to the newest timestamped snapshot (ours, then checked-in ones)
+                history = (self._snapshot_history()
+                           or sorted(glob.glob(os.path.join(self.BACKUP_DIR, "bandit_state_*.json"))))
+                backup_path = history[-1] if history else None
+            if backup_path is None:
+                replayed = self._replay_journal()
+                self._log_summary(f"No bandit state file in {self.BACKUP_DIR}, starting fresh", replayed)
+                return replayed > 0
+
             with open(backup_path, 'r') as f:
                 state_data = json.load(f)
-            
-            print(f"\nLoading bandit state from: {backup_path}")
-            print(f"State timestamp: {state_data.get('timestamp', 'Not recorded')}")
-            print("\nLoaded arm values:")
-            
+
             loaded_arms = set()
             for aid, arm_data in state_data["arms"].items():
                 if aid in self.arms:
                     loaded_arms.add(aid)
-                    self.arms[aid].alpha = arm_data["alpha"]
-                    self.arms[aid].beta = arm_data["beta"]
-                    self.arms[aid].total_reward = arm_data["total_reward"]
-                    self.arms[aid].num_pulls = arm_data["num_pulls"]
-                    print(f"\n{aid}:")
-                    print(f"  α (alpha): {arm_data['alpha']:.2f}")
-                    print(f"  β (beta): {arm_data['beta']:.2f}")
-                    print(f"  Total Reward: {arm_data['total_reward']}")
-                    print(f"  Number of Pulls: {arm_data['num_pulls']}")
-                    if arm_data['num_pulls'] > 0:
-                        avg_reward = arm_data['total_reward'] / arm_data['num_pulls']
-                        print(f"  Average Reward: {avg_reward:.3f}")
-            
-            # Print any new arms that weren't in the saved state
-            new_arms = set(self.arms.keys()) - loaded_arms
-            if new_arms:
-                print("\nNew arms (not in saved state):")
-                for aid in sorted(new_arms):
-                    arm = self.arms[aid]
-                    print(f"\n{aid}:")
-                    print(f"  α (alpha): {arm.alpha:.2f}")
-                    print(f"  β (beta): {arm.beta:.2f}")
-                    print(f"  Total Reward: {arm.total_reward}")
-                    print(f"  Number of Pulls: {arm.num_pulls}")
-            
-            print("\nBandit state loaded successfully!")
+                    i = self.arms[aid]
+                    self.alpha[i] = arm_data["alpha"]
+                    self.beta[i] = arm_data["beta"]
+                    self.total_reward[i] = arm_data["total_reward"]
+                    self.num_pulls[i] = arm_data["num_pulls"]
+
+            if self.forgetting is not None:
+                saved_at = datetime.fromisoformat(state_data["timestamp"]).timestamp() \
+                    if "timestamp" in state_data else time.time()
+                self.forgetting.load_json(state_data.get("adaptation"), self.arms,
+                                          self.alpha, self.beta, saved_at)
+
+            self._snapshot_seq = state_data.get("journal_seq", 0)
+            self.journal.advance_to(self._snapshot_seq)
+            replayed = self._replay_journal()
+            self._log_summary(f"Loaded bandit state from {backup_path} "
+                              f"(saved {state_data.get('timestamp', 'at an unknown time')})",
+                              replayed, set(self.arms) - loaded_arms)
             return True
         except Exception as e:
-            print(f"\nError loading bandit state: {e}")
+            logger.error("Error loading bandit state: %s", e)
             return False
 
+    def _replay_journal(self) -> int:
+        """Apply journaled events newer than the loaded snapshot."""
+        replayed = 0
+        for event in self.journal.replay(self._snapshot_seq):
+            if "d" in event:
+                # Batched per-arm deltas: {arm_id: [successes, failures]}
+                for aid, (successes, failures) in event["d"].items():
+                    i = self.arms.get(aid)
+                    if i is not None:
+                        self._advance(event.get("t"))
+                        self._apply_counts(i, successes, failures, event.get("t"))
+            else:
+                i = self.arms.get(event["a"])
+                if i is not None:
+                    self._advance(event.get("t"))
+                    self._apply(i, event["r"], event.get("t"))
+            replayed += 1
+        return replayed
+
+    def sample(self, n: Optional[int] = None) -> np.ndarray:
+        """Draw posterior samples for every arm in one vectorized call.
+
+        Returns shape ``(arms,)`` when ``n`` is None, otherwise ``(n, arms)``.
+        """
+        size = None if n is None else (n, len(self.arm_ids))
+        return self.rng.beta(*self.posterior(), size=size)
+
+    def posterior(self):
+        """(alpha, beta) arrays to sample from, after any decay or window expiry."""
+        if self.forgetting is None:
+            return self.alpha, self.beta
+        now = time.time()
+        self._advance(now)
+        return self.forgetting.posterior(self.alpha, self.beta, now)
+
+    def _advance(self, t: Optional[float]):
+        """Move a sliding window to time ``t``; a no-op for other modes."""
+        forgetting = self.forgetting
+        if t is None or forgetting is None or not hasattr(forgetting, "advance"):
+            return
+        if forgetting.needs_advance(t):
+            with self._locks.all():
+                forgetting.advance(self.alpha, self.beta, t)
+
     def choose(self) -> str:
         """Return arm with highest sampled probability."""
-        return max(self.arms, key=lambda aid: self.arms[aid].sample())
+        return self.arm_ids[int(np.argmax(self.sample()))]
 
-    def reward(self, arm_id: str, reward: int):
-        self.arms[arm_id].update(reward)
-        # Save state after each reward update
-        self.save_state()
+    def choose_many(self, n: int) -> List[str]:
+        """Serve ``n`` independent decisions from a single (n, arms) draw."""
+        if n <= 0:
+            return []
+        winners = np.argmax(self.sample(n), axis=1)
+        return [self.arm_ids[i] for i in winners]
+
+    def top_k(self, k: int) -> List[str]:
+        """Return the ``k`` arms with the highest samples from one draw, best first."""
+        k = min(k, len(self.arm_ids))
+        if k <= 0:
+            return []
+        draws = self.sample()
+        top = np.argpartition(draws, -k)[-k:]
+        top = top[np.argsort(draws[top])[::-1]]
+        return [self.arm_ids[i] for i in top]
+
+    def _apply(self, i: int, reward: int, t: Optional[float] = None):
+        self._apply_counts(i, reward, 1 - reward, t)
+
+    def _apply_counts(self, i, successes, failures, t: Optional[float] = None):
+        # A negative count could drive beta to 0 or below, which rng.beta rejects
+        if isinstance(successes, np.ndarray):
+            negative = (successes < 0).any() or (failures < 0).any()
+        else:
+            negative = successes < 0 or failures < 0
+        if negative:
+            raise ValueError("reward counts must be non-negative")
+        if self.forgetting is not None:
+            t = time.time() if t is None else t
+            self.forgetting.before_update(self.alpha, self.beta, i, t)
+            weight = self.forgetting.weight(i, t)
+            self.forgetting.record(i, successes * weight, failures * weight, t)
+            self.alpha[i] += successes * weight
+            self.beta[i] += failures * weight
+        else:
+            self.alpha[i] += successes
+            self.beta[i] += failures
+        self.total_reward[i] += successes
+        self.num_pulls[i] += successes + failures
+
+    def _count_rewards(self, n: int):
+        with self._count_lock:
+            self._rewards_since_snapshot += n
+
+    def apply_deltas(self, successes: np.ndarray, failures: np.ndarray, t: Optional[float] = None) -> int:
+        """Apply per-arm success/failure counts (indexed by slot) in one step.
+
+        Used for micro-batched rewards: the whole batch is one vectorized
+        update and one journal event. ``t`` is when the rewards happened
+        (default now); with ``adaptation`` older rewards count as decayed
+        or fall outside the window. Returns the journal sequence number.
+        """
+        successes = np.asarray(successes, dtype=np.float64)
+        failures = np.asarray(failures, dtype=np.float64)
+        t = round(time.time() if t is None else min(t, time.time()), 3)
+        self._advance(t)
+        with self._locks.all():
+            self._apply_counts(slice(None), successes, failures, t)
+            self._count_rewards(int(successes.sum() + failures.sum()))
+            if self.journal is None:
+                return 0
+            touched = np.flatnonzero(successes + failures)
+            return self.journal.append({"t": t, "d": {
+                self.arm_ids[i]: [int(successes[i]), int(failures[i])] for i in touched
+            }})
+
+    def reward(self, arm_id: str, reward: int) -> int:
+        """reward ∈ {0,1}; returns the journal sequence number of the event.
+
+        Returns 0 in shared mode, where rewards are not journaled.
+        """
+        if reward not in (0, 1):
+            raise ValueError(f"reward must be 0 or 1, got {reward!r}")
+        i = self.arms[arm_id]
+        t = round(time.time(), 3)
+        self._advance(t)
+        with self._locks.stripe(i):
+            self._apply(i, reward, t)
+            self._count_rewards(1)
+            if self.journal is None:
+                return 0
+            # Disk I/O happens on the journal's writer thread
+            return self.journal.append({"t": t, "a": arm_id, "r": reward})
+
+    def arm_state(self, arm_id: str) -> dict:
+        """``state()[arm_id]`` without building the dict for every arm."""
+        i = self.arms[arm_id]
+        d = self._arm_dict(i)
+        if self.forgetting is not None:
+            alpha, beta = self.posterior()
+            d["alpha"], d["beta"] = float(alpha[i]), float(beta[i])
+        d["average_reward"] = d["total_reward"] / d["num_pulls"] if d["num_pulls"] > 0 else 0.0
+        return d
 
     def state(self) -> Dict[str, dict]:
+        """Current posterior parameters per arm.
+
+        Reads are lock-free; a concurrent reward may or may not be reflected.
+        """
+        avg = np.divide(self.total_reward, self.num_pulls,
+                        out=np.zeros_like(self.total_reward), where=self.num_pulls > 0)
+        alpha, beta = self.posterior()
+        alpha = alpha.tolist()
+        beta = beta.tolist()
+        total_reward = self.total_reward.tolist()
+        num_pulls = self.num_pulls.astype(np.int64).tolist()
+        average_reward = avg.tolist()
         return {aid: {
-                "alpha": arm.alpha,
-                "beta": arm.beta,
-                "total_reward": arm.total_reward,
-                "num_pulls": arm.num_pulls,
-                "average_reward": arm.total_reward / arm.num_pulls if arm.num_pulls > 0 else 0.0
-            } for aid, arm in self.arms.items()}
\ No newline at end of file
+                "alpha": alpha[i],
+                "beta": beta[i],
+                "total_reward": total_reward[i],
+                "num_pulls": num_pulls[i],
+                "average_reward": average_reward[i]
+            } for i, aid in enumerate(self.arm_ids)}
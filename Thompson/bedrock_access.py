@@ -1,27 +1,146 @@
 import json 
 import logging 
-import boto3 
-from botocore.exceptions import ClientError 
-import yaml 
 import time 
-import pandas as pd 
-from datetime import datetime
+import numpy as np
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import torch
-import torch.nn.functional as F
-import random as _random
-import time as _time
+from concurrent.futures import ThreadPoolExecutor
+import os
+import asyncio
+import threading
+import metrics
+from rate_governor import RateGovernor, parse_rates
+from embedding_store import EmbeddingStore, text_digest
+from stream_parser import JSONStringArrayParser
 
-def generate_meassages(user_data, user_message):
-    
-    print(f'##### Function called at: {datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")}')
+# One long-lived client per region and one persistent executor per process;
+# building a client (and its TLS connections) per call dominated latency.
+# boto3 is imported with the first client (see warm_up), not with this
+# module, so importing main stays fast.
+BEDROCK_MAX_WORKERS = int(os.environ.get("BEDROCK_MAX_WORKERS", "8"))
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS",
+                                                  str(BEDROCK_MAX_WORKERS * 2)))
+# Point the client at another endpoint, e.g. fake_bedrock.py for load tests
+BEDROCK_ENDPOINT_URL = os.environ.get("BEDROCK_ENDPOINT_URL") or None
+_clients = {}
+_clients_lock = threading.Lock()
+_executor = None
+# (model_id, dimensions, sha256(text)) -> Future of an in-flight embedding
+_inflight_embeddings = {}
+_inflight_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+# Every Bedrock attempt (generation and embeddings) takes a permit from one
+# per-model token bucket + AIMD concurrency limit and is retried here, not
+# by the SDK. BEDROCK_RATE_LIMITS="model_id=requests_per_second,..." caps
+# the rate of a model; without it only concurrency adapts.
+bedrock_governor = RateGovernor(
+	max_concurrency=BEDROCK_MAX_WORKERS,
+	initial_concurrency=int(os.environ.get("BEDROCK_INITIAL_CONCURRENCY", "4")),
+	rates=parse_rates(os.environ.get("BEDROCK_RATE_LIMITS", "")),
+	retries=int(os.environ.get("BEDROCK_RETRIES", "3")),
+	acquire_timeout=float(os.environ.get("BEDROCK_ACQUIRE_TIMEOUT", "60")),
+)
 
-    bedrock_runtime_client = boto3.client(
-        service_name="bedrock-runtime",
-        region_name="us-east-1" 
-    )
+def get_bedrock_client(region: str = "us-east-1"):
+	"""Shared bedrock-runtime client for ``region`` (boto3 clients are thread-safe)."""
+	with _clients_lock:
+		client = _clients.get(region)
+		if client is None:
+			import boto3
+			from botocore.config import Config
+			client = boto3.client(
+				"bedrock-runtime",
+				region_name=region,
+				endpoint_url=BEDROCK_ENDPOINT_URL,
+				config=Config(
+					max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS,
+					tcp_keepalive=True,
+					# bedrock_governor retries, so it sees every throttle
+					retries={"total_max_attempts": 1},
+				),
+			)
+			client.meta.events.register("needs-retry.bedrock-runtime", _count_attempt)
+			_clients[region] = client
+		return client
+
+def executor_stats(executor=None) -> dict:
+	"""Size and backlog of ``executor`` (the Bedrock executor by default)."""
+	executor = executor if executor is not None else _executor
+	if executor is None:
+		return {"max_workers": 0, "threads": 0, "queued": 0}
+	return {
+		"max_workers": executor._max_workers,
+		"threads": len(executor._threads),
+		"queued": executor._work_queue.qsize(),
+	}
+
+def governor_stats() -> dict:
+	"""Current concurrency limit, rate and counters per model id."""
+	return bedrock_governor.stats()
+
+def _operation_label(name: str) -> str:
+	"""``ConverseStream`` -> ``converse_stream``."""
+	return "".join("_" + c.lower() if c.isupper() else c for c in name).lstrip("_")
+
+def _count_attempt(response=None, operation=None, **kwargs):
+	"""botocore hook run after every attempt, so throttles the SDK retried are counted too."""
+	if response is not None and operation is not None:
+		code = response[1].get("Error", {}).get("Code")
+		if code in ("ThrottlingException", "TooManyRequestsException") or response[0].status_code == 429:
+			metrics.BEDROCK_THROTTLES.inc(_operation_label(operation.name))
+
+def _record_call(operation: str, started: float, response=None, error=None):
+	"""Feed one Bedrock call's latency, SDK retries and failure into the metrics."""
+	metrics.BEDROCK_REQUEST_SECONDS.observe(time.perf_counter() - started, operation)
+	source = getattr(error, "response", None) if error is not None else response
+	retries = ((source or {}).get("ResponseMetadata") or {}).get("RetryAttempts", 0)
+	if retries:
+		metrics.BEDROCK_RETRIES.inc(operation, amount=retries)
+	if error is not None:
+		metrics.BEDROCK_ERRORS.inc(operation)
+
+def _call(operation: str, fn, **kwargs):
+	started = time.perf_counter()
+	try:
+		response = fn(**kwargs)
+	except Exception as e:
+		_record_call(operation, started, error=e)
+		raise
+	_record_call(operation, started, response=response)
+	return response
+
+def get_executor() -> ThreadPoolExecutor:
+	"""Persistent executor for Bedrock calls, sized by BEDROCK_MAX_WORKERS."""
+	global _executor
+	with _clients_lock:
+		if _executor is None:
+			_executor = ThreadPoolExecutor(max_workers=BEDROCK_MAX_WORKERS,
+										   thread_name_prefix="bedrock")
+		return _executor
+
+# Embeddings are cached on disk by (model_id, dimensions, sha256(text));
+# set BEDROCK_EMBEDDING_CACHE_DIR to an empty string to disable
+EMBEDDING_CACHE_DIR = os.environ.get("BEDROCK_EMBEDDING_CACHE_DIR", "embedding_cache")
+_embedding_store = None
+_embedding_store_lock = threading.Lock()
+
+def get_embedding_store():
+	"""Process-wide EmbeddingStore, or None when caching is disabled."""
+	global _embedding_store
+	if not EMBEDDING_CACHE_DIR:
+		return None
+	with _embedding_store_lock:
+		if _embedding_store is None:
+			_embedding_store = EmbeddingStore(EMBEDDING_CACHE_DIR)
+	return _embedding_store
 
+def warm_up(region: str = "us-east-1"):
+	"""Import boto3 and build the client, executor and embedding store ahead of the first login."""
+	get_bedrock_client(region)
+	get_executor()
+	get_embedding_store()
+
+def build_converse_request(user_data, user_message):
+    """Keyword arguments for ``converse``/``converse_stream`` for this user."""
     cluster_type = user_data["user_login"][0]["cluster_type"]
 
     if cluster_type == "HELOC":
@@ -30,13 +149,9 @@ def generate_meassages(user_data, user_message):
     
     reasoning = user_data["user_login"][0]["reasoning"]
 
-    print(bedrock_runtime_client)
-
     model_id = 'amazon.nova-micro-v1:0'
     system_prompt = "You are an expert in encouraging banking customer to engage with either home mortgage purchase, refinancing or home equity loan. I need you to come up with ten brief and powerful messages, each message has at least ten and most thirty words, and be creative for every time you are being called via API, do not use save verbiage each time. Do not make any offers or mention anything numeric, such as years, terms, interest rates, fees."
 
-    print('##### User Message: ', user_message, '\n')
-
     json_output_prompt = f"""
 {user_message}
 
@@ -52,7 +167,7 @@ Return the output as a JSON array of strings, with each string containing one me
 
     }
 
-    response = bedrock_runtime_client.converse(
+    return dict(
         modelId=model_id,
         system = [
             {"text": system_prompt} 
@@ -66,32 +181,96 @@ Return the output as a JSON array of strings, with each string containing one me
         inferenceConfig = inference_configuration
     )
 
-    print('##### Python Dict: ', response, '\n') 
+def generate_meassages(user_data, user_message):
+    """Ask the model for a set of messages; returns them as a list of strings."""
+    logger.debug("Converse called for: %s", user_message)
 
-    json_str = json.dumps(response, indent=2)
-    print('##### JSON String: ', json_str, '\n')
+    request = build_converse_request(user_data, user_message)
+    response = bedrock_governor.call(request["modelId"], "converse", _call,
+                                     "converse", get_bedrock_client("us-east-1").converse, **request)
+    logger.debug("Converse response: %s", response)
 
     # Extract list of messages from the response
     messages_json_str = response['output']['message']['content'][0]['text'] 
     messages_list = json.loads(messages_json_str) 
 
-    print('##### Messages List: ')
-    for i, message in enumerate(messages_list, 1):
-        print(f'{i:2d}. {message}')
-    print()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Messages list:\n%s",
+                     "\n".join(f"{i:2d}. {m}" for i, m in enumerate(messages_list, 1)))
     return messages_list
 
+async def generate_messages_async(user_data, user_message):
+    """Run ``generate_meassages`` on the Bedrock executor without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), generate_meassages, user_data, user_message)
+
+def generate_messages_stream(user_data, user_message):
+    """Yield each generated message as soon as the model finishes writing it.
+
+    Uses ``converse_stream`` and parses the JSON array incrementally, so the
+    first message is available after roughly one message's generation time.
+    """
+    logger.debug("Converse stream called for: %s", user_message)
+    # Times (and holds a governor permit for) the call up to the start of
+    # the stream, not the whole generation
+    request = build_converse_request(user_data, user_message)
+    response = bedrock_governor.call(request["modelId"], "converse_stream", _call,
+                                     "converse_stream", get_bedrock_client("us-east-1").converse_stream,
+                                     **request)
+    parser = JSONStringArrayParser()
+    for event in response["stream"]:
+        delta = event.get("contentBlockDelta", {}).get("delta", {}).get("text")
+        if delta:
+            for message in parser.feed(delta):
+                yield message
+            if parser.done:
+                break
+
+async def stream_messages_async(user_data, user_message):
+    """Async iterator over ``generate_messages_stream`` driven on the Bedrock executor."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+    stop = threading.Event()
+
+    def _pump():
+        try:
+            for message in generate_messages_stream(user_data, user_message):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, message)
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+
+    loop.run_in_executor(get_executor(), _pump)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Stop reading the Bedrock stream if the consumer went away
+        stop.set()
+
 def get_embeddings_batch(
 	texts: list,
 	model_id: str = "amazon.titan-embed-text-v1",
 	region: str = "us-east-1",
 	dimensions: int = 1536,
-	max_workers: int = 4,
-	retries: int = 2,
-	base_backoff: float = 0.5,
+	retries: int = None,
+	base_backoff: float = None,
+	store: EmbeddingStore = None,
 ):
 	"""Batch embed multiple texts with Titan, preserving order.
 
+	Texts already in the embedding store are served from it without calling
+	Bedrock; each distinct missing text is embedded once and stored. A text
+	already being embedded by another caller is awaited rather than re-sent.
+
 	Args:
 		texts: list of strings to embed.
 		model_id: Titan embedding model id.
@@ -99,68 +278,127 @@ def get_embeddings_batch(
 		dimensions: Output dimension size. Supported values depend on model:
 			- amazon.titan-embed-text-v1: 1536 (fixed)
 			- amazon.titan-embed-text-v2:0: 256, 512, 1024 (default: 1024)
-		max_workers: parallel requests.
-		retries: retry attempts per item on throttling/transient errors.
-		base_backoff: seconds for exponential backoff base.
+		retries: retry attempts per item on throttling/transient errors;
+			defaults to BEDROCK_RETRIES.
+		base_backoff: seconds for exponential backoff base; defaults to the
+			governor's.
+		store: embedding cache; defaults to get_embedding_store().
 
 	Returns:
-		List of embedding vectors (list[float]) aligned with input order.
+		List of float32 embedding vectors (np.ndarray) aligned with input order.
+	"""
+	results, missing, futures = _start_embeddings(
+		texts, model_id, region, dimensions, retries, base_backoff, store)
+	for text, fut in futures.items():
+		vec = fut.result()
+		for i in missing[text]:
+			results[i] = vec
+	return results
+
+async def get_embeddings_batch_async(
+	texts: list,
+	model_id: str = "amazon.titan-embed-text-v1",
+	region: str = "us-east-1",
+	dimensions: int = 1536,
+	retries: int = None,
+	base_backoff: float = None,
+	store: EmbeddingStore = None,
+):
+	"""Async ``get_embeddings_batch``: awaits the shared executor instead of blocking."""
+	results, missing, futures = _start_embeddings(
+		texts, model_id, region, dimensions, retries, base_backoff, store)
+	for text, fut in futures.items():
+		# Shielded: other callers may be waiting on the same coalesced request
+		vec = await asyncio.shield(asyncio.wrap_future(fut))
+		for i in missing[text]:
+			results[i] = vec
+	return results
+
+def _start_embeddings(
+	texts: list,
+	model_id: str = "amazon.titan-embed-text-v1",
+	region: str = "us-east-1",
+	dimensions: int = 1536,
+	retries: int = None,
+	base_backoff: float = None,
+	store: EmbeddingStore = None,
+):
+	"""Serve cache hits and submit (or join) in-flight requests for misses.
+
+	Returns ``(results, missing, futures)``: results with hits filled in,
+	text -> input indices still missing, and text -> Future of its vector.
 	"""
 	if not isinstance(texts, list):
 		raise TypeError("texts must be a list of strings")
+	for idx, text in enumerate(texts):
+		if not isinstance(text, str):
+			raise TypeError(f"texts[{idx}] is not a string")
+
+	if store is None:
+		store = get_embedding_store()
+	# Titan v1 always returns 1536 dimensions
+	store_dimensions = dimensions if "v2" in model_id else 1536
+	if store is not None:
+		results: list = store.get_many(model_id, store_dimensions, texts)
+	else:
+		results = [None] * len(texts)
+
+	# Embed each distinct missing text once
+	missing = {}
+	for idx, text in enumerate(texts):
+		if results[idx] is None:
+			missing.setdefault(text, []).append(idx)
+	if not missing:
+		return results, missing, {}
 
-	client = boto3.client("bedrock-runtime", region_name=region)
-	results: list = [None] * len(texts)
+	client = get_bedrock_client(region)
 
 	def _embed_one(idx: int, text: str):
-		if not isinstance(text, str):
-			raise TypeError(f"texts[{idx}] is not a string")
-		attempt = 0
-		while True:
-			try:
-				# Build request body based on model capabilities
-				if "v2" in model_id:
-					# Titan v2 supports configurable dimensions
-					body = json.dumps({
-						"inputText": text,
-						"dimensions": dimensions
-					})
-				else:
-					# Titan v1 has fixed 1536 dimensions
-					if dimensions != 1536 and idx == 0:  # Only warn once
-						print(f"Warning: Titan v1 only supports 1536 dimensions, ignoring dimensions={dimensions}")
-					body = json.dumps({"inputText": text})
-				
-				resp = client.invoke_model(
-					modelId=model_id,
-					body=body,
-					accept="application/json",
-					contentType="application/json",
-				)
-				payload = json.loads(resp["body"].read())
-				return idx, payload.get("embedding", [])
-			except ClientError as e:
-				code = e.response.get("Error", {}).get("Code")
-				status = (e.response.get("ResponseMetadata", {}) or {}).get("HTTPStatusCode")
-				if code in ("ThrottlingException", "TooManyRequestsException") or status in (429, 503, 500):
-					if attempt >= retries:
-						raise
-					delay = base_backoff * (2 ** attempt) + _random.uniform(0, 0.25)
-					_time.sleep(delay)
-					attempt += 1
-					continue
-				raise
-			except Exception:
-				if attempt >= retries:
-					raise
-				delay = base_backoff * (2 ** attempt) + _random.uniform(0, 0.25)
-				_time.sleep(delay)
-				attempt += 1
-
-	with ThreadPoolExecutor(max_workers=max_workers) as ex:
-		futures = [ex.submit(_embed_one, i, t) for i, t in enumerate(texts)]
-		for fut in as_completed(futures):
-			idx, vec = fut.result()
-			results[idx] = vec
-
-	return results
\ No newline at end of file
+		# Build request body based on model capabilities
+		if "v2" in model_id:
+			# Titan v2 supports configurable dimensions
+			body = json.dumps({
+				"inputText": text,
+				"dimensions": dimensions
+			})
+		else:
+			# Titan v1 has fixed 1536 dimensions
+			if dimensions != 1536 and idx == 0:  # Only warn once
+				logger.warning("Titan v1 only supports 1536 dimensions, ignoring dimensions=%s", dimensions)
+			body = json.dumps({"inputText": text})
+
+		resp = bedrock_governor.call(
+			model_id, "invoke_model", _call,
+			"invoke_model", client.invoke_model,
+			retries=retries,
+			base_backoff=base_backoff,
+			modelId=model_id,
+			body=body,
+			accept="application/json",
+			contentType="application/json",
+		)
+		payload = json.loads(resp["body"].read())
+		vec = payload.get("embedding", [])
+		if store is not None:
+			return store.put(model_id, store_dimensions, text, vec)
+		return np.asarray(vec, dtype=np.float32)
+
+	executor = get_executor()
+	futures = {}
+	for text, idxs in missing.items():
+		key = (model_id, store_dimensions, text_digest(text))
+		with _inflight_lock:
+			fut = _inflight_embeddings.get(key)
+			owner = fut is None
+			if owner:
+				fut = executor.submit(_embed_one, idxs[0], text)
+				_inflight_embeddings[key] = fut
+		if owner:
+			# Outside the lock: the callback runs inline if fut is already done
+			fut.add_done_callback(lambda _f, key=key: _forget_inflight(key))
+		futures[text] = fut
+	return results, missing, futures
+
+def _forget_inflight(key):
+	with _inflight_lock:
+		_inflight_embeddings.pop(key, None)
\ No newline at end of file
@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import threading
+import time
+from types import MappingProxyType
+from typing import Callable, Mapping, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogError(ValueError):
+    pass
+
+
+class Catalog:
+    """Immutable, indexed view of ``catalog.json``.
+
+    Built once per load: arm_id -> slot, cluster -> slot array (and arm ids),
+    user -> profile and arm ids. Handlers only do dict lookups against it.
+    A reload builds a new Catalog and swaps the reference, so a request that
+    already holds one keeps a consistent view.
+    """
+
+    def __init__(self, data: dict, source: str = "<dict>", version: float = 0.0):
+        self.source = source
+        self.version = version
+
+        arms = data.get("arms") or []
+        self.arm_ids: Tuple[str, ...] = tuple(arm["id"] for arm in arms)
+        if len(set(self.arm_ids)) != len(self.arm_ids):
+            raise CatalogError(f"{source}: duplicate arm ids")
+        self.slots: Mapping[str, int] = MappingProxyType(
+            {arm_id: i for i, arm_id in enumerate(self.arm_ids)})
+        self.descriptions: Mapping[str, Mapping[str, str]] = MappingProxyType({
+            arm["id"]: MappingProxyType({"message": arm["message"], "url": arm["url"]})
+            for arm in arms
+        })
+
+        aliases = dict(data.get("cluster_aliases") or {})
+        self.cluster_aliases: Mapping[str, str] = MappingProxyType(aliases)
+        cluster_arms = {}
+        cluster_slots = {}
+        for cluster, arm_ids in (data.get("clusters") or {}).items():
+            unknown = [a for a in arm_ids if a not in self.slots]
+            if unknown:
+                raise CatalogError(f"{source}: cluster {cluster!r} has unknown arms {unknown}")
+            cluster_arms[cluster] = tuple(arm_ids)
+            slots = np.array([self.slots[a] for a in arm_ids], dtype=np.intp)
+            slots.setflags(write=False)
+            cluster_slots[cluster] = slots
+        self.cluster_arms: Mapping[str, Tuple[str, ...]] = MappingProxyType(cluster_arms)
+        self.cluster_slots: Mapping[str, np.ndarray] = MappingProxyType(cluster_slots)
+
+        users = {}
+        user_arms = {}
+        for user_id, profile in (data.get("users") or {}).items():
+            users[user_id] = MappingProxyType(dict(profile))
+            cluster = self.cluster_name(profile["cluster_type"])
+            if cluster not in cluster_arms:
+                raise CatalogError(f"{source}: user {user_id!r} has unknown cluster {cluster!r}")
+            user_arms[user_id] = cluster_arms[cluster]
+        self.users: Mapping[str, Mapping[str, str]] = MappingProxyType(users)
+        self.user_arms: Mapping[str, Tuple[str, ...]] = MappingProxyType(user_arms)
+        self.default_user: Mapping[str, str] = MappingProxyType(dict(data["default_user"]))
+
+    @classmethod
+    def load(cls, path: str) -> "Catalog":
+        version = os.stat(path).st_mtime
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data, source=path, version=version)
+
+    def cluster_name(self, cluster_type: str) -> str:
+        """Canonical cluster name, e.g. "HELOC" -> "Home Equity Line of Credit"."""
+        return self.cluster_aliases.get(cluster_type, cluster_type)
+
+    def profile(self, user_id: str) -> Mapping[str, str]:
+        return self.users.get(user_id, self.default_user)
+
+    def summary(self) -> dict:
+        return {
+            "source": self.source,
+            "version": self.version,
+            "arms": len(self.arm_ids),
+            "clusters": {c: len(a) for c, a in self.cluster_arms.items()},
+            "users": len(self.users),
+        }
+
+
+class CatalogLoader:
+    """Holds the current Catalog and hot-reloads it when the file changes.
+
+    ``get`` stats the file at most every ``check_interval`` seconds; a
+    changed mtime triggers a reload. ``validate`` can reject a new catalog
+    (e.g. arms the running bandit doesn't know); a catalog that fails to
+    load or validate is logged and the previous one stays in use.
+    """
+
+    def __init__(self, path: str, check_interval: float = 5.0,
+                 validate: Optional[Callable[[Catalog], None]] = None):
+        self.path = path
+        self.check_interval = check_interval
+        self.validate = validate
+        self._lock = threading.Lock()
+        self._next_check = time.monotonic() + check_interval
+        self.reloads = 0
+        self.current = Catalog.load(path)
+        if validate is not None:
+            validate(self.current)
+        self._seen_version = self.current.version
+
+    def get(self) -> Catalog:
+        if self.check_interval > 0 and time.monotonic() >= self._next_check:
+            self.maybe_reload()
+        return self.current
+
+    def maybe_reload(self) -> bool:
+        """Reload if the file's mtime changed; returns True when swapped."""
+        with self._lock:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError as e:
+                logger.error("Catalog check failed for %s: %s", self.path, e)
+                return False
+            if mtime == self._seen_version:
+                return False
+            # Don't retry a bad file until it changes again
+            self._seen_version = mtime
+            try:
+                self._reload()
+            except (OSError, ValueError, KeyError) as e:
+                logger.error("Catalog reload rejected for %s: %s", self.path, e)
+                return False
+            return True
+
+    def reload(self) -> Catalog:
+        """Reload now; raises (keeping the current catalog) if the file is invalid."""
+        with self._lock:
+            return self._reload()
+
+    def _reload(self) -> Catalog:
+        catalog = Catalog.load(self.path)
+        if self.validate is not None:
+            self.validate(catalog)
+        self.current = catalog
+        self._seen_version = catalog.version
+        self.reloads += 1
+        logger.info("Catalog reloaded from %s: %d arms", self.path, len(catalog.arm_ids))
+        return catalog
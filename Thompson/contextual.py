@@ -0,0 +1,153 @@
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ContextEncoder:
+    """Builds context vectors: cluster one-hot + bias, plus a projected embedding.
+
+    With ``embed_dims > 0`` the (unit-normalized) user-message embedding is
+    reduced with a fixed, seeded Gaussian random projection so the model
+    stays small (d = clusters + 1 + embed_dims); a missing embedding
+    contributes zeros.
+    """
+
+    def __init__(self, clusters: Sequence[str], embed_dims: int = 0,
+                 embedding_dims: int = 1536, seed: int = 0):
+        self.clusters: Dict[str, int] = {c: i for i, c in enumerate(clusters)}
+        self.embed_dims = embed_dims
+        self.dim = len(self.clusters) + 1 + embed_dims
+        self.projection = None
+        if embed_dims:
+            rng = np.random.default_rng(seed)
+            self.projection = (rng.standard_normal((embedding_dims, embed_dims))
+                               / np.sqrt(embed_dims))
+
+    def encode(self, cluster: Optional[str], embedding=None) -> np.ndarray:
+        x = np.zeros(self.dim)
+        i = self.clusters.get(cluster)
+        if i is not None:
+            x[i] = 1.0
+        x[len(self.clusters)] = 1.0  # bias
+        if self.projection is not None and embedding is not None:
+            e = np.asarray(embedding, dtype=np.float64)
+            norm = np.linalg.norm(e)
+            if norm > 0:
+                x[len(self.clusters) + 1:] = (e / norm) @ self.projection
+        return x
+
+
+class LinearThompsonBandit:
+    """Linear Thompson sampling with one ridge-regression model per arm.
+
+    Each arm keeps ``A^-1`` (d x d), ``b`` and ``mu = A^-1 b``. A reward is
+    a Sherman-Morrison rank-one update of ``A^-1``, O(d^2). Choosing samples
+    every arm at once: for context x the score of arm k is
+    ``x.mu_k + v * sqrt(x' A_k^-1 x) * z_k`` (the exact distribution of
+    ``x.theta_k`` under the Gaussian posterior), batched with einsum.
+
+    State is kept in memory and written to ``<backup_dir>/<STATE_FILE>``
+    every ``snapshot_every`` updates and on close; it is per process.
+    """
+    STATE_FILE = "contextual_state.npz"
+
+    def __init__(self, arm_ids: List[str], dim: int, v: float = 0.5,
+                 ridge: float = 1.0, seed: Optional[int] = None,
+                 backup_dir: Optional[str] = "bandit_backup", snapshot_every: int = 100):
+        self.arm_ids: List[str] = list(arm_ids)
+        self.arms: Dict[str, int] = {aid: i for i, aid in enumerate(self.arm_ids)}
+        self.dim = dim
+        self.v = v
+        self.rng = np.random.default_rng(seed)
+        self.snapshot_every = snapshot_every
+        self.path = os.path.join(backup_dir, self.STATE_FILE) if backup_dir else None
+        self._lock = threading.Lock()
+        self._updates_since_snapshot = 0
+        n = len(self.arm_ids)
+        self.A_inv = np.tile(np.eye(dim) / ridge, (n, 1, 1))
+        self.b = np.zeros((n, dim))
+        self.mu = np.zeros((n, dim))
+        self.num_pulls = np.zeros(n, dtype=np.int64)
+        self.total_reward = np.zeros(n)
+        self.load_state()
+
+    def scores(self, x: np.ndarray, slots: Optional[np.ndarray] = None) -> np.ndarray:
+        """One posterior sample of the expected reward per arm (or per ``slots``)."""
+        A_inv = self.A_inv if slots is None else self.A_inv[slots]
+        mu = self.mu if slots is None else self.mu[slots]
+        var = np.einsum("j,kjl,l->k", x, A_inv, x)
+        z = self.rng.standard_normal(len(mu))
+        return mu @ x + self.v * np.sqrt(np.maximum(var, 0.0)) * z
+
+    def choose(self, x: np.ndarray, arm_ids: Optional[Sequence[str]] = None) -> str:
+        """Best sampled arm for context ``x``, optionally among ``arm_ids`` only."""
+        if arm_ids is None:
+            return self.arm_ids[int(np.argmax(self.scores(x)))]
+        slots = np.array([self.arms[a] for a in arm_ids], dtype=np.intp)
+        return self.arm_ids[int(slots[np.argmax(self.scores(x, slots))])]
+
+    def reward(self, arm_id: str, x: np.ndarray, reward: float):
+        i = self.arms[arm_id]
+        with self._lock:
+            A_inv = self.A_inv[i]
+            Ax = A_inv @ x
+            A_inv -= np.outer(Ax, Ax) / (1.0 + x @ Ax)
+            self.b[i] += reward * x
+            self.mu[i] = A_inv @ self.b[i]
+            self.num_pulls[i] += 1
+            self.total_reward[i] += reward
+            self._updates_since_snapshot += 1
+            due = self._updates_since_snapshot >= self.snapshot_every
+        if due:
+            self.save_state()
+
+    def state(self) -> Dict[str, dict]:
+        return {aid: {
+                "num_pulls": int(self.num_pulls[i]),
+                "total_reward": float(self.total_reward[i]),
+                "mu": self.mu[i].tolist(),
+            } for i, aid in enumerate(self.arm_ids)}
+
+    def save_state(self):
+        if self.path is None:
+            return
+        with self._lock:
+            arrays = dict(arm_ids=np.array(self.arm_ids, dtype=str), A_inv=self.A_inv.copy(),
+                          b=self.b.copy(), num_pulls=self.num_pulls.copy(),
+                          total_reward=self.total_reward.copy())
+            self._updates_since_snapshot = 0
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def load_state(self) -> bool:
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with np.load(self.path) as data:
+            if data["A_inv"].shape[1:] != (self.dim, self.dim):
+                logger.warning("Ignoring %s: context dimension changed (%d -> %d)",
+                               self.path, data['A_inv'].shape[1], self.dim)
+                return False
+            # Restore arms we still have; new arms start from the prior
+            for j, aid in enumerate(data["arm_ids"].tolist()):
+                i = self.arms.get(aid)
+                if i is None:
+                    continue
+                self.A_inv[i] = data["A_inv"][j]
+                self.b[i] = data["b"][j]
+                self.num_pulls[i] = data["num_pulls"][j]
+                self.total_reward[i] = data["total_reward"][j]
+        self.mu = np.einsum("kij,kj->ki", self.A_inv, self.b)
+        logger.info("Loaded contextual bandit state from %s", self.path)
+        return True
+
+    def close(self):
+        self.save_state()
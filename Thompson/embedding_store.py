@@ -0,0 +1,139 @@
+import hashlib
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class _Table:
+    """Vectors of one (model_id, dimensions) pair.
+
+    ``<name>.f32`` is a raw row-major float32 matrix and ``<name>.idx`` an
+    append-only list of ``<sha256> <row>`` lines. Rows are appended with
+    ``pwrite`` under an flock on the index file, so several workers can share
+    a table; reads are views into a read-only memmap of the matrix.
+    """
+
+    def __init__(self, directory: str, model_id: str, dimensions: int):
+        name = f"{re.sub(r'[^A-Za-z0-9]+', '_', model_id)}_{dimensions}"
+        self.dimensions = dimensions
+        self.row_bytes = dimensions * 4
+        self.vec_path = os.path.join(directory, f"{name}.f32")
+        self.idx_path = os.path.join(directory, f"{name}.idx")
+        self.index: Dict[str, int] = {}
+        self._idx_offset = 0
+        self._mm: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+        self._vec_fd = os.open(self.vec_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._idx_fd = os.open(self.idx_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._refresh_index()
+
+    def get(self, digest: str) -> Optional[np.ndarray]:
+        with self._lock:
+            row = self.index.get(digest)
+            if row is None:
+                # Another worker may have added it since we last looked
+                self._refresh_index()
+                row = self.index.get(digest)
+                if row is None:
+                    return None
+            return self._row(row)
+
+    def put(self, digest: str, vector: Sequence[float]) -> np.ndarray:
+        vec = np.asarray(vector, dtype=np.float32)
+        if vec.shape != (self.dimensions,):
+            raise ValueError(f"expected {self.dimensions} dimensions, got {vec.shape}")
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._idx_fd, fcntl.LOCK_EX)
+            try:
+                self._refresh_index()
+                row = self.index.get(digest)
+                if row is None:
+                    row = os.fstat(self._vec_fd).st_size // self.row_bytes
+                    os.pwrite(self._vec_fd, vec.tobytes(), row * self.row_bytes)
+                    line = f"{digest} {row}\n".encode()
+                    os.write(self._idx_fd, line)
+                    self._idx_offset += len(line)
+                    self.index[digest] = row
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._idx_fd, fcntl.LOCK_UN)
+            return self._row(row)
+
+    def _row(self, row: int) -> np.ndarray:
+        if self._mm is None or row >= self._mm.shape[0]:
+            rows = os.fstat(self._vec_fd).st_size // self.row_bytes
+            # Views handed out earlier keep the previous mapping alive
+            self._mm = np.memmap(self.vec_path, dtype=np.float32, mode="r",
+                                 shape=(rows, self.dimensions))
+        return self._mm[row]
+
+    def _refresh_index(self):
+        size = os.fstat(self._idx_fd).st_size
+        if size <= self._idx_offset:
+            return
+        data = os.pread(self._idx_fd, size - self._idx_offset, self._idx_offset)
+        # Only consume complete lines; a concurrent writer may be mid-line
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            digest, row = line.split()
+            self.index[digest.decode()] = int(row)
+        self._idx_offset += end
+
+    def __len__(self):
+        return len(self.index)
+
+
+class EmbeddingStore:
+    """Persistent, content-addressed embedding cache.
+
+    Vectors are keyed by ``(model_id, dimensions, sha256(text))`` and stored
+    in one memory-mapped float32 matrix per model/dimension pair with an
+    offset index, so a hit is a zero-copy row view and restarts start warm.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._tables: Dict[tuple, _Table] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def table(self, model_id: str, dimensions: int) -> _Table:
+        key = (model_id, dimensions)
+        with self._lock:
+            if key not in self._tables:
+                self._tables[key] = _Table(self.directory, model_id, dimensions)
+            return self._tables[key]
+
+    def get_many(self, model_id: str, dimensions: int, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Look up every text; misses are None."""
+        table = self.table(model_id, dimensions)
+        found = [table.get(text_digest(t)) for t in texts]
+        hits = sum(v is not None for v in found)
+        self.hits += hits
+        self.misses += len(texts) - hits
+        return found
+
+    def put(self, model_id: str, dimensions: int, text: str, vector: Sequence[float]) -> np.ndarray:
+        return self.table(model_id, dimensions).put(text_digest(text), vector)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "vectors": {f"{m}:{d}": len(t) for (m, d), t in self._tables.items()},
+        }
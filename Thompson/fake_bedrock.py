@@ -0,0 +1,252 @@
+"""Local stand-in for the Bedrock runtime API, for load tests and offline runs.
+
+    python fake_bedrock.py --port 8700 --latency-ms 800 --throttle-rate 0.02
+    BEDROCK_ENDPOINT_URL=http://127.0.0.1:8700 AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x \\
+        uvicorn main:app --port 8000
+
+Serves canned ``converse`` and ``converse_stream`` replies (ten messages as
+a JSON array, like the real prompt asks for) and deterministic
+``invoke_model`` embeddings (a seeded random unit vector per text), with
+injectable latency and throttling. Requests are not authenticated; boto3
+only needs some credentials to sign them.
+
+Settings can be changed while it runs with ``POST /_fake/config`` (same
+keys as ``FakeBedrockConfig``); ``GET /_fake/stats`` returns call counts.
+"""
+import argparse
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from dataclasses import asdict, dataclass, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import numpy as np
+
+MESSAGES = [
+    "Your next chapter could start at a front door you choose yourself, so let us help you take that first confident step.",
+    "Owning a home is about more than walls and a roof; it is a place to grow, gather and belong.",
+    "Take a fresh look at your mortgage and see whether a new plan fits the life you are living today.",
+    "The equity you have built at home can help fund the projects and goals that matter most to you.",
+    "Imagine the kitchen you have always wanted; your home may already hold the means to build it.",
+    "A simpler, clearer mortgage can free your attention for the things you truly care about.",
+    "Every great neighborhood story begins with someone deciding it is time to plant roots.",
+    "Your home has worked hard for you; explore how it can keep supporting your plans ahead.",
+    "Talk with a specialist who listens first and helps you find a path that feels right for you.",
+    "Big moves feel lighter with a guide by your side, from the first question to the final key.",
+    "Refreshing your home loan could be a practical way to line your finances up with your goals.",
+    "Turn the value in your walls into momentum for renovations, education or a well deserved upgrade.",
+    "Picture weekend mornings in a place that is truly yours, and let us help you get there.",
+    "When life changes, your mortgage can change with it; see what options might fit better now.",
+    "Your home is one of your strongest assets, and understanding it well opens new possibilities.",
+]
+
+
+@dataclass
+class FakeBedrockConfig:
+    latency_ms: float = 800.0        # converse / converse_stream, whole reply
+    jitter_ms: float = 200.0         # uniform +/- around every latency
+    embed_latency_ms: float = 40.0   # invoke_model
+    first_token_ms: float = 250.0    # converse_stream, before the first chunk
+    chunk_chars: int = 24            # converse_stream text per event
+    throttle_rate: float = 0.0       # fraction of calls answered with ThrottlingException
+    max_concurrency: int = 0         # throttle beyond this many calls in flight (0 = no limit)
+    dimensions: int = 1536           # embedding size when the request doesn't say
+
+
+def _event_message(event_type: str, payload: dict) -> bytes:
+    """One ``application/vnd.amazon.eventstream`` frame."""
+    headers = b""
+    for name, value in ((":event-type", event_type), (":content-type", "application/json"),
+                        (":message-type", "event")):
+        name_b, value_b = name.encode(), value.encode()
+        headers += struct.pack("!B", len(name_b)) + name_b + struct.pack("!BH", 7, len(value_b)) + value_b
+    body = json.dumps(payload).encode()
+    total = 12 + len(headers) + len(body) + 4
+    prelude = struct.pack("!II", total, len(headers))
+    message = prelude + struct.pack("!I", zlib.crc32(prelude)) + headers + body
+    return message + struct.pack("!I", zlib.crc32(message))
+
+
+def fake_embedding(text: str, dimensions: int) -> List[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    vec = np.random.default_rng(seed).standard_normal(dimensions)
+    return np.round(vec / np.linalg.norm(vec), 6).tolist()
+
+
+class FakeBedrock:
+    def __init__(self, config: FakeBedrockConfig, seed: int = 0):
+        self.config = config
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.calls: Dict[str, int] = {}
+        self.throttled = 0
+
+    def delay(self, ms: float):
+        jitter = self.config.jitter_ms
+        time.sleep(max(ms + self.rng.uniform(-jitter, jitter), 0.0) / 1000.0)
+
+    def admit(self, operation: str) -> bool:
+        """Count the call; False means answer it with a throttling error."""
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            limit = self.config.max_concurrency
+            if self.rng.random() < self.config.throttle_rate or (limit and self.in_flight >= limit):
+                self.throttled += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def messages_text(self) -> str:
+        return json.dumps(self.rng.sample(MESSAGES, 10))
+
+    def update(self, changes: dict):
+        names = {f.name: f.type for f in fields(FakeBedrockConfig)}
+        for key, value in changes.items():
+            if key in names:
+                setattr(self.config, key, type(getattr(self.config, key))(value))
+
+    def stats(self) -> dict:
+        return {"config": asdict(self.config), "calls": dict(self.calls),
+                "throttled": self.throttled, "in_flight": self.in_flight}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake: FakeBedrock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, data, headers: Dict[str, str] = None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def do_GET(self):
+        if self.path == "/_fake/stats":
+            self._send_json(200, self.fake.stats())
+        else:
+            self._send_json(404, {"message": f"no route for GET {self.path}"})
+
+    def do_POST(self):
+        request = self._read_json()
+        if self.path == "/_fake/config":
+            self.fake.update(request)
+            self._send_json(200, self.fake.stats())
+            return
+        # /model/<modelId>/<operation>
+        parts = self.path.split("/")
+        if len(parts) != 4 or parts[1] != "model":
+            self._send_json(404, {"message": f"no route for POST {self.path}"})
+            return
+        operation = parts[3]
+        if operation not in ("converse", "converse-stream", "invoke"):
+            self._send_json(404, {"message": f"unsupported operation {operation}"})
+            return
+        if not self.fake.admit(operation):
+            self._send_json(429, {"message": "Too many requests, please wait before trying again."},
+                            {"x-amzn-ErrorType": "ThrottlingException"})
+            return
+        try:
+            if operation == "invoke":
+                self._invoke(request)
+            elif operation == "converse":
+                self._converse()
+            else:
+                self._converse_stream()
+        finally:
+            self.fake.release()
+
+    def _invoke(self, request: dict):
+        config = self.fake.config
+        self.fake.delay(config.embed_latency_ms)
+        text = request.get("inputText", "")
+        self._send_json(200, {
+            "embedding": fake_embedding(text, int(request.get("dimensions", config.dimensions))),
+            "inputTextTokenCount": len(text.split()),
+        })
+
+    def _converse(self):
+        config = self.fake.config
+        started = time.perf_counter()
+        self.fake.delay(config.latency_ms)
+        self._send_json(200, {
+            "output": {"message": {"role": "assistant", "content": [{"text": self.fake.messages_text()}]}},
+            "stopReason": "end_turn",
+            "usage": {"inputTokens": 150, "outputTokens": 300, "totalTokens": 450},
+            "metrics": {"latencyMs": int((time.perf_counter() - started) * 1000)},
+        })
+
+    def _converse_stream(self):
+        config = self.fake.config
+        text = self.fake.messages_text()
+        chunks = [text[i:i + config.chunk_chars] for i in range(0, len(text), config.chunk_chars)]
+        per_chunk = max(config.latency_ms - config.first_token_ms, 0.0) / max(len(chunks), 1)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.fake.delay(config.first_token_ms)
+        self._write_chunk(_event_message("messageStart", {"role": "assistant"}))
+        for chunk in chunks:
+            self._write_chunk(_event_message("contentBlockDelta",
+                                             {"contentBlockIndex": 0, "delta": {"text": chunk}}))
+            time.sleep(per_chunk / 1000.0)
+        self._write_chunk(_event_message("contentBlockStop", {"contentBlockIndex": 0}))
+        self._write_chunk(_event_message("messageStop", {"stopReason": "end_turn"}))
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def serve(host: str = "127.0.0.1", port: int = 8700, config: FakeBedrockConfig = None,
+          seed: int = 0) -> ThreadingHTTPServer:
+    """Start the server on a daemon thread and return it (``shutdown()`` to stop)."""
+    handler = type("FakeBedrockHandler", (Handler,), {"fake": FakeBedrock(config or FakeBedrockConfig(), seed)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-bedrock", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake of the Bedrock runtime API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--seed", type=int, default=0)
+    for f in fields(FakeBedrockConfig):
+        parser.add_argument("--" + f.name.replace("_", "-"), type=type(f.default), default=f.default)
+    args = parser.parse_args()
+    config = FakeBedrockConfig(**{f.name: getattr(args, f.name) for f in fields(FakeBedrockConfig)})
+    server = serve(args.host, args.port, config, args.seed)
+    print(f"Fake Bedrock listening on http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import logging
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class DiscountedCounts:
+    """Discounted Thompson sampling: evidence decays with a half-life.
+
+    The decay is applied lazily. Each arm remembers when it was last
+    updated; an update first shrinks that arm's evidence (alpha/beta above
+    the prior) by ``0.5 ** (elapsed / half_life)``, and sampling applies the
+    pending decay to a copy. Decay is memoryless, so applying it late or in
+    pieces gives the same posterior, and a reward stays O(1). A reward
+    older than the arm's last update (e.g. from a batch) is added already
+    decayed by its age.
+    """
+    mode = "discounted"
+
+    def __init__(self, n_arms: int, half_life: float, prior: Tuple[float, float] = (1.0, 1.0)):
+        self.half_life = half_life
+        self.rate = math.log(2) / half_life
+        self.prior = prior
+        self.last_update = np.zeros(n_arms)  # 0 = never updated
+
+    def before_update(self, alpha: np.ndarray, beta: np.ndarray, i, t: float):
+        """Bring arm(s) ``i`` (an int or slice) forward to time ``t``."""
+        last = self.last_update[i]
+        factor = np.where(last > 0, np.exp(-self.rate * np.maximum(t - last, 0.0)), 1.0)
+        alpha[i] = self.prior[0] + (alpha[i] - self.prior[0]) * factor
+        beta[i] = self.prior[1] + (beta[i] - self.prior[1]) * factor
+        self.last_update[i] = np.maximum(last, t)
+
+    def weight(self, i, t: float):
+        """Share of a reward from time ``t`` still counted (after ``before_update``)."""
+        return np.exp(-self.rate * np.maximum(self.last_update[i] - t, 0.0))
+
+    def record(self, i, successes, failures, t: float):
+        pass
+
+    def posterior(self, alpha: np.ndarray, beta: np.ndarray, now: float):
+        factor = np.where(self.last_update > 0,
+                          np.exp(-self.rate * np.maximum(now - self.last_update, 0.0)), 1.0)
+        return (self.prior[0] + (alpha - self.prior[0]) * factor,
+                self.prior[1] + (beta - self.prior[1]) * factor)
+
+    def to_json(self, arm_ids: List[str]) -> dict:
+        return {"mode": self.mode, "half_life": self.half_life,
+                "last_update": dict(zip(arm_ids, self.last_update.tolist()))}
+
+    def load_json(self, data: Optional[dict], arms: Dict[str, int], alpha, beta, saved_at: float):
+        if data and data.get("mode") == self.mode:
+            for aid, t in data.get("last_update", {}).items():
+                i = arms.get(aid)
+                if i is not None:
+                    self.last_update[i] = t
+        else:
+            # Undiscounted state: start decaying it from when it was saved
+            self.last_update[:] = saved_at
+
+
+class SlidingWindowCounts:
+    """Sliding-window Thompson sampling over the last ``window`` seconds.
+
+    A ring buffer of ``buckets`` rows holds per-arm success/failure counts
+    for consecutive time buckets. alpha/beta always equal the prior plus the
+    sum of the ring, so sampling needs no extra work. A reward adds to the
+    current bucket (O(1)); when time crosses into a new bucket the expiring
+    row is subtracted and zeroed, one vectorized step per bucket. A reward
+    from an earlier bucket still inside the window goes into that bucket;
+    one from before the window is not counted.
+    """
+    mode = "window"
+
+    def __init__(self, n_arms: int, window: float, buckets: int = 168,
+                 prior: Tuple[float, float] = (1.0, 1.0)):
+        self.window = window
+        self.buckets = buckets
+        self.width = window / buckets
+        self.prior = prior
+        self.successes = np.zeros((buckets, n_arms))
+        self.failures = np.zeros((buckets, n_arms))
+        self.epoch: Optional[int] = None  # number of the current bucket
+
+    def needs_advance(self, t: float) -> bool:
+        return self.epoch is None or int(t // self.width) > self.epoch
+
+    def advance(self, alpha: np.ndarray, beta: np.ndarray, t: float):
+        """Expire buckets older than the window as of ``t`` (needs every arm's lock)."""
+        epoch = int(t // self.width)
+        if self.epoch is None:
+            self.epoch = epoch
+            return
+        if epoch <= self.epoch:
+            return
+        # At most one full turn of the ring can expire
+        for e in range(self.epoch + 1, min(epoch, self.epoch + self.buckets) + 1):
+            row = e % self.buckets
+            alpha -= self.successes[row]
+            beta -= self.failures[row]
+            self.successes[row] = 0.0
+            self.failures[row] = 0.0
+        self.epoch = epoch
+
+    def before_update(self, alpha, beta, i, t: float):
+        if self.epoch is None:
+            self.epoch = int(t // self.width)
+
+    def weight(self, i, t: float) -> float:
+        return 1.0 if int(t // self.width) > self.epoch - self.buckets else 0.0
+
+    def record(self, i, successes, failures, t: float):
+        epoch = min(int(t // self.width), self.epoch)
+        if epoch <= self.epoch - self.buckets:
+            return
+        row = epoch % self.buckets
+        self.successes[row, i] += successes
+        self.failures[row, i] += failures
+
+    def posterior(self, alpha: np.ndarray, beta: np.ndarray, now: float):
+        return alpha, beta
+
+    def to_json(self, arm_ids: List[str]) -> dict:
+        return {"mode": self.mode, "window": self.window, "buckets": self.buckets,
+                "epoch": self.epoch,
+                "successes": dict(zip(arm_ids, self.successes.T.tolist())),
+                "failures": dict(zip(arm_ids, self.failures.T.tolist()))}
+
+    def load_json(self, data: Optional[dict], arms: Dict[str, int], alpha, beta, saved_at: float):
+        same = (data and data.get("mode") == self.mode and data.get("window") == self.window
+                and data.get("buckets") == self.buckets)
+        if same:
+            self.epoch = data["epoch"]
+            for key, ring in (("successes", self.successes), ("failures", self.failures)):
+                for aid, counts in data[key].items():
+                    i = arms.get(aid)
+                    if i is not None:
+                        ring[:, i] = counts
+        else:
+            # First start in this mode (or the window settings changed): put the
+            # loaded evidence in the current bucket, so it still counts for one
+            # window and then ages out, instead of being reset to the prior
+            self.epoch = int(time.time() // self.width)
+            row = self.epoch % self.buckets
+            self.successes[row] = np.maximum(np.asarray(alpha) - self.prior[0], 0.0)
+            self.failures[row] = np.maximum(np.asarray(beta) - self.prior[1], 0.0)
+            logger.info("No sliding window in the saved state (or settings changed); "
+                        "the loaded posterior starts a new window")
+        # The posterior is exactly the prior plus what is inside the window
+        alpha[:] = self.prior[0] + self.successes.sum(axis=0)
+        beta[:] = self.prior[1] + self.failures.sum(axis=0)
+
+
+def make_forgetting(mode: Optional[str], n_arms: int, half_life: float, window: float,
+                    buckets: int, prior: Tuple[float, float]):
+    """``None`` (keep all evidence), "discounted" or "window"."""
+    if mode in (None, "", "none"):
+        return None
+    if mode == "discounted":
+        return DiscountedCounts(n_arms, half_life, prior)
+    if mode == "window":
+        return SlidingWindowCounts(n_arms, window, buckets, prior)
+    raise ValueError(f"unknown adaptation mode: {mode!r}")
@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(text: str) -> str:
+    """Case- and whitespace-insensitive form of a prompt."""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def prompt_key(*parts: str) -> str:
+    """sha256 over the normalized prompt parts (e.g. model id and user message)."""
+    normalized = json.dumps([normalize_prompt(p) for p in parts])
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    """TTL + LRU cache for generated (and ranked) message sets.
+
+    Entries are fresh for ``ttl`` seconds. Between ``ttl`` and ``stale_ttl``
+    they are still served, but ``aget_or_compute`` starts one background
+    refresh task (stale-while-revalidate). Older entries are recomputed inline.
+    Concurrent computations for the same key are coalesced into one.
+
+    At most ``max_entries`` are kept in memory, least recently used first
+    out. When ``disk_dir`` is set every entry is also written there as JSON
+    so the cache survives restarts and is shared by workers on one host.
+    """
+
+    def __init__(self, ttl: float = 900.0, stale_ttl: float = 86400.0,
+                 max_entries: int = 256, disk_dir: Optional[str] = None):
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        if disk_dir and not os.path.exists(disk_dir):
+            os.makedirs(disk_dir)
+
+    def peek(self, key: str) -> Optional[Tuple[Any, bool]]:
+        """Return ``(value, is_fresh)`` without computing, or None if unusable."""
+        entry = self._lookup(key)
+        if entry is None:
+            return None
+        created, value = entry
+        age = time.time() - created
+        if age >= self.stale_ttl:
+            return None
+        return value, age < self.ttl
+
+    def get_fresh(self, key: str) -> Optional[Any]:
+        """Return the value only if it is fresh (counted as a hit), else None."""
+        cached = self.peek(key)
+        if cached is None or not cached[1]:
+            return None
+        self.hits += 1
+        return cached[0]
+
+    def set(self, key: str, value: Any, created: Optional[float] = None):
+        created = time.time() if created is None else created
+        with self._lock:
+            self._remember(key, created, value)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created": created, "value": value}, f)
+            os.replace(tmp_path, path)
+
+    async def aget_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Serve from cache, refreshing stale entries in a background task."""
+        cached = self.peek(key)
+        if cached is not None:
+            value, fresh = cached
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+                with self._lock:
+                    refreshing = key in self._inflight
+                if not refreshing:
+                    asyncio.get_running_loop().create_task(self._arefresh(key, compute))
+            return value
+        self.misses += 1
+        return await self._acompute(key, compute)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshing": len(self._inflight),
+        }
+
+    async def _acompute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        with self._lock:
+            fut = self._inflight.get(key)
+            owner = fut is None
+            if owner:
+                fut = Future()
+                # A running future can't be cancelled, so one waiter giving up
+                # (e.g. a superseded job) doesn't abort the shared computation
+                fut.set_running_or_notify_cancel()
+                self._inflight[key] = fut
+        if owner:
+            asyncio.get_running_loop().create_task(self._run_compute(key, compute, fut))
+        return await asyncio.wrap_future(fut)
+
+    async def _run_compute(self, key: str, compute: Callable[[], Awaitable[Any]], fut: Future):
+        try:
+            value = await compute()
+            self.set(key, value)
+            fut.set_result(value)
+        except BaseException as e:
+            fut.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    async def _arefresh(self, key: str, compute: Callable[[], Awaitable[Any]]):
+        try:
+            await self._acompute(key, compute)
+        except Exception as e:
+            logger.error("Error refreshing generation cache entry %s: %s", key[:12], e)
+
+    def _lookup(self, key: str) -> Optional[Tuple[float, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        entry = (data["created"], data["value"])
+        with self._lock:
+            self._remember(key, *entry)
+        return entry
+
+    def _remember(self, key: str, created: float, value: Any):
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
@@ -0,0 +1,315 @@
+"""Posterior history: per-arm snapshots in chunked, memory-mapped columns.
+
+    python history.py import bandit_backup       # load bandit_state_*.json files
+    python history.py query purchase_1 --from 2025-09-01 --resolution 1d
+"""
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("alpha", "beta", "total_reward", "num_pulls")
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+
+def parse_time(value) -> Optional[float]:
+    """Unix seconds from a number or an ISO 8601 string (None passes through)."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(str(value)).timestamp()
+
+
+def parse_duration(value) -> Optional[float]:
+    """Seconds from a number or ``<n><s|m|h|d|w>``, e.g. ``"15m"``."""
+    if value is None or value == "":
+        return None
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([smhdw]?)\s*", str(value))
+    if match is None:
+        raise ValueError(f"bad duration {value!r}; use seconds or e.g. 15m, 1h, 1d")
+    return float(match.group(1)) * _DURATION_UNITS[match.group(2) or "s"]
+
+
+class _Chunk:
+    """Up to ``capacity`` snapshot rows over a fixed list of arms.
+
+    ``<name>.json`` lists the arm ids (the columns), ``<name>.ts`` is an
+    append-only float64 array of row timestamps, and ``<name>.f32`` a
+    preallocated float32 array shaped ``[field, row, arm]``, so one arm's
+    values over a time range are a strided slice of a memmap. A row is
+    written to ``.f32`` first and becomes visible when its timestamp is
+    appended, so readers never see a partial row.
+    """
+
+    def __init__(self, directory: str, index: int, capacity: int):
+        self.index = index
+        base = os.path.join(directory, f"chunk_{index:06d}")
+        self.meta_path = base + ".json"
+        self.ts_path = base + ".ts"
+        self.data_path = base + ".f32"
+        with open(self.meta_path, "r", encoding="utf-8") as f:
+            self.arm_ids: List[str] = json.load(f)["arms"]
+        self.capacity = capacity
+        self.slots = {arm_id: i for i, arm_id in enumerate(self.arm_ids)}
+        self._ts: Optional[np.ndarray] = None
+        self._data: Optional[np.memmap] = None
+
+    @classmethod
+    def create(cls, directory: str, index: int, capacity: int, arm_ids: Sequence[str]) -> "_Chunk":
+        base = os.path.join(directory, f"chunk_{index:06d}")
+        with open(base + ".f32", "wb") as f:
+            f.truncate(len(FIELDS) * capacity * len(arm_ids) * 4)
+        open(base + ".ts", "wb").close()
+        tmp_path = base + ".json.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"arms": list(arm_ids), "fields": list(FIELDS), "capacity": capacity}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # The chunk exists once its metadata does
+        os.replace(tmp_path, base + ".json")
+        return cls(directory, index, capacity)
+
+    @property
+    def rows(self) -> int:
+        return os.path.getsize(self.ts_path) // 8
+
+    def timestamps(self) -> np.ndarray:
+        """Row timestamps; cached once the chunk is full, re-read while it is growing."""
+        if self._ts is None or len(self._ts) < self.capacity:
+            self._ts = np.fromfile(self.ts_path, dtype=np.float64)
+        return self._ts
+
+    def data(self) -> np.memmap:
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=np.float32, mode="r",
+                                   shape=(len(FIELDS), self.capacity, len(self.arm_ids)))
+        return self._data
+
+    def write_row(self, row: int, timestamp: float, values: np.ndarray):
+        """Write ``values`` (``[field, arm]``) as row ``row``, then publish its timestamp."""
+        n_arms = len(self.arm_ids)
+        fd = os.open(self.data_path, os.O_WRONLY)
+        try:
+            for f in range(len(FIELDS)):
+                os.pwrite(fd, values[f].astype(np.float32).tobytes(), (f * self.capacity + row) * n_arms * 4)
+        finally:
+            os.close(fd)
+        with open(self.ts_path, "ab") as f:
+            f.write(np.float64(timestamp).tobytes())
+
+
+class HistoryStore:
+    """Append-only history of per-arm posteriors, queryable by time range.
+
+    Rows go into fixed-size chunks (a new chunk starts when one fills up or
+    the arm set changes); a query binary-searches each overlapping chunk's
+    timestamps and slices the memory-mapped columns, so its cost depends
+    on the rows returned, not on how much history there is. Appends take an
+    flock on the directory's lock file, so several workers can record into
+    one store; timestamps must increase, older rows are ignored.
+    """
+
+    def __init__(self, directory: str, chunk_rows: int = 4096):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        os.makedirs(directory, exist_ok=True)
+        self._chunks: List[_Chunk] = []
+        self._lock = threading.Lock()
+        self._lock_fd = os.open(os.path.join(directory, "history.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        self.appended = 0
+        self.skipped = 0
+        self._refresh()
+
+    def _refresh(self):
+        """Pick up chunks created since the last look (possibly by another process)."""
+        known = len(self._chunks)
+        for path in sorted(glob.glob(os.path.join(self.directory, "chunk_*.json")))[known:]:
+            index = int(os.path.basename(path)[6:12])
+            with open(path, "r", encoding="utf-8") as f:
+                capacity = json.load(f).get("capacity", self.chunk_rows)
+            self._chunks.append(_Chunk(self.directory, index, capacity))
+
+    def last_timestamp(self) -> Optional[float]:
+        with self._lock:
+            self._refresh()
+            for chunk in reversed(self._chunks):
+                ts = chunk.timestamps()
+                if len(ts):
+                    return float(ts[-1])
+        return None
+
+    def append(self, timestamp: float, arm_ids: Sequence[str], values: Dict[str, Iterable[float]]) -> bool:
+        """Record one snapshot; ``values`` maps each of FIELDS to per-arm values in ``arm_ids`` order.
+
+        Returns False (and records nothing) if ``timestamp`` is not newer than the last row.
+        """
+        arm_ids = list(arm_ids)
+        row_values = np.array([np.asarray(values[f], dtype=np.float64) for f in FIELDS])
+        if row_values.shape != (len(FIELDS), len(arm_ids)):
+            raise ValueError(f"expected {len(FIELDS)} fields x {len(arm_ids)} arms, got {row_values.shape}")
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                chunk = self._chunks[-1] if self._chunks else None
+                rows = chunk.rows if chunk is not None else 0
+                if rows and timestamp <= float(chunk.timestamps()[-1]):
+                    self.skipped += 1
+                    return False
+                if chunk is None or rows >= chunk.capacity or chunk.arm_ids != arm_ids:
+                    index = chunk.index + 1 if chunk is not None else 0
+                    chunk = _Chunk.create(self.directory, index, self.chunk_rows, arm_ids)
+                    self._chunks.append(chunk)
+                    rows = 0
+                chunk.write_row(rows, timestamp, row_values)
+                self.appended += 1
+                return True
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def append_bandit(self, bandit, timestamp: float) -> bool:
+        """Record the bandit's current (effective) posteriors and lifetime counters."""
+        alpha, beta = bandit.posterior()
+        return self.append(timestamp, bandit.arm_ids, {
+            "alpha": alpha, "beta": beta,
+            "total_reward": bandit.total_reward, "num_pulls": bandit.num_pulls,
+        })
+
+    def query(self, arm_id: str, start: Optional[float] = None, end: Optional[float] = None,
+              resolution: Optional[float] = None, max_points: int = 1000) -> Optional[dict]:
+        """One arm's history in ``[start, end]``, downsampled to one row per ``resolution`` seconds.
+
+        The last row of each bucket is kept (the values are running totals).
+        Without ``resolution`` it is chosen so at most ``max_points`` rows
+        come back. Returns None if the arm never appears in the history.
+        """
+        start = -math.inf if start is None else start
+        end = math.inf if end is None else end
+        times, columns, seen = [], [], False
+        with self._lock:
+            self._refresh()
+            chunks = list(self._chunks)
+        for chunk in chunks:
+            col = chunk.slots.get(arm_id)
+            if col is None:
+                continue
+            seen = True
+            ts = chunk.timestamps()
+            if not len(ts) or ts[0] > end or ts[-1] < start:
+                continue
+            lo, hi = np.searchsorted(ts, start, "left"), np.searchsorted(ts, end, "right")
+            if hi > lo:
+                times.append(ts[lo:hi])
+                columns.append(np.array(chunk.data()[:, lo:hi, col], dtype=np.float64))
+        if not seen:
+            return None
+        t = np.concatenate(times) if times else np.zeros(0)
+        values = np.concatenate(columns, axis=1) if columns else np.zeros((len(FIELDS), 0))
+        if resolution is None and len(t) > max_points:
+            resolution = math.ceil((t[-1] - t[0]) / max_points) or None
+        if resolution and len(t):
+            buckets = np.floor(t / resolution)
+            keep = np.append(np.flatnonzero(np.diff(buckets)), len(t) - 1)
+            t, values = t[keep], values[:, keep]
+        alpha, beta = values[0], values[1]
+        mean = np.divide(alpha, alpha + beta, out=np.zeros_like(alpha), where=(alpha + beta) > 0)
+        out = {
+            "arm_id": arm_id,
+            "from": float(t[0]) if len(t) else None,
+            "to": float(t[-1]) if len(t) else None,
+            "resolution_seconds": resolution,
+            "points": int(len(t)),
+            "timestamp": t.tolist(),
+        }
+        for i, field in enumerate(FIELDS):
+            out[field] = values[i].tolist()
+        out["mean"] = mean.tolist()
+        return out
+
+    def import_snapshots(self, paths: Iterable[str]) -> int:
+        """Append ``bandit_state*.json`` snapshots newer than the last row, oldest first."""
+        snapshots = []
+        for path in paths:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                timestamp = parse_time(state["timestamp"]) if "timestamp" in state else os.path.getmtime(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Skipping %s: %s", path, e)
+                continue
+            snapshots.append((timestamp, state["arms"]))
+        imported = 0
+        for timestamp, arms in sorted(snapshots, key=lambda s: s[0]):
+            arm_ids = list(arms)
+            values = {f: [arms[a].get(f, 0.0) for a in arm_ids] for f in FIELDS}
+            imported += self.append(timestamp, arm_ids, values)
+        return imported
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refresh()
+            chunks = list(self._chunks)
+        return {
+            "chunks": len(chunks),
+            "rows": sum(c.rows for c in chunks),
+            # Chunks are preallocated as sparse files; count what is on disk
+            "bytes": sum((os.stat(c.data_path).st_blocks + os.stat(c.ts_path).st_blocks) * 512
+                         for c in chunks),
+            "appended": self.appended,
+            "skipped": self.skipped,
+        }
+
+    def close(self):
+        os.close(self._lock_fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bandit posterior history")
+    parser.add_argument("--dir", default=os.path.join("bandit_backup", "history"))
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="import bandit_state*.json snapshots")
+    imp.add_argument("paths", nargs="+", help="snapshot files or directories holding them")
+    q = sub.add_parser("query", help="print one arm's history as JSON")
+    q.add_argument("arm")
+    q.add_argument("--from", dest="start")
+    q.add_argument("--to", dest="end")
+    q.add_argument("--resolution")
+    args = parser.parse_args()
+
+    store = HistoryStore(args.dir)
+    if args.command == "import":
+        paths = []
+        for path in args.paths:
+            if os.path.isdir(path):
+                paths.extend(glob.glob(os.path.join(path, "bandit_state*.json")))
+            else:
+                paths.append(path)
+        print(f"Imported {store.import_snapshots(paths)} of {len(paths)} snapshots into {args.dir}", flush=True)
+        print(json.dumps(store.stats()))
+    else:
+        result = store.query(args.arm, parse_time(args.start), parse_time(args.end),
+                             parse_duration(args.resolution))
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
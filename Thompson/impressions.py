@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Row states
+EXPIRED = 0
+OPEN = 1
+REWARDED = 2
+
+MAGIC = 0x494D505231  # "IMPR1"
+# Header words: magic, token, capacity, next sequence number, oldest open one
+HEADER_WORDS = 8
+USER_BYTES = 32
+
+
+class ImpressionError(KeyError):
+    """Unknown, expired or evicted impression id."""
+
+
+class ImpressionLog:
+    """Fixed-memory log of served arms awaiting a reward.
+
+    Impression ``n`` lives in row ``n % capacity`` of a few parallel arrays
+    (sequence number, arm slot, issue time, state, user), so the "hash
+    index" is the modulo itself and memory never grows. Ids are issued in
+    time order, so expiry is a binary search from the oldest open row:
+    every impression not rewarded within ``ttl`` seconds (or overwritten
+    because the ring wrapped first) becomes a 0 reward.
+
+    Expired impressions are only collected under the lock; ``expire`` (run
+    by the sweep task) hands them to ``on_expire(slots, issued_at, user_ids)``
+    after releasing it, so the caller can apply them like any other batch
+    of rewards.
+
+    With ``path`` the arrays live in a memory-mapped file guarded by an
+    flock, so every uvicorn worker shares one log and any of them can join
+    a reward. Ids look like ``<log token>-<sequence>``; the token is stored
+    in the file, so ids from a replaced log are rejected. User ids longer
+    than ``USER_BYTES`` are not kept.
+    """
+
+    def __init__(self, n_arms: int, on_expire: Callable[[np.ndarray, np.ndarray, List[Optional[str]]], None],
+                 capacity: int = 1 << 18, ttl: float = 1800.0, path: Optional[str] = None):
+        self.n_arms = n_arms
+        self.on_expire = on_expire
+        self.capacity = capacity
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._lock_fd: Optional[int] = None
+        if path is None:
+            self._header = np.zeros(HEADER_WORDS, dtype=np.int64)
+            self._header[:3] = (MAGIC, secrets.randbits(62), capacity)
+            self._seq = np.full(capacity, -1, dtype=np.int64)
+            self._slot = np.zeros(capacity, dtype=np.int32)
+            self._issued_at = np.zeros(capacity, dtype=np.float64)
+            self._state = np.zeros(capacity, dtype=np.int8)
+            self._user = np.zeros(capacity, dtype=f"S{USER_BYTES}")
+        else:
+            if fcntl is None:
+                raise RuntimeError("a shared impression log requires fcntl (POSIX)")
+            self._lock_fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+            with self._locked():
+                self._map()
+        self.token = format(int(self._header[1]), "x")
+        # Expired impressions collected under the lock, not yet passed to on_expire
+        self._pending: List[tuple] = []
+        self._task: Optional[asyncio.Task] = None
+        self.issued = 0
+        self.joined = 0
+        self.duplicates = 0
+        self.expired = 0
+        self.evicted = 0
+        self.unknown = 0
+
+    # (attribute, dtype) of each array, in file order after the header
+    _COLUMNS = (("_seq", np.int64), ("_slot", np.int32), ("_issued_at", np.float64),
+                ("_state", np.int8), ("_user", f"S{USER_BYTES}"))
+
+    def _map(self):
+        """Attach to the log file, creating it if missing or laid out differently (under the flock)."""
+        size = HEADER_WORDS * 8 + sum(np.dtype(dtype).itemsize for _, dtype in self._COLUMNS) * self.capacity
+        header = None
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            header = np.memmap(self.path, dtype=np.int64, mode="r+", shape=(HEADER_WORDS,))
+            if header[0] != MAGIC or header[2] != self.capacity:
+                header = None
+        if header is None:
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.truncate(size)
+            init = np.memmap(tmp_path, dtype=np.int64, mode="r+", shape=(HEADER_WORDS + self.capacity,))
+            init[:3] = (MAGIC, secrets.randbits(62), self.capacity)
+            init[HEADER_WORDS:] = -1  # _seq: no impression in any row
+            init.flush()
+            del init
+            os.replace(tmp_path, self.path)
+            header = np.memmap(self.path, dtype=np.int64, mode="r+", shape=(HEADER_WORDS,))
+        self._header = header
+        offset = HEADER_WORDS * 8
+        for name, dtype in self._COLUMNS:
+            setattr(self, name, np.memmap(self.path, dtype=dtype, mode="r+", offset=offset,
+                                          shape=(self.capacity,)))
+            offset += np.dtype(dtype).itemsize * self.capacity
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            if self._lock_fd is None:
+                yield
+                return
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    @property
+    def _next(self) -> int:
+        """Next sequence number to issue."""
+        return int(self._header[3])
+
+    @property
+    def _oldest(self) -> int:
+        """No open impression has a lower sequence number."""
+        return int(self._header[4])
+
+    def issue(self, slots, user_id: Optional[str] = None) -> List[str]:
+        """Record one impression per arm slot, shown to ``user_id``; returns their ids."""
+        slots = np.atleast_1d(np.asarray(slots, dtype=np.int32))
+        n = len(slots)
+        if n > self.capacity:
+            raise ValueError(f"cannot issue {n} impressions into a log of {self.capacity}")
+        user = (user_id or "").encode("utf-8")
+        if len(user) > USER_BYTES:
+            user = b""
+        now = time.time()
+        with self._locked():
+            start = self._next
+            # Rows about to be reused must not hold open impressions
+            self._expire_locked(now, upto=start + n - self.capacity)
+            seqs = np.arange(start, start + n, dtype=np.int64)
+            rows = seqs % self.capacity
+            self._seq[rows] = seqs
+            self._slot[rows] = slots
+            self._issued_at[rows] = now
+            self._state[rows] = OPEN
+            self._user[rows] = user
+            self._header[3] = start + n
+            self.issued += n
+        return [f"{self.token}-{s}" for s in seqs.tolist()]
+
+    def join(self, impression_id: str, slot: Optional[int] = None) -> Optional[int]:
+        """Close an impression and return its arm slot, or None if it was already rewarded.
+
+        Raises ImpressionError if the id is unknown, expired or evicted, and
+        ValueError (leaving it open) if ``slot`` is given and doesn't match.
+        """
+        token, _, seq = impression_id.partition("-")
+        try:
+            seq = int(seq)
+        except ValueError:
+            seq = -1
+        with self._locked():
+            row = seq % self.capacity
+            if token != self.token or seq < 0 or self._seq[row] != seq:
+                self.unknown += 1
+                raise ImpressionError(impression_id)
+            state = self._state[row]
+            if state == REWARDED:
+                self.duplicates += 1
+                return None
+            if state == EXPIRED or time.time() - self._issued_at[row] >= self.ttl:
+                # Past its TTL (swept or not): it already counts as a 0 reward
+                self.unknown += 1
+                raise ImpressionError(impression_id)
+            if slot is not None and slot != self._slot[row]:
+                raise ValueError(f"impression {impression_id} was not for this arm")
+            self._state[row] = REWARDED
+            self.joined += 1
+            return int(self._slot[row])
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Emit 0 rewards for every impression past its TTL (or evicted); returns how many."""
+        with self._locked():
+            self._expire_locked(time.time() if now is None else now)
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+        slots = np.concatenate([p[0] for p in pending])
+        issued_at = np.concatenate([p[1] for p in pending])
+        user_ids = [u.decode("utf-8") or None for p in pending for u in p[2].tolist()]
+        self.on_expire(slots, issued_at, user_ids)
+        return len(slots)
+
+    def _expire_locked(self, now: float, upto: int = -1) -> int:
+        """Close impressions older than the TTL and, if ``upto`` is set, every
+        sequence number below it (rows about to be overwritten)."""
+        cutoff = now - self.ttl
+        oldest = self._oldest
+        # Sequence numbers are issued in time order: binary search for the
+        # first impression still inside its TTL
+        lo, hi = max(oldest, upto), self._next
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._issued_at[mid % self.capacity] <= cutoff:
+                lo = mid + 1
+            else:
+                hi = mid
+        end = max(lo, oldest)
+        if end == oldest:
+            return 0
+        rows = np.arange(oldest, end) % self.capacity
+        open_rows = rows[self._state[rows] == OPEN]
+        self._state[open_rows] = EXPIRED
+        self._header[4] = end
+        n = len(open_rows)
+        if n:
+            evicted = int(np.count_nonzero(self._issued_at[open_rows] > cutoff))
+            self.evicted += evicted
+            self.expired += n - evicted
+            self._pending.append((np.array(self._slot[open_rows]), np.array(self._issued_at[open_rows]),
+                                  np.array(self._user[open_rows])))
+        return n
+
+    async def start(self, interval: Optional[float] = None):
+        """Sweep periodically so zeros are recorded even when traffic stops."""
+        if self._task is None:
+            interval = interval if interval is not None else min(max(self.ttl / 10, 1.0), 60.0)
+            self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.expire()
+            except Exception as e:
+                logger.error("Error expiring impressions: %s", e)
+
+    def close(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def metrics(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "ttl_seconds": self.ttl,
+            "shared": self.path is not None,
+            "open": int(np.count_nonzero(self._state == OPEN)),
+            # Counted by this process only
+            "issued": self.issued,
+            "joined": self.joined,
+            "duplicates": self.duplicates,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "unknown": self.unknown,
+        }
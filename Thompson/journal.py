@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RewardJournal:
+    """Append-only, write-behind journal of reward events.
+
+    ``append`` only buffers the event in memory and returns its sequence
+    number; a background thread writes buffered events as compact JSON lines
+    and fsyncs them as a group, either every ``flush_interval`` seconds or as
+    soon as ``flush_events`` events are pending, whichever comes first.
+
+    Durability is explicit: an appended event is on disk once the next group
+    flush completes (at most ``flush_interval`` seconds later), or right away
+    after a call to ``flush()``.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, flush_events: int = 64,
+                 on_flush: Optional[Callable[[int], None]] = None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        # Called from the writer thread with the last durable sequence number
+        self.on_flush = on_flush
+        self._pending: List[str] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._io_lock = threading.Lock()
+        self._closed = False
+        self.last_seq = 0
+        self.durable_seq = 0
+        for event in self.replay():
+            self.last_seq = max(self.last_seq, event["s"])
+        self.durable_seq = self.last_seq
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name="reward-journal", daemon=True)
+        self._thread.start()
+
+    def append(self, event: dict) -> int:
+        """Buffer one event and return the sequence number assigned to it."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("journal is closed")
+            self.last_seq += 1
+            record = {"s": self.last_seq, "t": round(time.time(), 3)}
+            record.update(event)
+            self._pending.append(json.dumps(record, separators=(",", ":")))
+            if len(self._pending) >= self.flush_events:
+                self._wakeup.notify()
+            return self.last_seq
+
+    def advance_to(self, seq: int):
+        """Never hand out sequence numbers at or below ``seq`` (a snapshot's)."""
+        with self._lock:
+            self.last_seq = max(self.last_seq, seq)
+            self.durable_seq = max(self.durable_seq, seq)
+
+    def flush(self):
+        """Write and fsync every buffered event before returning."""
+        with self._io_lock:
+            with self._lock:
+                lines, self._pending = self._pending, []
+                seq = self.last_seq
+            if lines:
+                self._file.write("\n".join(lines) + "\n")
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self.durable_seq = seq
+        if lines and self.on_flush is not None:
+            self.on_flush(seq)
+
+    def replay(self, after_seq: int = 0) -> Iterator[dict]:
+        """Yield journaled events with a sequence number above ``after_seq``."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # Torn final line from a crash mid-write
+                    continue
+                if event.get("s", 0) > after_seq:
+                    yield event
+
+    def truncate(self, upto_seq: int):
+        """Drop events already covered by a snapshot taken at ``upto_seq``."""
+        self.flush()
+        with self._io_lock:
+            keep = [json.dumps(e, separators=(",", ":")) for e in self.replay(upto_seq)]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                if keep:
+                    f.write("\n".join(keep) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        """Flush outstanding events and stop the writer thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup.notify()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._closed and len(self._pending) < self.flush_events:
+                    self._wakeup.wait(self.flush_interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Error flushing reward journal: %s", e)
@@ -0,0 +1,300 @@
+"""Load test for the API: latency percentiles, throughput and threadpool saturation.
+
+    python loadtest.py --spawn --scenario mix --concurrency 32 --duration 30
+    python loadtest.py --url http://localhost:8000 --scenario reward -c 64 -d 60
+
+With ``--spawn`` it starts ``fake_bedrock.py`` and ``uvicorn main:app`` in
+a scratch directory (fresh bandit state, no AWS needed) and stops them
+afterwards. Each of ``--concurrency`` clients runs the scenario in a loop
+over one keep-alive connection:
+
+    choose  GET /choose
+    reward  GET /choose, then POST /reward with its impression id
+    state   GET /state
+    login   GET /api/recommendation/immediate, then long-poll /wait until processed
+    mix     login 5%, choose 50%, reward 35%, state 10%
+
+While it runs, ``/debug/runtime`` is sampled to report how busy the handler
+threadpool and the Bedrock executor were. The report is printed as JSON.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from typing import Dict, List, Optional
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ["choose", "reward", "state", "login", "mix"]
+MIX = [("login", 0.05), ("choose", 0.50), ("reward", 0.35), ("state", 0.10)]
+
+
+class Recorder:
+    """Latencies (seconds) and error counts per operation, shared by all clients."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def add(self, name: str, seconds: float, ok: bool = True):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        out = {}
+        for name, values in sorted(self.latencies.items()):
+            ms = np.asarray(values) * 1000.0
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            out[name] = {
+                "count": len(values),
+                "errors": self.errors.get(name, 0),
+                "per_sec": round(len(values) / elapsed, 1),
+                "p50_ms": round(float(p50), 2),
+                "p95_ms": round(float(p95), 2),
+                "p99_ms": round(float(p99), 2),
+                "max_ms": round(float(ms.max()), 2),
+            }
+        return out
+
+
+class Client:
+    """One simulated user agent with a persistent HTTP/1.1 connection."""
+
+    def __init__(self, base_url: str, recorder: Recorder, users: List[str], seed: int):
+        parsed = urllib.parse.urlparse(base_url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.recorder = recorder
+        self.users = users
+        self.rng = random.Random(seed)
+        self.conn = None
+
+    def request(self, name: str, method: str, path: str, body: Optional[dict] = None):
+        """Timed request; returns the decoded JSON body, or None on failure."""
+        data = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        started = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            self.conn.request(method, path, body=data, headers=headers)
+            response = self.conn.getresponse()
+            raw = response.read()
+            ok = response.status < 400
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            self.recorder.add(name, time.perf_counter() - started, ok=False)
+            return None
+        self.recorder.add(name, time.perf_counter() - started, ok=ok)
+        return json.loads(raw) if ok and raw else None
+
+    def run(self, scenario: str):
+        if scenario == "mix":
+            r = self.rng.random()
+            for scenario, weight in MIX:
+                if r < weight:
+                    break
+                r -= weight
+        getattr(self, scenario)()
+
+    def choose(self):
+        self.request("choose", "GET", "/choose")
+
+    def reward(self):
+        choice = self.request("choose", "GET", "/choose")
+        if choice is not None:
+            self.request("reward", "POST", "/reward", {
+                "arm_id": choice["arm_id"], "impression_id": choice.get("impression_id"),
+                "reward": int(self.rng.random() < 0.05)})
+
+    def state(self):
+        self.request("state", "GET", "/state")
+
+    def login(self):
+        user = self.rng.choice(self.users)
+        query = urllib.parse.urlencode({"user_id": user})
+        started = time.perf_counter()
+        if self.request("immediate", "GET", f"/api/recommendation/immediate?{query}") is None:
+            return
+        deadline = started + 60
+        while time.perf_counter() < deadline:
+            result = self.request("wait", "GET", f"/api/recommendation/wait?{query}&timeout=10")
+            if result is None:
+                break
+            status = result.get("status", {}).get("status")
+            if status != "processing":
+                self.recorder.add("login_to_processed", time.perf_counter() - started,
+                                  ok=status == "complete")
+                return
+        self.recorder.add("login_to_processed", time.perf_counter() - started, ok=False)
+
+
+def sample_runtime(base_url: str, stop: threading.Event, interval: float, samples: list):
+    while not stop.wait(interval):
+        try:
+            with urllib.request.urlopen(base_url + "/debug/runtime", timeout=5) as r:
+                samples.append(json.load(r))
+        except OSError:
+            pass
+
+
+def summarize_runtime(samples: List[dict]) -> dict:
+    """Peak and mean utilization of each executor, plus event loop lag."""
+    if not samples:
+        return {}
+    out = {"samples": len(samples)}
+    lag = [s["loop_lag_ms"] for s in samples]
+    out["loop_lag_ms"] = {"mean": round(float(np.mean(lag)), 3), "max": round(max(lag), 3)}
+    for key in ("handler_threadpool", "bedrock_executor"):
+        stats = [s[key] for s in samples if s.get(key)]
+        if not stats:
+            continue
+        wait = [s["wait_ms"] for s in stats]
+        queued = [s["queued"] for s in stats]
+        out[key] = {
+            "max_workers": max(s["max_workers"] for s in stats),
+            "max_threads": max(s["threads"] for s in stats),
+            "mean_queued": round(float(np.mean(queued)), 2),
+            "max_queued": max(queued),
+            "wait_ms_mean": round(float(np.mean(wait)), 3),
+            "wait_ms_max": round(max(wait), 3),
+            # Share of samples where work was waiting for a thread
+            "saturated": round(sum(q > 0 for q in queued) / len(stats), 3),
+        }
+    return out
+
+
+def run(base_url: str, scenario: str, concurrency: int, duration: float,
+        users: List[str], seed: int = 0, sample_interval: float = 0.5) -> dict:
+    recorder = Recorder()
+    stop = threading.Event()
+    samples: List[dict] = []
+
+    def worker(i: int):
+        client = Client(base_url, recorder, users, seed + i)
+        while not stop.is_set():
+            client.run(scenario)
+
+    sampler = threading.Thread(target=sample_runtime, args=(base_url, stop, sample_interval, samples),
+                               daemon=True)
+    workers = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    started = time.perf_counter()
+    sampler.start()
+    for t in workers:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in workers:
+        t.join(timeout=70)
+    elapsed = time.perf_counter() - started
+    total = sum(len(v) for v in recorder.latencies.values())
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "duration_seconds": round(elapsed, 2),
+        "requests": total,
+        "requests_per_sec": round(total / elapsed, 1),
+        "operations": recorder.report(elapsed),
+        "runtime": summarize_runtime(samples),
+    }
+
+
+def _wait_for(url: str, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+            time.sleep(0.2)
+
+
+def spawn(workdir: str, port: int, bedrock_port: int, bedrock_args: List[str], env: Dict[str, str]):
+    """Start the fake Bedrock and the API in ``workdir``; returns both processes."""
+    log = open(os.path.join(workdir, "server.log"), "w")
+    fake = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_bedrock.py"),
+                             "--port", str(bedrock_port)] + bedrock_args,
+                            stdout=log, stderr=subprocess.STDOUT)
+    server_env = dict(os.environ, AWS_ACCESS_KEY_ID="fake", AWS_SECRET_ACCESS_KEY="fake",
+                      BEDROCK_ENDPOINT_URL=f"http://127.0.0.1:{bedrock_port}",
+                      CATALOG_PATH=os.path.join(HERE, "catalog.json"), **env)
+    api = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", HERE,
+                            "--port", str(port), "--log-level", "warning"],
+                           cwd=workdir, env=server_env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        _wait_for(f"http://127.0.0.1:{bedrock_port}/_fake/stats")
+        _wait_for(f"http://127.0.0.1:{port}/catalog")
+    except RuntimeError:
+        stop_processes([api, fake])
+        raise
+    return [api, fake]
+
+
+def stop_processes(processes):
+    for p in processes:
+        p.terminate()
+    for p in processes:
+        try:
+            p.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="mix")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-d", "--duration", type=float, default=20.0, help="seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--spawn", action="store_true",
+                        help="start fake_bedrock.py and the API in a scratch directory")
+    parser.add_argument("--bedrock-port", type=int, default=8700)
+    parser.add_argument("--bedrock-arg", action="append", default=[],
+                        help="extra fake_bedrock.py option, e.g. --bedrock-arg=--throttle-rate=0.05")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="(--spawn) disable generation cache and library so every login calls Bedrock")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="(--spawn) extra environment for the API, e.g. BANDIT_MODE=segmented")
+    args = parser.parse_args()
+
+    with open(os.path.join(HERE, "catalog.json"), "r", encoding="utf-8") as f:
+        users = list(json.load(f)["users"])
+
+    processes = []
+    workdir = None
+    base_url = args.url.rstrip("/")
+    if args.spawn:
+        workdir = tempfile.mkdtemp(prefix="loadtest-")
+        env = dict(item.split("=", 1) for item in args.env)
+        if args.no_cache:
+            env.update(GEN_CACHE_TTL="0", GEN_CACHE_STALE_TTL="0", MESSAGE_LIBRARY_DIR="")
+        port = urllib.parse.urlparse(base_url).port or 8000
+        processes = spawn(workdir, port, args.bedrock_port, args.bedrock_arg, env)
+    try:
+        report = run(base_url, args.scenario, args.concurrency, args.duration, users, args.seed)
+        if args.spawn:
+            with urllib.request.urlopen(f"http://127.0.0.1:{args.bedrock_port}/_fake/stats") as r:
+                report["bedrock"] = json.load(r)
+            report["workdir"] = workdir
+    finally:
+        stop_processes(processes)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
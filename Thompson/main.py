@@ -1,14 +1,45 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from startup import StartupReport
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import ORJSONResponse
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, conint
+from typing import List, Optional
 from bandit import ThompsonBandit
-from bedrock_access import generate_meassages, get_embeddings_batch
+from catalog import Catalog, CatalogError, CatalogLoader
+from contextual import ContextEncoder, LinearThompsonBandit
+from segments import SegmentedBandit
+from reward_queue import QueueFull, RewardAggregator
+from gen_cache import GenerationCache, prompt_key
+from history import HistoryStore, parse_duration, parse_time
+from impressions import ImpressionError, ImpressionLog
+from bedrock_access import (executor_stats, generate_messages_async, get_embeddings_batch_async,
+                            get_embedding_store, get_executor, governor_stats, stream_messages_async,
+                            warm_up)
+from notify import ReadinessBroker
+from message_library import MessageLibrary
+from pipeline import RecommendationJobs
+from pregen import PregenScheduler
+from result_store import open_result_store
 from ranker import rank_by_cosine
 import asyncio
+import glob
+import json
+import logging
+import metrics
+import numpy as np
+import os
 import threading
 import time
 
+# Phase timings since process start; see /debug/startup
+startup_report = StartupReport()
+startup_report.mark("imports")
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+# uvicorn has its own handlers; don't print its records twice
+logging.getLogger("uvicorn").propagate = False
+logger = logging.getLogger("recommender")
 
 app = FastAPI(title="Thompson-Bandit",default_response_class=ORJSONResponse,  version="0.1.0")
 
@@ -21,393 +52,799 @@ app.add_middleware(
     allow_credentials=False,    # keep False if using "*"
 )
 
-# Global cache for processed messages and processing status
-message_cache = {}
-processing_status = {}  # user_id -> {"status": "processing"/"complete", "timestamp": time}
+# Processed messages and processing status per user, bounded by a TTL and a
+# byte budget (LRU eviction). The default SQLite store is shared by every
+# worker on the host, so any worker can answer for a user; see result_store.py
+RESULT_STORE_PATH = os.environ.get("RESULT_STORE_PATH", "result_store.sqlite3")
+result_store = open_result_store(
+    os.environ.get("RESULT_STORE", "sqlite"), RESULT_STORE_PATH,
+    ttl=float(os.environ.get("RESULT_STORE_TTL", "3600")),
+    max_bytes=int(float(os.environ.get("RESULT_STORE_MAX_MB", "64")) * (1 << 20)))
+message_cache = result_store.namespace("messages")
+processing_status = result_store.namespace("status")  # user_id -> {"status": "processing"/"complete", "timestamp": time}
+# How often waiters re-read the shared store for changes made by other workers
+RESULT_POLL_INTERVAL = float(os.environ.get("RESULT_POLL_INTERVAL", "0.5"))
+# Wakes long-poll and SSE waiters when a user's status changes
+readiness = ReadinessBroker()
+# Partial ranked sets of a streamed generation, by generation key, for the
+# /stream subscribers following that (single, coalesced) computation
+partial_sets = ReadinessBroker()
+# Upper bound for /api/recommendation/wait and the SSE keep-alive interval
+LONG_POLL_MAX_TIMEOUT = float(os.environ.get("LONG_POLL_MAX_TIMEOUT", "30"))
 
 
 # --- config -------------------------------------------------------------
-ARM_NAMES = [
-    # Purchase Mortgage (10 arms)
-    "purchase_1", "purchase_2", "purchase_3", "purchase_4", "purchase_5",
-    "purchase_6", "purchase_7", "purchase_8", "purchase_9", "purchase_10",
-    # Refinance (10 arms)
-    "refinance_1", "refinance_2", "refinance_3", "refinance_4", "refinance_5",
-    "refinance_6", "refinance_7", "refinance_8", "refinance_9", "refinance_10",
-    # Home Equity (10 arms)
-    "home_equity_1", "home_equity_2", "home_equity_3", "home_equity_4", "home_equity_5",
-    "home_equity_6", "home_equity_7", "home_equity_8", "home_equity_9", "home_equity_10",
-    # Early Explorer (10 arms)
-    "early_explorer_1", "early_explorer_2", "early_explorer_3", "early_explorer_4", "early_explorer_5",
-    "early_explorer_6", "early_explorer_7", "early_explorer_8", "early_explorer_9", "early_explorer_10"
-]
-ARM_DESCRIPTIONS = {
-    # Purchase Mortgage (10 arms)
-    "purchase_1": {
-        "message": "Make home ownership a reality for you Find your dream home with <link>Chase</link>",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-purchase"
-    },
-    "purchase_2": {
-        "message": "Thinking of buying another home? Let us help you with your <link>Second home or investment properties</link>",
-        "url": "https://www.chase.com/personal/mortgage/investment-property"
-    },
-    "purchase_3": {
-        "message": "Let us help you with your journey of <link>homebuying</link>",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-purchase/first-time-homebuyer"
-    },
-    "purchase_4": {
-        "message": "Explore your mortgage options with <link>Chase Home Lending</link>",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-purchase"
-    },
-    "purchase_5": {
-        "message": "Get pre-approved for your <link>home purchase</link>",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-purchase"
-    },
-    "purchase_6": {
-        "message": "Find the right <link>mortgage rate</link> for your home purchase",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-rates"
-    },
-    "purchase_7": {
-        "message": "Calculate your mortgage payments with our <link>calculator</link>",
-        "url": "https://www.chase.com/personal/mortgage/calculators-resources"
-    },
-    "purchase_8": {
-        "message": "Learn about <link>down payment assistance</link> programs",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-purchase/first-time-homebuyer"
-    },
-    "purchase_9": {
-        "message": "Discover <link>jumbo mortgage</link> options for luxury homes",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-purchase"
-    },
-    "purchase_10": {
-        "message": "Get started with your <link>home buying journey</link> today",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-purchase"
-    },
-    
-    # Refinance (10 arms)
-    "refinance_1": {
-        "message": "Take advantage of current interest rate, explore <link>refinancing options</link> for your home",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-refinance"
-    },
-    "refinance_2": {
-        "message": "Considering refinancing your mortgage? Want to know <link>mortgage rates?</link>",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-rates"
-    },
-    "refinance_3": {
-        "message": "Check out these resources to enable your journey. Featured <link>calculators and resources</link>",
-        "url": "https://www.chase.com/personal/mortgage/calculators-resources"
-    },
-    "refinance_4": {
-        "message": "Lower your monthly payments with <link>refinancing</link>",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-refinance"
-    },
-    "refinance_5": {
-        "message": "Cash-out refinancing for <link>home improvements</link>",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-refinance"
-    },
-    "refinance_6": {
-        "message": "Switch to a <link>fixed-rate mortgage</link> for stability",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-refinance"
-    },
-    "refinance_7": {
-        "message": "Reduce your loan term with <link>refinancing</link>",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-refinance"
-    },
-    "refinance_8": {
-        "message": "Get a free <link>refinance consultation</link>",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-refinance"
-    },
-    "refinance_9": {
-        "message": "Compare current <link>refinance rates</link>",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-rates"
-    },
-    "refinance_10": {
-        "message": "Start your <link>refinance application</link> online",
-        "url": "https://www.chase.com/personal/mortgage/mortgage-refinance"
-    },
-    
-    # Home Equity (10 arms)
-    "home_equity_1": {
-        "message": "Curious about how to let your home equity work for you? Learn about <link>home equity</link> solutions",
-        "url": "https://www.chase.com/personal/home-equity/customer-service"
-    },
-    "home_equity_2": {
-        "message": "Know your equity, are you ready to pay it off? <link>Pay off your HELOC account</link>",
-        "url": "https://www.chase.com/personal/home-equity/customer-service/info/pay-off-account"
-    },
-    "home_equity_3": {
-        "message": "Understanding your options in Home Equity Line of Credit (HELOC) <link>End-of-draw options</link>",
-        "url": "https://www.chase.com/personal/home-equity/customer-service/info/end-of-draw-options"
-    },
-    "home_equity_4": {
-        "message": "Access your home's equity with a <link>HELOC</link>",
-        "url": "https://www.chase.com/personal/home-equity"
-    },
-    "home_equity_5": {
-        "message": "Fund home improvements with <link>home equity loans</link>",
-        "url": "https://www.chase.com/personal/home-equity"
-    },
-    "home_equity_6": {
-        "message": "Compare <link>home equity rates</link> and terms",
-        "url": "https://www.chase.com/personal/home-equity"
-    },
-    "home_equity_7": {
-        "message": "Use your equity for <link>debt consolidation</link>",
-        "url": "https://www.chase.com/personal/home-equity"
-    },
-    "home_equity_8": {
-        "message": "Calculate your available <link>home equity</link>",
-        "url": "https://www.chase.com/personal/home-equity"
-    },
-    "home_equity_9": {
-        "message": "Apply online for a <link>home equity line of credit</link>",
-        "url": "https://www.chase.com/personal/home-equity"
-    },
-    "home_equity_10": {
-        "message": "Learn about <link>home equity loan</link> vs HELOC options",
-        "url": "https://www.chase.com/personal/home-equity"
-    },
-    
-    # Early Explorer (10 arms)
-    "early_explorer_1": {
-        "message": "Imagine your own space - explore home <link>homeownership</link>",
-        "url": "https://www.chase.com/personal/mortgage/education"
-    },
-    "early_explorer_2": {
-        "message": "Build equity and stability through <link>owning your home</link>",
-        "url": "https://www.chase.com/personal/mortgage/education"
-    },
-    "early_explorer_3": {
-        "message": "Discover the financial benefits of <link>homeownership</link>",
-        "url": "https://www.chase.com/personal/mortgage/education"
-    },
-    "early_explorer_4": {
-        "message": "Start building wealth through <link>home ownership</link>",
-        "url": "https://www.chase.com/personal/mortgage/education"
-    },
-    "early_explorer_5": {
-        "message": "Create a foundation for your future with <link>your own home</link>",
-        "url": "https://www.chase.com/personal/mortgage/education"
-    },
-    "early_explorer_6": {
-        "message": "Explore the pride and security of <link>owning your home</link>",
-        "url": "https://www.chase.com/personal/mortgage/education"
-    },
-    "early_explorer_7": {
-        "message": "Take the first step towards <link>homeownership</link> today",
-        "url": "https://www.chase.com/personal/mortgage/education"
-    },
-    "early_explorer_8": {
-        "message": "Invest in your future with the stability of <link>home ownership</link>",
-        "url": "https://www.chase.com/personal/mortgage/education"
-    },
-    "early_explorer_9": {
-        "message": "Experience the freedom and control of <link>owning your home</link>",
-        "url": "https://www.chase.com/personal/mortgage/education"
-    },
-    "early_explorer_10": {
-        "message": "Make memories in a place you can truly call <link>your own</link>",
-        "url": "https://www.chase.com/personal/mortgage/education"
-    }
-}
+# Arms, their default messages, clusters and user routing live in
+# catalog.json; edits are picked up without a restart (see catalog.py)
+CATALOG_PATH = os.environ.get("CATALOG_PATH",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
 
-# Default messages (original ARM_DESCRIPTIONS that will be shown immediately)
-DEFAULT_ARM_DESCRIPTIONS = ARM_DESCRIPTIONS.copy()
+# Generated message sets are cached per normalized prompt; see gen_cache.py
+GENERATION_MODEL_ID = "amazon.nova-micro-v1:0"
+generation_cache = GenerationCache(
+    ttl=float(os.environ.get("GEN_CACHE_TTL", "900")),
+    stale_ttl=float(os.environ.get("GEN_CACHE_STALE_TTL", "86400")),
+    max_entries=int(os.environ.get("GEN_CACHE_MAX_ENTRIES", "256")),
+    disk_dir=os.environ.get("GEN_CACHE_DIR") or None,
+)
 
-bandit = ThompsonBandit(ARM_NAMES)
+# Every generated message is kept in an embedded library (see
+# message_library.py); set MESSAGE_LIBRARY_DIR to an empty string to disable
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v1"
+MESSAGE_SET_SIZE = 10
+MESSAGE_LIBRARY_DIR = os.environ.get("MESSAGE_LIBRARY_DIR", "message_library")
+MESSAGE_LIBRARY_MIN_SIMILARITY = float(os.environ.get("MESSAGE_LIBRARY_MIN_SIMILARITY", "0.55"))
+_message_library = None
+_message_library_lock = threading.Lock()
 
-def process_bedrock_messages_background(user_id: str):
-    """Background function to process Bedrock messages for a user."""
-    global message_cache, processing_status
-    
+def get_message_library():
+    """The shared MessageLibrary, loaded on first use; None when disabled."""
+    global _message_library
+    if not MESSAGE_LIBRARY_DIR:
+        return None
+    with _message_library_lock:
+        if _message_library is None:
+            _message_library = MessageLibrary(
+                MESSAGE_LIBRARY_DIR, dimensions=1536,
+                nprobe=int(os.environ.get("MESSAGE_LIBRARY_NPROBE", "8")),
+                max_messages=int(os.environ.get("MESSAGE_LIBRARY_MAX_MESSAGES", "50000")))
+    return _message_library
+
+async def get_message_library_async():
+    """``get_message_library`` without loading the library file on the event loop."""
+    if _message_library is not None or not MESSAGE_LIBRARY_DIR:
+        return _message_library
+    return await asyncio.get_running_loop().run_in_executor(None, get_message_library)
+
+# Background generation jobs; bounded so login bursts can't starve other work
+recommendation_jobs = RecommendationJobs(
+    max_concurrency=int(os.environ.get("RECOMMENDATION_MAX_CONCURRENCY", "4")))
+
+def validate_catalog(new_catalog: Catalog):
+    """The bandit's arm set is fixed at startup; a reload may not add or remove arms.
+
+    A removed arm could still be chosen by the bandit and would then have
+    no message or URL to serve.
+    """
+    unknown = [arm_id for arm_id in new_catalog.arm_ids if arm_id not in bandit.arms]
+    if unknown:
+        raise CatalogError(f"arms {unknown} need a restart to be added")
+    missing = [arm_id for arm_id in bandit.arm_ids if arm_id not in new_catalog.descriptions]
+    if missing:
+        raise CatalogError(f"arms {missing} need a restart to be removed")
+
+catalog_loader = CatalogLoader(
+    CATALOG_PATH, check_interval=float(os.environ.get("CATALOG_RELOAD_INTERVAL", "5")))
+startup_report.mark("catalog")
+
+# Set BANDIT_SHARED_STATE=1 when running several uvicorn workers so they all
+# update one memory-mapped set of posterior counts
+# BANDIT_ADAPTATION=discounted (BANDIT_HALF_LIFE_HOURS) or window
+# (BANDIT_WINDOW_HOURS, BANDIT_WINDOW_BUCKETS) lets old evidence fade so the
+# posteriors keep reacting when message performance changes
+bandit = ThompsonBandit(list(catalog_loader.current.arm_ids),
+                        shared=os.environ.get("BANDIT_SHARED_STATE") == "1",
+                        adaptation=os.environ.get("BANDIT_ADAPTATION") or None,
+                        half_life=float(os.environ.get("BANDIT_HALF_LIFE_HOURS", "168")) * 3600,
+                        window=float(os.environ.get("BANDIT_WINDOW_HOURS", "168")) * 3600,
+                        window_buckets=int(os.environ.get("BANDIT_WINDOW_BUCKETS", "168")))
+catalog_loader.validate = validate_catalog
+
+# BANDIT_MODE=segmented keeps separate posteriors per user cluster (see
+# segments.py) and samples only that cluster's arms.
+# BANDIT_MODE=contextual adds a linear Thompson sampling model over user
+# context (cluster one-hot + bias, plus CONTEXT_EMBED_DIMS projected
+# dimensions of the cached user-message embedding). /choose and /reward use
+# it when given a user_id; the global Beta posteriors are always updated too.
+BANDIT_MODE = os.environ.get("BANDIT_MODE", "global")
+context_encoder = None
+contextual_bandit = None
+segmented_bandit = None
+if BANDIT_MODE == "segmented":
+    segmented_bandit = SegmentedBandit(bandit.arm_ids, segments=list(catalog_loader.current.cluster_arms))
+elif BANDIT_MODE == "contextual":
+    context_encoder = ContextEncoder(list(catalog_loader.current.cluster_arms),
+                                     embed_dims=int(os.environ.get("CONTEXT_EMBED_DIMS", "0")))
+    contextual_bandit = LinearThompsonBandit(bandit.arm_ids, context_encoder.dim,
+                                             v=float(os.environ.get("LINTS_V", "0.5")))
+startup_report.mark("bandit state")
+
+def apply_user_rewards(user_ids: List[str], arm_ids: List[str], rewards: List[int]):
+    """Update the per-user models (segments, contextual) for rewards that name a user."""
+    if segmented_bandit is not None:
+        segmented_bandit.apply_deltas([user_segment(u)[0] for u in user_ids], arm_ids, rewards)
+    if contextual_bandit is not None:
+        for user_id, arm_id, reward in zip(user_ids, arm_ids, rewards):
+            contextual_bandit.reward(arm_id, user_context(user_id), reward)
+
+reward_aggregator = RewardAggregator(
+    bandit,
+    flush_window=float(os.environ.get("REWARD_FLUSH_WINDOW", "0.5")),
+    max_pending=int(os.environ.get("REWARD_MAX_PENDING", "100000")),
+    on_user_rewards=apply_user_rewards if BANDIT_MODE != "global" else None,
+)
+
+def record_expired_impressions(slots: np.ndarray, issued_at: np.ndarray, user_ids):
+    """Impressions nobody rewarded within IMPRESSION_TTL count as 0 rewards.
+
+    They go through the batch reward path, so they are applied off the
+    event loop and reach the segmented and contextual models too.
+    """
+    reward_aggregator.submit(slots.astype(np.int64), np.zeros(len(slots), dtype=np.int64),
+                             issued_at, user_ids, force=True)
+
+# Every final recommendation set and /choose result gets impression ids;
+# /reward joins on them (see impressions.py). With the shared result store
+# the log is a memory-mapped file too, so any worker can join a reward; set
+# IMPRESSION_LOG_PATH to an empty string to keep it in-process
+IMPRESSION_LOG_PATH = os.environ.get("IMPRESSION_LOG_PATH",
+                                     "impressions.ring" if result_store.shared else "")
+impression_log = ImpressionLog(
+    len(bandit.arm_ids), on_expire=record_expired_impressions,
+    capacity=int(os.environ.get("IMPRESSION_CAPACITY", str(1 << 18))),
+    ttl=float(os.environ.get("IMPRESSION_TTL", "1800")),
+    path=IMPRESSION_LOG_PATH or None,
+)
+
+# The Bedrock client (boto3) and the message library load on first use.
+# STARTUP_WARMUP=background (default) loads them right after the server
+# starts accepting traffic, "eager" before it does, "off" not at all.
+STARTUP_WARMUP = os.environ.get("STARTUP_WARMUP", "background")
+
+def warm_generation_stack():
+    with startup_report.phase("warm-up"):
+        warm_up()
+        get_message_library()
+    logger.info("Generation stack warmed up in %.0fms", startup_report.phases[-1][1] * 1000)
+
+async def warm_up_later(delay: float = 1.0):
+    # Give uvicorn a moment to bind the socket first
+    await asyncio.sleep(delay)
     try:
-        print(f"Starting background processing for {user_id}", flush=True)
-        processing_status[user_id] = {"status": "processing", "timestamp": time.time()}
-        
-        user_profile_map = {
-            "user1": {
-                "cluster_type": "Purchase Mortgage",
-                "reasoning": "Recommended based onL high purchase page engagement(1.00), strong buying power (%511,045)" 
-            },
-            "user2": {
-                "cluster_type": "Refinance",
-                "reasoning": "Recommended based on existing mortgage indicates refinance potential " 
-            },
-            "user3": {
-                "cluster_type": "HELOC",
-                "reasoning": "Recommended based on home equity available for borrowing" 
-            },
-            "user4": {
-                "cluster_type": "Early Explorer",
-                "reasoning": "Recommended based on interest in exploring homeownership opportunities" 
+        await asyncio.get_running_loop().run_in_executor(get_executor(), warm_generation_stack)
+    except Exception as e:
+        logger.error("Warm-up failed (will retry on first use): %s", e)
+
+# Posterior history (see history.py): one row of per-arm alpha/beta/pulls
+# every HISTORY_INTERVAL seconds, queried with /state/history. Existing
+# bandit_state_*.json snapshots are imported at startup. Set HISTORY_DIR to
+# an empty string to disable
+HISTORY_DIR = os.environ.get("HISTORY_DIR", os.path.join(ThompsonBandit.BACKUP_DIR, "history"))
+HISTORY_INTERVAL = float(os.environ.get("HISTORY_INTERVAL", "300"))
+posterior_history = HistoryStore(HISTORY_DIR) if HISTORY_DIR else None
+history_task = None
+
+def record_history_row():
+    # Workers sharing the store (and, with BANDIT_SHARED_STATE, the counts)
+    # record at most about one row per interval between them
+    last = posterior_history.last_timestamp()
+    now = time.time()
+    if last is None or now - last >= HISTORY_INTERVAL / 2:
+        posterior_history.append_bandit(bandit, now)
+
+def glob_snapshots():
+    backup_dir = ThompsonBandit.BACKUP_DIR
+    return sorted(glob.glob(os.path.join(backup_dir, "bandit_state*.json"))
+                  + glob.glob(os.path.join(backup_dir, ThompsonBandit.SNAPSHOT_DIR, "bandit_state_*.json")))
+
+async def record_history():
+    loop = asyncio.get_running_loop()
+    try:
+        imported = await loop.run_in_executor(None, posterior_history.import_snapshots, glob_snapshots())
+        if imported:
+            logger.info("Imported %d bandit snapshots into %s", imported, HISTORY_DIR)
+    except Exception as e:
+        logger.error("Error importing bandit snapshots into history: %s", e)
+    while True:
+        try:
+            await loop.run_in_executor(None, record_history_row)
+        except Exception as e:
+            logger.error("Error recording bandit history: %s", e)
+        await asyncio.sleep(HISTORY_INTERVAL)
+
+startup_report.mark("app setup")
+
+@app.on_event("startup")
+async def start_reward_aggregator():
+    await reward_aggregator.start()
+    await impression_log.start()
+
+@app.on_event("startup")
+async def start_pregen():
+    if PREGEN_POOL_SIZE > 0:
+        pregen.start()
+
+@app.on_event("startup")
+async def start_history_recorder():
+    global history_task
+    if posterior_history is not None:
+        history_task = asyncio.get_running_loop().create_task(record_history())
+
+@app.on_event("startup")
+async def report_startup():
+    """Runs last among the startup hooks: log the phase timings and start the warm-up."""
+    if STARTUP_WARMUP == "eager":
+        warm_generation_stack()
+    startup_report.ready()
+    logger.info(startup_report.summary())
+    if STARTUP_WARMUP == "background":
+        asyncio.get_running_loop().create_task(warm_up_later())
+
+@app.on_event("shutdown")
+async def stop_pregen():
+    await pregen.stop()
+
+@app.on_event("shutdown")
+async def cancel_recommendation_jobs():
+    await recommendation_jobs.cancel_all()
+
+@app.on_event("shutdown")
+async def stop_impression_log():
+    await impression_log.stop()
+    impression_log.close()
+
+@app.on_event("shutdown")
+async def stop_reward_aggregator():
+    """Apply queued batch rewards before the bandit is closed."""
+    await reward_aggregator.stop()
+
+@app.on_event("shutdown")
+def close_result_store():
+    result_store.close()
+
+@app.on_event("shutdown")
+async def stop_history_recorder():
+    """Record a final history row after the last rewards were applied."""
+    if history_task is not None:
+        history_task.cancel()
+        await asyncio.gather(history_task, return_exceptions=True)
+    if posterior_history is not None:
+        posterior_history.append_bandit(bandit, time.time())
+        posterior_history.close()
+
+@app.on_event("shutdown")
+def close_bandit():
+    """Flush journaled rewards and write a final snapshot."""
+    bandit.close()
+    if contextual_bandit is not None:
+        contextual_bandit.close()
+    if segmented_bandit is not None:
+        segmented_bandit.close()
+
+def build_user_request(user_id: str):
+    """Return (user_data, user_message, cluster_type) for a user's profile."""
+    catalog = catalog_loader.get()
+    profile = catalog.profile(user_id)
+
+    user_data = {
+        "user_login": [
+            {
+                "cluster_type": profile["cluster_type"],
+                "reasoning": profile["reasoning"]
             }
-        }
+        ]
+    }
 
-        profile = user_profile_map.get(user_id, {
-            "cluster_type": "Purchase Mortgage",
-            "reasoning": "Recommended based onL high purchase page engagement(1.00), strong buying power (%511,045)" 
-        })
+    cluster_type = catalog.cluster_name(user_data["user_login"][0]["cluster_type"])
+    reasoning = user_data["user_login"][0]["reasoning"]
 
-        user_data = {
-            "user_login": [
-                {
-                    "cluster_type": profile["cluster_type"],
-                    "reasoning": profile["reasoning"]
-                }
-            ]
-        }
-
-        cluster_type = user_data["user_login"][0]["cluster_type"]
-        if cluster_type == "HELOC":
-            cluster_type = "Home Equity Line of Credit" 
-        reasoning = user_data["user_login"][0]["reasoning"]
-
-        user_message = (
-            f"This message is for user that is interested in {cluster_type}. "
-            f"Reasoning: {reasoning}. "
-        )
-        
-        print(f"### USER_MESSAGE for {user_id} in background:", user_message, flush=True)
+    user_message = (
+        f"This message is for user that is interested in {cluster_type}. "
+        f"Reasoning: {reasoning}. "
+    )
+    return user_data, user_message, cluster_type
+
+def user_segment(user_id: str):
+    """(segment, eligible arm ids) for a user: their cluster and its arms."""
+    catalog = catalog_loader.get()
+    cluster = catalog.cluster_name(catalog.profile(user_id)["cluster_type"])
+    return cluster, catalog.cluster_arms.get(cluster)
+
+def user_context(user_id: str) -> np.ndarray:
+    """Context vector for the contextual bandit; embedding lookups never call Bedrock."""
+    catalog = catalog_loader.get()
+    cluster = catalog.cluster_name(catalog.profile(user_id)["cluster_type"])
+    embedding = None
+    if context_encoder.embed_dims:
+        store = get_embedding_store()
+        if store is not None:
+            _, user_message, _ = build_user_request(user_id)
+            embedding = store.get_many(EMBEDDING_MODEL_ID, 1536, [user_message])[0]
+    return context_encoder.encode(cluster, embedding)
+
+async def stream_generated_messages(ref_vec, user_data, user_message):
+    """Generate messages with the streaming API, embedding each one as it arrives.
+
+    After every message the candidates so far are ranked and published to
+    ``partial_sets`` under the prompt's generation key. Returns
+    ``(messages, vectors)`` in generation order.
+    """
+    key = generation_key(user_message)
+    messages, vecs = [], []
+    async for message in stream_messages_async(user_data, user_message):
+        vecs.append((await get_embeddings_batch_async(
+            [message], model_id=EMBEDDING_MODEL_ID, dimensions=1536))[0])
+        messages.append(message)
+        partial_sets.publish(key, {"ranked": rank_by_cosine(ref_vec, vecs, messages)})
+    return messages, vecs
 
+async def generate_ranked_messages(user_data, user_message, cluster_type: str, stream: bool = False):
+    """Rank library messages against the user message, generating new ones if needed.
+
+    Bedrock is only called when the library has fewer than MESSAGE_SET_SIZE
+    messages for the cluster that clear MESSAGE_LIBRARY_MIN_SIMILARITY; the
+    generated messages are added to the library and ranked together with it.
+    With ``stream`` the LLM output is streamed and partial rankings are
+    published as it arrives (see ``stream_generated_messages``).
+    """
+    ref_vec = (await get_embeddings_batch_async(
+        [user_message], model_id=EMBEDDING_MODEL_ID, dimensions=1536))[0]
+    message_library = await get_message_library_async()
+    if message_library is not None:
+        matches = message_library.match(ref_vec, MESSAGE_SET_SIZE, MESSAGE_LIBRARY_MIN_SIMILARITY,
+                                        cluster=cluster_type)
+        if matches is not None:
+            return matches
+
+    if stream:
+        bedrock_messages_list, cand_vecs = await stream_generated_messages(ref_vec, user_data, user_message)
+    else:
         # Call Bedrock API
-        bedrock_messages_list = generate_meassages(user_data, user_message)
-        print(f"Bedrock Messages List for {user_id}:")
-        for i, message in enumerate(bedrock_messages_list, 1):
-            print(f'{i:2d}. {message}', flush=True)
+        bedrock_messages_list = await generate_messages_async(user_data, user_message)
 
         # Get embedding vector list
-        text_list = [user_message] + bedrock_messages_list
-        vecs = get_embeddings_batch(text_list, model_id="amazon.titan-embed-text-v1", dimensions=1536)
-
-        # Rank the messages
-        ref_vec = vecs[0]
-        cand_vecs = vecs[1:]
-        ranked_bedrock_messages_list = rank_by_cosine(ref_vec, cand_vecs, bedrock_messages_list)
-
-        print(f"=== RANKED MESSAGES FOR {user_id} ===")
-        for i, item in enumerate(ranked_bedrock_messages_list, 1):
-            print(f"{i:2d}. Similarity: {item['cosine_similarity']:.4f} | Message: {item['message']}")
-        print("=" * 60)
-
-        cluster_headline_map = {
-            "Purchase Mortgage": ["purchase_1", "purchase_2", "purchase_3", "purchase_4", "purchase_5", 
-                                 "purchase_6", "purchase_7", "purchase_8", "purchase_9", "purchase_10"],
-            "Refinance": ["refinance_1", "refinance_2", "refinance_3", "refinance_4", "refinance_5",
-                          "refinance_6", "refinance_7", "refinance_8", "refinance_9", "refinance_10"],
-            "Home Equity Line of Credit": ["home_equity_1", "home_equity_2", "home_equity_3", "home_equity_4", "home_equity_5",
-                      "home_equity_6", "home_equity_7", "home_equity_8", "home_equity_9", "home_equity_10"],
-            "Early Explorer": ["early_explorer_1", "early_explorer_2", "early_explorer_3", "early_explorer_4", "early_explorer_5",
-                              "early_explorer_6", "early_explorer_7", "early_explorer_8", "early_explorer_9", "early_explorer_10"]
-        }
-
-        # Create processed messages for this user
-        processed_messages = {}
-        if cluster_type in cluster_headline_map and len(ranked_bedrock_messages_list) >= 10:
-            print(f"DEBUG: Assigning background messages to {len(cluster_headline_map[cluster_type])} arms for {user_id}")
-            for i, headline_id in enumerate(cluster_headline_map[cluster_type]):
-                similarity_score = ranked_bedrock_messages_list[i]["cosine_similarity"]
-                message = ranked_bedrock_messages_list[i]["message"]
-                processed_messages[headline_id] = {
-                    "message": message,
-                    "url": DEFAULT_ARM_DESCRIPTIONS[headline_id]["url"]
-                }
-            print(f"DEBUG: Background message assignment completed for {user_id}!")
-        else:
-            print(f"DEBUG: Background condition failed for {user_id} - keeping default messages!")
-            # Use default messages for this user
-            user_interest_map = {
-                "user1": ["purchase_1", "purchase_2", "purchase_3", "purchase_4", "purchase_5", 
-                          "purchase_6", "purchase_7", "purchase_8", "purchase_9", "purchase_10"],
-                "user2": ["refinance_1", "refinance_2", "refinance_3", "refinance_4", "refinance_5",
-                          "refinance_6", "refinance_7", "refinance_8", "refinance_9", "refinance_10"],
-                "user3": ["home_equity_1", "home_equity_2", "home_equity_3", "home_equity_4", "home_equity_5",
-                          "home_equity_6", "home_equity_7", "home_equity_8", "home_equity_9", "home_equity_10"],
-                "user4": ["early_explorer_1", "early_explorer_2", "early_explorer_3", "early_explorer_4", "early_explorer_5",
-                          "early_explorer_6", "early_explorer_7", "early_explorer_8", "early_explorer_9", "early_explorer_10"]
+        cand_vecs = await get_embeddings_batch_async(bedrock_messages_list, model_id=EMBEDDING_MODEL_ID, dimensions=1536)
+    if message_library is None:
+        return rank_by_cosine(ref_vec, cand_vecs, bedrock_messages_list)
+
+    await add_to_message_library(bedrock_messages_list, cand_vecs, cluster_type)
+    return message_library.search(ref_vec, MESSAGE_SET_SIZE, cluster=cluster_type)
+
+async def pregenerate_ranked_messages(user_data, user_message, cluster_type: str):
+    """One new LLM-generated set for a pre-generation pool, ranked on its own.
+
+    Unlike ``generate_ranked_messages`` this always calls Bedrock, so each
+    pooled set is different; the messages still go into the library.
+    """
+    async with recommendation_jobs.slot():
+        ref_vec = (await get_embeddings_batch_async(
+            [user_message], model_id=EMBEDDING_MODEL_ID, dimensions=1536))[0]
+        bedrock_messages_list = await generate_messages_async(user_data, user_message)
+        cand_vecs = await get_embeddings_batch_async(bedrock_messages_list, model_id=EMBEDDING_MODEL_ID,
+                                                     dimensions=1536)
+        if await get_message_library_async() is not None:
+            await add_to_message_library(bedrock_messages_list, cand_vecs, cluster_type)
+    return rank_by_cosine(ref_vec, cand_vecs, bedrock_messages_list)
+
+def pregen_targets():
+    """Every distinct profile prompt in the catalog (the default profile included), by generation key."""
+    catalog = catalog_loader.get()
+    targets = {}
+    for user_id in (*catalog.users, ""):
+        user_data, user_message, cluster_type = build_user_request(user_id)
+        targets[generation_key(user_message)] = (user_data, user_message, cluster_type)
+    return targets
+
+# PREGEN_POOL_SIZE > 0 keeps that many ranked sets per profile ready before
+# anyone logs in, each replaced after about PREGEN_INTERVAL seconds; logins
+# take the next set from the pool. Off by default since it calls Bedrock
+# whether or not anyone logs in. With the shared result store one worker
+# refreshes the pools and every worker serves from them.
+PREGEN_POOL_SIZE = int(os.environ.get("PREGEN_POOL_SIZE", "0"))
+PREGEN_INTERVAL = float(os.environ.get("PREGEN_INTERVAL", "900"))
+pregen = PregenScheduler(
+    # Pools outlive their refresh interval, but not a scheduler that stopped
+    result_store.namespace("pregen", ttl=2 * PREGEN_INTERVAL),
+    pregenerate_ranked_messages, pregen_targets,
+    size=max(PREGEN_POOL_SIZE, 1), interval=PREGEN_INTERVAL,
+    jitter=float(os.environ.get("PREGEN_JITTER", "0.2")),
+    lock_path=RESULT_STORE_PATH + ".pregen.lock" if result_store.shared else None)
+
+async def take_ready_messages(key: str):
+    """A pooled or freshly cached ranked set for a generation key, or None."""
+    if PREGEN_POOL_SIZE > 0:
+        pooled = await pregen.take(key)
+        if pooled is not None:
+            return pooled
+    return generation_cache.get_fresh(key)
+
+async def add_to_message_library(messages, vectors, cluster_type: str):
+    # Saving the library is file I/O; keep it off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, get_message_library().add, messages, vectors, cluster_type)
+
+def build_processed_messages(user_id: str, cluster_type: str, ranked_bedrock_messages_list,
+                             partial: bool = False):
+    """Assign ranked messages to the cluster's arms, or fall back to defaults.
+
+    With ``partial`` (streaming), fewer than ten messages fill the first arms
+    and the remaining arms keep their default messages.
+    """
+    catalog = catalog_loader.get()
+    descriptions = catalog.descriptions
+    cluster_arms = catalog.cluster_arms.get(catalog.cluster_name(cluster_type))
+
+    # Create processed messages for this user
+    processed_messages = {}
+    if cluster_arms is not None and (partial or len(ranked_bedrock_messages_list) >= len(cluster_arms)):
+        logger.debug("Assigning background messages to %d arms for %s", len(cluster_arms), user_id)
+        for i, headline_id in enumerate(cluster_arms):
+            if i >= len(ranked_bedrock_messages_list):
+                processed_messages[headline_id] = dict(descriptions[headline_id])
+                continue
+            similarity_score = ranked_bedrock_messages_list[i]["cosine_similarity"]
+            message = ranked_bedrock_messages_list[i]["message"]
+            processed_messages[headline_id] = {
+                "message": message,
+                "url": descriptions[headline_id]["url"]
             }
-            arm_ids = user_interest_map.get(user_id, [])
-            for arm_id in arm_ids:
-                processed_messages[arm_id] = DEFAULT_ARM_DESCRIPTIONS[arm_id].copy()
+    else:
+        logger.debug("Background condition failed for %s - keeping default messages", user_id)
+        # Use default messages for this user
+        arm_ids = catalog.user_arms.get(user_id, ())
+        for arm_id in arm_ids:
+            processed_messages[arm_id] = dict(descriptions[arm_id])
+    return processed_messages
+
+def generation_key(user_message: str) -> str:
+    """Cache key shared by every user whose profile yields the same prompt."""
+    return prompt_key(GENERATION_MODEL_ID, user_message)
+
+async def set_processing_status(user_id: str, status: dict):
+    """Record the user's status and wake anyone waiting on it."""
+    await processing_status.aset(user_id, status)
+    readiness.publish(user_id, status)
+
+async def store_processed_messages(user_id: str, processed_messages):
+    await message_cache.aset(user_id, processed_messages)
+    await set_processing_status(user_id, {"status": "complete", "timestamp": time.time()})
+
+async def process_bedrock_messages_background(user_id: str, stream: bool = False):
+    """Background job that generates and ranks Bedrock messages for a user.
+
+    Runs as an asyncio task under ``recommendation_jobs``; Bedrock calls go
+    to the Bedrock executor, never to the threadpool serving sync handlers.
+    With ``stream``, a generation this job starts publishes partial sets.
+    """
+    try:
+        logger.info("Starting background processing for %s", user_id)
+        await set_processing_status(user_id, {"status": "processing", "timestamp": time.time()})
+
+        user_data, user_message, cluster_type = build_user_request(user_id)
+        logger.debug("User message for %s: %s", user_id, user_message)
+
+        # Users with the same profile share one ranked message set
+        ranked_bedrock_messages_list = await generation_cache.aget_or_compute(
+            generation_key(user_message),
+            lambda: generate_ranked_messages(user_data, user_message, cluster_type, stream=stream))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Ranked messages for %s:\n%s", user_id, "\n".join(
+                f"{i:2d}. Similarity: {item['cosine_similarity']:.4f} | Message: {item['message']}"
+                for i, item in enumerate(ranked_bedrock_messages_list, 1)))
 
         # Store in cache
-        message_cache[user_id] = processed_messages
-        processing_status[user_id] = {"status": "complete", "timestamp": time.time()}
-        print(f"Background processing complete for {user_id}", flush=True)
+        await store_processed_messages(
+            user_id, build_processed_messages(user_id, cluster_type, ranked_bedrock_messages_list))
+        logger.info("Background processing complete for %s", user_id)
         
+    except asyncio.CancelledError:
+        logger.info("Background processing superseded for %s", user_id)
+        raise
     except Exception as e:
-        print(f"Error in background processing for {user_id}: {e}", flush=True)
-        processing_status[user_id] = {"status": "error", "timestamp": time.time(), "error": str(e)}
+        logger.error("Error in background processing for %s: %s", user_id, e)
+        await set_processing_status(user_id, {"status": "error", "timestamp": time.time(), "error": str(e)})
 # ------------------------------------------------------------------------
 
 class ChoiceOut(BaseModel):
     arm_id: str
+    impression_id: Optional[str] = None
 
 class RewardIn(BaseModel):
-    arm_id: str
-    reward: int   # 0 or 1
+    arm_id: Optional[str] = None        # required unless impression_id is given
+    impression_id: Optional[str] = None
+    reward: conint(ge=0, le=1)
+    user_id: Optional[str] = None  # context/segment for BANDIT_MODE=contextual/segmented
+
+class LibraryMessagesIn(BaseModel):
+    cluster_type: str
+    messages: List[str]
+
+class RewardBatchIn(BaseModel):
+    arm_ids: List[str]
+    rewards: List[int]                        # 0 or 1, aligned with arm_ids
+    timestamps: Optional[List[float]] = None  # epoch seconds, aligned with arm_ids
+    user_ids: Optional[List[Optional[str]]] = None  # per-event users for segmented/contextual modes
 
 @app.get("/choose", response_model=ChoiceOut)
-def choose():
-    """Pick an arm."""
-    return ChoiceOut(arm_id=bandit.choose())
+def choose(user_id: Optional[str] = None):
+    """Pick an arm (for ``user_id``'s context or segment in those modes)."""
+    with metrics.timer(metrics.BANDIT_OP_SECONDS, "choose"):
+        if contextual_bandit is not None and user_id is not None:
+            arm_id = contextual_bandit.choose(user_context(user_id))
+        elif segmented_bandit is not None and user_id is not None:
+            arm_id = segmented_bandit.choose(*user_segment(user_id))
+        else:
+            arm_id = bandit.choose()
+    return ChoiceOut(arm_id=arm_id, impression_id=impression_log.issue(bandit.arms[arm_id], user_id)[0])
 
 @app.post("/reward")
 def reward(payload: RewardIn):
-    """Log a binary reward."""
-    if payload.arm_id not in bandit.arms:
+    """Log a binary reward, preferably for an impression id from /choose or a recommendation."""
+    if payload.arm_id is not None and payload.arm_id not in bandit.arms:
         raise HTTPException(status_code=404, detail="Unknown arm")
-    bandit.reward(payload.arm_id, payload.reward)
-    # Print arm info after reward update
-    arm_state = bandit.state()[payload.arm_id]
-    print(f"\nReward Updated: {payload.arm_id}", flush=True)
-    print(f"Current Parameters - Alpha: {arm_state['alpha']:.2f}, Beta: {arm_state['beta']:.2f}", flush=True)
-    if arm_state['num_pulls'] > 0:
-        print(f"Average Reward: {arm_state['average_reward']:.3f} (Total Pulls: {arm_state['num_pulls']})", flush=True)
+    if payload.impression_id is not None:
+        try:
+            slot = impression_log.join(payload.impression_id,
+                                       bandit.arms[payload.arm_id] if payload.arm_id is not None else None)
+        except ImpressionError:
+            raise HTTPException(status_code=410, detail="Unknown or expired impression")
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if slot is None:
+            return {"status": "duplicate"}
+        payload.arm_id = bandit.arm_ids[slot]
+    elif payload.arm_id is None:
+        raise HTTPException(status_code=422, detail="arm_id or impression_id is required")
+    with metrics.timer(metrics.BANDIT_OP_SECONDS, "reward"):
+        bandit.reward(payload.arm_id, payload.reward)
+        if payload.user_id is not None:
+            apply_user_rewards([payload.user_id], [payload.arm_id], [payload.reward])
+    if logger.isEnabledFor(logging.DEBUG):
+        arm_state = bandit.arm_state(payload.arm_id)
+        logger.debug("Reward updated: %s alpha=%.2f beta=%.2f average=%.3f pulls=%d", payload.arm_id,
+                     arm_state["alpha"], arm_state["beta"], arm_state["average_reward"],
+                     arm_state["num_pulls"])
     return {"status": "ok"}
 
+@app.post("/rewards/batch", status_code=202)
+async def reward_batch(payload: RewardBatchIn):
+    """Queue many binary rewards; they are applied together at the next flush."""
+    n = len(payload.arm_ids)
+    if len(payload.rewards) != n or any(v is not None and len(v) != n
+                                        for v in (payload.timestamps, payload.user_ids)):
+        raise HTTPException(status_code=422,
+                            detail="arm_ids, rewards, timestamps and user_ids must have equal length")
+    unknown = sorted({aid for aid in payload.arm_ids if aid not in bandit.arms})
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Unknown arm(s): {', '.join(unknown)}")
+    rewards = np.asarray(payload.rewards, dtype=np.int64)
+    if n and (rewards.min() < 0 or rewards.max() > 1):
+        raise HTTPException(status_code=422, detail="rewards must be 0 or 1")
+    slots = np.fromiter((bandit.arms[aid] for aid in payload.arm_ids), dtype=np.int64, count=n)
+    timestamps = (np.asarray(payload.timestamps, dtype=np.float64) if payload.timestamps is not None
+                  else np.full(n, time.time()))
+    try:
+        depth = reward_aggregator.submit(slots, rewards, timestamps, payload.user_ids)
+    except QueueFull:
+        raise HTTPException(status_code=429, detail="Reward queue is full",
+                            headers={"Retry-After": str(max(1, round(reward_aggregator.flush_window)))})
+    return {"status": "accepted", "accepted": n, "queue_depth": depth}
+
+@app.get("/impressions/metrics")
+def impression_metrics():
+    return impression_log.metrics()
+
+@app.get("/rewards/metrics")
+def reward_metrics():
+    """Batch reward queue depth, backpressure and flush statistics."""
+    return reward_aggregator.metrics()
+
+@app.get("/api/recommendation/cache")
+def generation_cache_stats():
+    """Debug: generation and embedding cache hit/miss counters."""
+    store = get_embedding_store()
+    return {
+        "generation": generation_cache.stats(),
+        "embeddings": store.stats() if store is not None else None,
+        "jobs": recommendation_jobs.stats(),
+        "readiness": readiness.stats(),
+        "library": _message_library.stats() if _message_library is not None else None,
+        "results": result_store.stats(),
+        "pregen": dict(pregen.stats(), pools=pregen.pool_summary()) if PREGEN_POOL_SIZE > 0 else None,
+    }
+
+@metrics.REGISTRY.collector
+def collect_app_metrics():
+    """Scrape-time metrics read from the bandit arrays and component stats."""
+    arm_ids = bandit.arm_ids
+    yield ("bandit_arm_pulls_total", "counter", "Rewards recorded per arm (lifetime).",
+           [({"arm": a}, n) for a, n in zip(arm_ids, bandit.num_pulls.tolist())])
+    yield ("bandit_arm_rewards_total", "counter", "Successful rewards per arm (lifetime).",
+           [({"arm": a}, n) for a, n in zip(arm_ids, bandit.total_reward.tolist())])
+    store = get_embedding_store()
+    yield metrics.numeric_stats(
+        "recommender_component_stat", "Counters and depths from each component's stats().",
+        "component", {
+            "generation_cache": generation_cache.stats(),
+            "embedding_store": store.stats() if store is not None else None,
+            "message_library": _message_library.stats() if _message_library is not None else None,
+            "recommendation_jobs": recommendation_jobs.stats(),
+            "reward_queue": reward_aggregator.metrics(),
+            "impressions": impression_log.metrics(),
+            "readiness": readiness.stats(),
+            "result_store": result_store.stats(),
+            "pregen": pregen.stats() if PREGEN_POOL_SIZE > 0 else None,
+        })
+    yield metrics.numeric_stats(
+        "bedrock_governor_stat", "Adaptive concurrency limit, rate and counters per Bedrock model.",
+        "model", governor_stats())
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Prometheus text exposition of every metric in ``metrics.REGISTRY``."""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/debug/bedrock")
+def bedrock_limits():
+    """Debug: the Bedrock rate governor's current limits per model (see rate_governor.py)."""
+    return governor_stats()
+
+@app.get("/debug/startup")
+def startup_stats():
+    """Debug: start-up phase timings and which heavy modules are loaded."""
+    return startup_report.report()
+
+@app.get("/debug/runtime")
+async def runtime_stats():
+    """Debug: threadpool and event loop saturation (polled by loadtest.py).
+
+    Sync handlers run on the event loop's default executor, Bedrock calls on
+    their own. ``loop_lag_ms`` is how long a callback waited for its turn
+    on the loop; ``wait_ms`` is how long a no-op waited for a free thread.
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    await asyncio.sleep(0)
+    lag = time.perf_counter() - started
+
+    async def probe(executor):
+        started = time.perf_counter()
+        await loop.run_in_executor(executor, time.perf_counter)
+        stats = executor_stats(executor or getattr(loop, "_default_executor", None))
+        stats["wait_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        return stats
+
+    return {
+        "loop_lag_ms": round(lag * 1000, 3),
+        "tasks": len(asyncio.all_tasks()),
+        "handler_threadpool": await probe(None),
+        "bedrock_executor": await probe(get_executor()),
+        "bedrock_limits": governor_stats(),
+        "jobs": recommendation_jobs.stats(),
+        "reward_queue_depth": reward_aggregator.metrics()["queue_depth"],
+    }
+
+@app.get("/catalog")
+def catalog_summary():
+    return {**catalog_loader.get().summary(), "reloads": catalog_loader.reloads}
+
+@app.post("/catalog/reload")
+def reload_catalog():
+    """Reload catalog.json now instead of waiting for the mtime check."""
+    try:
+        catalog = catalog_loader.reload()
+    except (OSError, ValueError, KeyError) as e:
+        raise HTTPException(status_code=422, detail=f"catalog rejected: {e}")
+    return catalog.summary()
+
+@app.post("/api/recommendation/library")
+async def add_library_messages(payload: LibraryMessagesIn):
+    """Embed curated messages and add them to the message library."""
+    message_library = await get_message_library_async()
+    if message_library is None:
+        raise HTTPException(status_code=404, detail="Message library is disabled")
+    catalog = catalog_loader.get()
+    cluster_type = catalog.cluster_name(payload.cluster_type)
+    if cluster_type not in catalog.cluster_arms:
+        raise HTTPException(status_code=404, detail=f"Unknown cluster: {payload.cluster_type}")
+    messages = list(dict.fromkeys(m.strip() for m in payload.messages if m.strip()))
+    if not messages:
+        raise HTTPException(status_code=422, detail="No messages")
+    vecs = await get_embeddings_batch_async(messages, model_id=EMBEDDING_MODEL_ID, dimensions=1536)
+    added = await add_to_message_library(messages, vecs, cluster_type)
+    return {"cluster_type": cluster_type, "added": added, "library": message_library.stats()}
+
 @app.get("/state")
 def state():
     """Debug: current posterior parameters."""
     return bandit.state()
 
-@app.get("/api/recommendation/immediate")
-def get_immediate_recommendation(user_id: str, background_tasks: BackgroundTasks):
-    """Get immediate default recommendations while starting background processing."""
-    global message_cache, processing_status
-    
-    # Always start fresh background processing (clear any existing cache)
-    if user_id in message_cache:
-        del message_cache[user_id]
-    if user_id in processing_status:
-        del processing_status[user_id]
-    
-    # Always start new background processing
-    background_tasks.add_task(process_bedrock_messages_background, user_id)
-    print(f"Started fresh background processing for {user_id}", flush=True)
-    
-    # Return default messages immediately
-    user_interest_map = {
-        "user1": ["purchase_1", "purchase_2", "purchase_3", "purchase_4", "purchase_5", 
-                  "purchase_6", "purchase_7", "purchase_8", "purchase_9", "purchase_10"],
-        "user2": ["refinance_1", "refinance_2", "refinance_3", "refinance_4", "refinance_5",
-                  "refinance_6", "refinance_7", "refinance_8", "refinance_9", "refinance_10"],
-        "user3": ["home_equity_1", "home_equity_2", "home_equity_3", "home_equity_4", "home_equity_5",
-                  "home_equity_6", "home_equity_7", "home_equity_8", "home_equity_9", "home_equity_10"],
-        "user4": ["early_explorer_1", "early_explorer_2", "early_explorer_3", "early_explorer_4", "early_explorer_5",
-                  "early_explorer_6", "early_explorer_7", "early_explorer_8", "early_explorer_9", "early_explorer_10"]
-    }
-    
-    arm_ids = user_interest_map.get(user_id, [bandit.choose()])
+@app.get("/state/history")
+def state_history(arm: str, from_: Optional[str] = Query(None, alias="from"), to: Optional[str] = None,
+                  resolution: Optional[str] = None):
+    """One arm's posterior history, downsampled to ``resolution`` (seconds or e.g. 15m, 1h, 1d).
+
+    ``from`` and ``to`` are unix seconds or ISO 8601 times; without a
+    resolution at most 1000 points are returned.
+    """
+    if posterior_history is None:
+        raise HTTPException(status_code=404, detail="History is off (HISTORY_DIR is empty)")
+    try:
+        start, end, step = parse_time(from_), parse_time(to), parse_duration(resolution)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if step is not None and step <= 0:
+        raise HTTPException(status_code=422, detail="resolution must be positive")
+    result = posterior_history.query(arm, start, end, step)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Unknown arm")
+    return result
+
+@app.get("/state/segments")
+def segment_state(segment: Optional[str] = None):
+    """Debug: segment names, or one segment's posteriors (BANDIT_MODE=segmented only)."""
+    if segmented_bandit is None:
+        raise HTTPException(status_code=404, detail="Segmented mode is off (BANDIT_MODE=segmented)")
+    if segment is None:
+        return {"segments": list(segmented_bandit.segments)}
+    if segment not in segmented_bandit.segments:
+        raise HTTPException(status_code=404, detail="Unknown segment")
+    return segmented_bandit.state(segment)
+
+@app.get("/state/contextual")
+def contextual_state():
+    """Debug: per-arm contextual model (BANDIT_MODE=contextual only)."""
+    if contextual_bandit is None:
+        raise HTTPException(status_code=404, detail="Contextual mode is off (BANDIT_MODE=contextual)")
+    return contextual_bandit.state()
+
+def default_recommendations(user_id: str):
+    """Default (non-generated) recommendations for the user's cluster arms."""
+    catalog = catalog_loader.get()
+    arm_ids = catalog.user_arms.get(user_id) or (bandit.choose(),)
     recommendations = []
-    
     for arm_id in arm_ids:
-        description = DEFAULT_ARM_DESCRIPTIONS[arm_id]
-        arm_state = bandit.state()[arm_id]
+        description = catalog.descriptions[arm_id]
         recommendations.append({
             "arm_id": arm_id,
             "message": description["message"],
             "url": description["url"]
         })
+    return recommendations
+
+@app.get("/api/recommendation/immediate")
+async def get_immediate_recommendation(user_id: str):
+    """Get immediate default recommendations while starting background processing."""
+    # A pre-generated or fresh cached set for this user's profile can be
+    # served right away; otherwise start background processing (which may
+    # serve a stale set)
+    user_data, user_message, cluster_type = build_user_request(user_id)
+    key = generation_key(user_message)
+    cached = await take_ready_messages(key)
+    if cached is not None:
+        await store_processed_messages(user_id, build_processed_messages(user_id, cluster_type, cached))
+        logger.info("Served pre-generated or cached set for %s", user_id)
+    else:
+        await message_cache.adelete(user_id)
+        # Set here too, since a job already running for this user is joined
+        await set_processing_status(user_id, {"status": "processing", "timestamp": time.time()})
+        recommendation_jobs.submit(user_id, key, lambda: process_bedrock_messages_background(user_id))
+        logger.info("Started fresh background processing for %s", user_id)
+    
+    # Return default messages immediately (placeholders: impressions are
+    # issued for the set that replaces them)
+    recommendations = default_recommendations(user_id)
 
     return {
         "user_id": user_id,
@@ -416,6 +853,109 @@ def get_immediate_recommendation(user_id: str, background_tasks: BackgroundTasks
         "processing_status": {"status": "processing", "timestamp": time.time()}
     }
 
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def track_impressions(user_id: str, recommendations):
+    """Attach an impression id to each recommendation shown to the user."""
+    ids = impression_log.issue([bandit.arms[r["arm_id"]] for r in recommendations], user_id)
+    for rec, impression_id in zip(recommendations, ids):
+        rec["impression_id"] = impression_id
+    return recommendations
+
+async def recommendations_payload(user_id: str, processed_messages, source: str):
+    """Recommendations for a stored (``processed``) or intermediate set.
+
+    Impressions are issued once per stored set, the first time it is sent,
+    and saved with it, so the stream, /wait, /events and /processed all
+    hand out the same ids for it. Intermediate streaming sets are replaced
+    within seconds and get none.
+    """
+    recommendations = [
+        {"arm_id": arm_id, "message": d["message"], "url": d["url"]}
+        for arm_id, d in processed_messages.items()
+    ]
+    if source == "processed":
+        if all("impression_id" in d for d in processed_messages.values()):
+            for rec in recommendations:
+                rec["impression_id"] = processed_messages[rec["arm_id"]]["impression_id"]
+        else:
+            track_impressions(user_id, recommendations)
+            for rec in recommendations:
+                processed_messages[rec["arm_id"]]["impression_id"] = rec["impression_id"]
+            await message_cache.aset(user_id, processed_messages)
+    return {
+        "user_id": user_id,
+        "recommendations": recommendations,
+        "source": source,
+    }
+
+@app.get("/api/recommendation/stream")
+async def stream_recommendation(user_id: str):
+    """Server-Sent Events stream of recommendations for a user.
+
+    Sends the defaults first, then a re-ranked set (event ``recommendations``,
+    source ``streaming``) each time the LLM finishes another message, and a
+    final set with source ``processed``. Replaces immediate + status polling.
+
+    The work is the same background job /immediate starts, so concurrent
+    logins for one profile share a single generation (and a stale cached
+    set is served at once while it refreshes); the stream follows the
+    partial sets that generation publishes. A client that disconnects
+    leaves the job running, so its result is still cached for the user.
+    """
+    user_data, user_message, cluster_type = build_user_request(user_id)
+    key = generation_key(user_message)
+
+    async def events():
+        # A job already running for this profile stores the set itself (with
+        # the ids it is issued); follow it rather than storing a second copy
+        cached = await take_ready_messages(key) if recommendation_jobs.running_key(user_id) != key else None
+        if cached is not None:
+            processed_messages = build_processed_messages(user_id, cluster_type, cached)
+            await store_processed_messages(user_id, processed_messages)
+            yield sse_event("recommendations", await recommendations_payload(user_id, processed_messages, "processed"))
+            return
+
+        yield sse_event("recommendations", {
+            "user_id": user_id, "recommendations": default_recommendations(user_id), "source": "default"})
+        version, _ = partial_sets.current(key)
+        await message_cache.adelete(user_id)
+        await set_processing_status(user_id, {"status": "processing", "timestamp": time.time()})
+        job = recommendation_jobs.submit(
+            user_id, key, lambda: process_bedrock_messages_background(user_id, stream=True))
+        waiter = None
+        try:
+            while not job.done():
+                waiter = asyncio.ensure_future(partial_sets.wait(key, version, LONG_POLL_MAX_TIMEOUT))
+                await asyncio.wait({job, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                if not waiter.done() or job.done():
+                    continue
+                new_version, partial = waiter.result()
+                if new_version == version:
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                version = new_version
+                processed_messages = build_processed_messages(user_id, cluster_type, partial["ranked"], partial=True)
+                yield sse_event("recommendations",
+                                await recommendations_payload(user_id, processed_messages, "streaming"))
+        finally:
+            if waiter is not None and not waiter.done():
+                waiter.cancel()
+
+        status = await processing_status.aget(user_id, {"status": "not_started"})
+        processed_messages = await message_cache.aget(user_id) if status["status"] == "complete" else None
+        if processed_messages is not None:
+            yield sse_event("recommendations", await recommendations_payload(user_id, processed_messages, "processed"))
+        else:
+            error = status.get("error", "recommendation job was cancelled")
+            logger.error("Error streaming recommendations for %s: %s", user_id, error)
+            yield sse_event("error", {"user_id": user_id, "error": error})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/api/recommendation/status")
 def get_processing_status(user_id: str):
     """Check if background processing is complete for a user."""
@@ -424,35 +964,89 @@ def get_processing_status(user_id: str):
         "status": processing_status.get(user_id, {"status": "not_started"})
     }
 
+@app.get("/api/recommendation/wait")
+async def wait_for_recommendation(user_id: str, timeout: float = 25.0):
+    """Long-poll until the user's background processing finishes.
+
+    Returns as soon as the status is no longer "processing" (immediately if
+    it already isn't), with the processed recommendations once complete.
+    On timeout the status is still "processing" and the client asks again.
+    """
+    timeout = min(max(timeout, 0.0), LONG_POLL_MAX_TIMEOUT)
+    version, _ = readiness.current(user_id)
+    status = await processing_status.aget(user_id, {"status": "not_started"})
+    if status["status"] == "processing":
+        _, changed = await wait_for_status(user_id, version, status, timeout)
+        status = changed or status
+    return await readiness_payload(user_id, status)
+
+async def wait_for_status(user_id: str, version: int, status: dict, timeout: float):
+    """Wait for the user's status to change from ``status``; returns ``(version, new status or None)``.
+
+    A change made on this worker wakes the waiter at once. With a shared
+    result store, one made by another worker is noticed by re-reading the
+    store every RESULT_POLL_INTERVAL seconds.
+    """
+    if not result_store.shared:
+        new_version, published = await readiness.wait(user_id, version, timeout)
+        return new_version, published if new_version != version else None
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return version, None
+        new_version, published = await readiness.wait(user_id, version, min(remaining, RESULT_POLL_INTERVAL))
+        if new_version != version:
+            version = new_version
+            if published != status:
+                return version, published
+        stored = await processing_status.aget(user_id)
+        if stored is not None and stored != status:
+            return version, stored
+
+@app.get("/api/recommendation/events")
+async def recommendation_events(user_id: str):
+    """Server-Sent Events: a ``status`` event now and on every status change."""
+
+    async def events():
+        version, _ = readiness.current(user_id)
+        status = await processing_status.aget(user_id, {"status": "not_started"})
+        yield sse_event("status", await readiness_payload(user_id, status))
+        while True:
+            version, changed = await wait_for_status(user_id, version, status, LONG_POLL_MAX_TIMEOUT)
+            if changed is None:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                continue
+            status = changed
+            yield sse_event("status", await readiness_payload(user_id, status))
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def readiness_payload(user_id: str, status: dict):
+    processed_messages = await message_cache.aget(user_id) if status["status"] == "complete" else None
+    if processed_messages is not None:
+        payload = await recommendations_payload(user_id, processed_messages, "processed")
+    else:
+        payload = {"user_id": user_id}
+    payload["status"] = status
+    return payload
+
 @app.get("/api/recommendation/processed")
-def get_processed_recommendation(user_id: str):
+async def get_processed_recommendation(user_id: str):
     """Get processed recommendations if available, otherwise default ones."""
-    global message_cache
-    
-    # Check if processed messages are available
-    if user_id in message_cache:
-        processed_messages = message_cache[user_id]
-        recommendations = []
-        
-        for arm_id, description in processed_messages.items():
-            arm_state = bandit.state()[arm_id]
-            recommendations.append({
-                "arm_id": arm_id,
-                "message": description["message"],
-                "url": description["url"]
-            })
-        
-        return {
-            "user_id": user_id,
-            "recommendations": recommendations,
-            "source": "processed",
-            "processing_status": processing_status.get(user_id, {"status": "unknown"})
-        }
+    # Check if processed messages are available (from any worker)
+    processed_messages = await message_cache.aget(user_id)
+    if processed_messages is not None:
+        payload = await recommendations_payload(user_id, processed_messages, "processed")
+        payload["processing_status"] = await processing_status.aget(user_id, {"status": "unknown"})
+        return payload
     else:
         # Fall back to default recommendations
-        return get_immediate_recommendation(user_id, BackgroundTasks())
+        return await get_immediate_recommendation(user_id)
 
 @app.get("/api/recommendation")
-def get_recommendation(user_id: str):
+async def get_recommendation(user_id: str):
     """Legacy endpoint - now redirects to processed recommendations."""
-    return get_processed_recommendation(user_id)
\ No newline at end of file
+    return await get_processed_recommendation(user_id)
\ No newline at end of file
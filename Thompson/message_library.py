@@ -0,0 +1,457 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ranker import normalize_rows, top_k
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class IVFIndex:
+    """Inverted-file index over unit vectors (inner product == cosine).
+
+    Spherical k-means splits the vectors into ``nlist`` cells; a query scans
+    only the ``nprobe`` cells whose centroids are closest. Below
+    ``min_train`` vectors there are no cells and every search is exact.
+
+    ``add`` and ``train`` replace ``centroids`` and ``lists`` rather than
+    modify them, so a ``cells()`` pair taken earlier stays usable.
+    """
+
+    def __init__(self, min_train: int = 256, kmeans_iters: int = 10, seed: int = 0):
+        self.min_train = min_train
+        self.kmeans_iters = kmeans_iters
+        self.rng = np.random.default_rng(seed)
+        self.centroids: Optional[np.ndarray] = None
+        self.assign = np.zeros(0, dtype=np.int32)
+        self.lists: List[np.ndarray] = []
+        self.trained_size = 0
+
+    def needs_training(self, n: int) -> bool:
+        # Retrain as the library doubles so cells stay balanced
+        return n >= self.min_train and n >= 2 * max(self.trained_size, self.min_train // 2)
+
+    def train(self, vectors: np.ndarray):
+        n = vectors.shape[0]
+        nlist = int(np.clip(np.sqrt(n), 1, 1024))
+        centroids = vectors[self.rng.choice(n, nlist, replace=False)].copy()
+        for _ in range(self.kmeans_iters):
+            assign = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, vectors)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                # Restart empty cells from random points
+                sums[empty] = vectors[self.rng.choice(n, int(empty.sum()))]
+            centroids = normalize_rows(sums)
+        self.centroids = centroids
+        self._assign_all(vectors)
+        self.trained_size = n
+
+    def load(self, centroids: np.ndarray, vectors: np.ndarray, trained_size: int):
+        self.centroids = centroids if centroids.size else None
+        self.trained_size = trained_size
+        if self.centroids is not None:
+            self._assign_all(vectors)
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray):
+        if self.centroids is None:
+            return
+        assign = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+        self.assign = np.concatenate([self.assign, assign])
+        lists = list(self.lists)
+        for cell in np.unique(assign):
+            lists[cell] = np.concatenate([lists[cell], ids[assign == cell]])
+        self.lists = lists
+
+    def cells(self) -> Tuple[Optional[np.ndarray], List[np.ndarray]]:
+        return self.centroids, self.lists
+
+    @staticmethod
+    def candidates(cells, query: np.ndarray, nprobe: int) -> Optional[np.ndarray]:
+        """Ids in the ``nprobe`` nearest of ``cells``, or None to scan every vector."""
+        centroids, lists = cells
+        if centroids is None or nprobe >= len(lists):
+            return None
+        probes = top_k(centroids @ query, nprobe)
+        return np.concatenate([lists[p] for p in probes.tolist()])
+
+    def _assign_all(self, vectors: np.ndarray):
+        assign = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+        self.assign = assign
+        self.lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self.centroids))]
+
+
+class _View(NamedTuple):
+    """What a search reads, captured after every change and never modified."""
+    size: int
+    vectors: np.ndarray
+    cluster_ids: np.ndarray
+    messages: List[str]
+    clusters: Tuple[str, ...]
+    cells: tuple
+
+
+class MessageLibrary:
+    """Persistent library of embedded messages with approximate top-k search.
+
+    Every generated (or curated) message is stored once, keyed by its text,
+    with its unit-normalized embedding and cluster label. Searches go
+    through an ``IVFIndex``; when a probe (narrowed to one cluster) yields
+    fewer than k hits, it is widened until it does or covers every cell.
+
+    On disk the library is a compacted ``<directory>/library.npz`` plus an
+    append-only ``library.log`` of messages added since; an add appends
+    only its own records (under an flock, after reading what other workers
+    appended), so its cost does not grow with the library. Every
+    ``compact_every`` logged messages the log is folded into a new
+    ``library.npz`` and the oldest messages beyond ``max_messages`` are
+    dropped. A worker that sees a new ``library.npz`` reloads from it.
+
+    Searches take no lock: they read a view of the arrays that writers
+    replace after each change. Writers hold the flock, then the thread
+    lock only while changing rows in memory; the log append, compaction's
+    file writes and index retraining (k-means over a snapshot, installed
+    when done) happen outside it.
+    """
+
+    FILE = "library.npz"
+    LOG = "library.log"
+
+    def __init__(self, directory: str, dimensions: int = 1536, nprobe: int = 8,
+                 min_train: int = 256, max_messages: int = 50_000, compact_every: int = 1024):
+        self.directory = directory
+        self.dimensions = dimensions
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.max_messages = max_messages
+        self.compact_every = compact_every
+        self.path = os.path.join(directory, self.FILE)
+        self.log_path = os.path.join(directory, self.LOG)
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._training = False
+        self._reset()
+        # Which library.npz and library.log we have read, and how far into the log
+        self._base_id = None
+        self._log_id = None
+        self._log_offset = 0
+        self._log_records = 0
+        self.searches = 0
+        self.matches = 0
+        self.misses = 0
+        self.widened = 0
+        self.compactions = 0
+        with self._file_lock(), self._lock:
+            self._sync_from_disk()
+            self._publish()
+        self._train_if_needed()
+
+    def _reset(self):
+        # Bumped so an index trained on the old rows is not installed
+        self._generation += 1
+        self._vectors = np.zeros((0, self.dimensions), dtype=np.float32)
+        self._size = 0
+        self.messages: List[str] = []
+        self._cluster_ids = np.zeros(0, dtype=np.int32)
+        self.clusters: List[str] = []
+        self._digests: Dict[str, int] = {}
+        self.index = IVFIndex(min_train=self.min_train)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[:self._size]
+
+    def __len__(self):
+        return self._size
+
+    def add(self, messages: Sequence[str], vectors, cluster: str = "") -> int:
+        """Add messages not already in the library and log them; returns how many were new."""
+        vecs = normalize_rows(vectors)
+        with self._file_lock():
+            with self._lock:
+                self._sync_from_disk()
+                start = self._size
+                added = self._append(messages, vecs, cluster)
+                self._publish()
+            if added:
+                # Rows only change under the flock, which is still held
+                self._write_log(start, start + added)
+                if self._log_records >= self.compact_every:
+                    self._compact()
+        self._train_if_needed()
+        return added
+
+    def search(self, query_vec, k: int = 10, cluster: Optional[str] = None,
+               nprobe: Optional[int] = None) -> List[dict]:
+        """Top-k messages by cosine similarity, optionally within one cluster.
+
+        Same item format as ``ranker.rank_by_cosine``; ``index`` is the
+        message's position in the library.
+        """
+        query = normalize_rows(query_vec)[0]
+        probe = self.nprobe if nprobe is None else nprobe
+        self.searches += 1
+        view = self._view
+        cluster_id = view.clusters.index(cluster) if cluster in view.clusters else None
+        if cluster is not None and cluster_id is None:
+            return []
+        while True:
+            ids = IVFIndex.candidates(view.cells, query, probe)
+            exact = ids is None
+            if exact:
+                ids = np.arange(view.size)
+            if cluster_id is not None:
+                ids = ids[view.cluster_ids[ids] == cluster_id]
+            if exact or ids.size >= k:
+                break
+            # Too few hits in the probed cells (e.g. a small cluster): probe more
+            probe *= 2
+            self.widened += 1
+        if ids.size == 0:
+            return []
+        scores = view.vectors[ids] @ query
+        order = top_k(scores, k)
+        return [
+            {"index": int(i), "message": view.messages[i], "cosine_similarity": s}
+            for i, s in zip(ids[order].tolist(), scores[order].tolist())
+        ]
+
+    def match(self, query_vec, k: int, min_similarity: float,
+              cluster: Optional[str] = None) -> Optional[List[dict]]:
+        """``search`` results if there are ``k`` of them all at least ``min_similarity``."""
+        found = self.search(query_vec, k, cluster=cluster)
+        if len(found) >= k and found[-1]["cosine_similarity"] >= min_similarity:
+            self.matches += 1
+            return found
+        self.misses += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "messages": self._size,
+            "max_messages": self.max_messages,
+            "clusters": len(self.clusters),
+            "cells": len(self.index.lists),
+            "trained_size": self.index.trained_size,
+            "log_records": self._log_records,
+            "compactions": self.compactions,
+            "searches": self.searches,
+            "widened_searches": self.widened,
+            "matches": self.matches,
+            "misses": self.misses,
+        }
+
+    def _publish(self):
+        """Replace the view searches read (call under the thread lock)."""
+        self._view = _View(self._size, self._vectors[:self._size], self._cluster_ids[:self._size],
+                           self.messages, tuple(self.clusters), self.index.cells())
+
+    def _train_if_needed(self):
+        """Retrain the index outside the locks once the library has doubled, then install it."""
+        with self._lock:
+            if self._training or not self.index.needs_training(self._size):
+                return
+            self._training = True
+            generation, n, vectors = self._generation, self._size, self._vectors[:self._size]
+        try:
+            # Rows below n are never modified, so the snapshot stays valid
+            index = IVFIndex(min_train=self.min_train)
+            index.train(vectors)
+            with self._lock:
+                if generation == self._generation:
+                    # Rows appended while training go into the new cells
+                    index.add(np.arange(n, self._size), self._vectors[n:self._size])
+                    self.index = index
+                    self._publish()
+        finally:
+            self._training = False
+
+    def _append(self, messages: Sequence[str], vecs: np.ndarray, cluster,
+                reindex: bool = True) -> int:
+        """Append new messages (to the index's cells too with ``reindex``);
+        ``cluster`` is one label or one per message. Call under the thread lock."""
+        labels = [cluster] * len(messages) if isinstance(cluster, str) else list(cluster)
+        new = [(m, v, c) for m, v, c in zip(messages, vecs, labels) if _digest(m) not in self._digests]
+        if not new:
+            return 0
+        start = self._size
+        end = start + len(new)
+        if end > self._vectors.shape[0]:
+            capacity = max(end, 2 * self._vectors.shape[0], 64)
+            grown = np.zeros((capacity, self.dimensions), dtype=np.float32)
+            grown[:start] = self._vectors[:start]
+            self._vectors = grown
+            cluster_ids = np.zeros(capacity, dtype=np.int32)
+            cluster_ids[:start] = self._cluster_ids[:start]
+            self._cluster_ids = cluster_ids
+        for i, (message, vec, label) in enumerate(new, start):
+            if label not in self.clusters:
+                self.clusters.append(label)
+            self._vectors[i] = vec
+            self._cluster_ids[i] = self.clusters.index(label)
+            self._digests[_digest(message)] = i
+        # Replace rather than mutate so concurrent searches keep their snapshot
+        self.messages = self.messages + [m for m, _, _ in new]
+        self._size = end
+        if reindex:
+            self.index.add(np.arange(start, end), self._vectors[start:end])
+        return len(new)
+
+    @staticmethod
+    def _file_id(path: str):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        # A replaced file has a new inode
+        return st.st_ino, st.st_mtime_ns
+
+    def _sync_from_disk(self):
+        """Catch up with entries other workers saved (call under the flock and thread lock).
+
+        A new ``library.npz`` (another worker compacted) replaces what we
+        hold; then log records past our offset are appended.
+        """
+        base_id = self._file_id(self.path)
+        if base_id != self._base_id:
+            self._reset()
+            if base_id is not None:
+                with np.load(self.path) as data:
+                    clusters = data["clusters"].tolist()
+                    labels = [clusters[c] for c in data["cluster_ids"].tolist()]
+                    self._append(data["messages"].tolist(), data["vectors"], labels, reindex=False)
+                    self.index.load(data["centroids"], self.vectors, int(data["trained_size"]))
+            self._base_id = base_id
+            self._log_id = None
+        log_id = self._file_id(self.log_path)
+        if log_id is None or log_id[0] != (self._log_id or (None,))[0]:
+            self._log_offset = 0
+            self._log_records = 0
+        self._log_id = log_id
+        if log_id is None:
+            return
+        with open(self.log_path, "rb") as f:
+            f.seek(self._log_offset)
+            data = f.read()
+        messages, vecs, labels = [], [], []
+        pos = 0
+        vec_bytes = self.dimensions * 4
+        while pos + 4 <= len(data):
+            meta_len = int.from_bytes(data[pos:pos + 4], "little")
+            end = pos + 4 + meta_len + vec_bytes
+            if end > len(data):
+                # Torn record from a crash mid-append; the next append cuts it off
+                break
+            meta = json.loads(data[pos + 4:pos + 4 + meta_len])
+            messages.append(meta["m"])
+            labels.append(meta["c"])
+            vecs.append(np.frombuffer(data[pos + 4 + meta_len:end], dtype=np.float32))
+            pos = end
+        if messages:
+            self._append(messages, np.stack(vecs), labels)
+        self._log_offset += pos
+        self._log_records += len(messages)
+
+    def _write_log(self, start: int, end: int):
+        """Append library rows ``start:end`` to the log (call under the flock, after a sync)."""
+        records = []
+        for i in range(start, end):
+            meta = json.dumps({"m": self.messages[i], "c": self.clusters[self._cluster_ids[i]]},
+                              separators=(",", ":")).encode("utf-8")
+            records.append(len(meta).to_bytes(4, "little") + meta + self._vectors[i].tobytes())
+        payload = b"".join(records)
+        with open(self.log_path, "ab") as f:
+            # Drop a torn tail so the new records start at a record boundary
+            f.truncate(self._log_offset)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_offset += len(payload)
+        self._log_records += len(records)
+        self._log_id = self._file_id(self.log_path)
+
+    def _compact(self):
+        """Fold the log into a new library.npz, dropping the oldest messages over the cap.
+
+        Call under the flock only; the thread lock is taken just to swap in
+        the trimmed rows.
+        """
+        excess = self._size - self.max_messages
+        if excess > 0:
+            with self._lock:
+                keep = slice(excess, self._size)
+                messages = self.messages[keep]
+                vectors = self._vectors[keep].copy()
+                labels = [self.clusters[c] for c in self._cluster_ids[keep].tolist()]
+                centroids, trained_size = self.index.centroids, self.index.trained_size
+                self._reset()
+                self._append(messages, vectors, labels, reindex=False)
+                if centroids is not None:
+                    # The cells still describe the messages that were kept
+                    self.index.load(centroids, self.vectors, trained_size)
+                self._publish()
+        self._save()
+        # A crash before the log is emptied only means its records are read again (and skipped)
+        tmp_path = f"{self.log_path}.{os.getpid()}.tmp"
+        open(tmp_path, "wb").close()
+        os.replace(tmp_path, self.log_path)
+        self._log_id = self._file_id(self.log_path)
+        self._log_offset = 0
+        self._log_records = 0
+        self.compactions += 1
+
+    def _save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        centroids = self.index.centroids
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                vectors=self.vectors,
+                messages=np.array(self.messages, dtype=str),
+                cluster_ids=self._cluster_ids[:self._size],
+                clusters=np.array(self.clusters, dtype=str),
+                centroids=centroids if centroids is not None
+                else np.zeros((0, self.dimensions), dtype=np.float32),
+                trained_size=np.int64(self.index.trained_size),
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._base_id = self._file_id(self.path)
+
+    def _file_lock(self):
+        return _FileLock(self.path + ".lock")
+
+
+class _FileLock:
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
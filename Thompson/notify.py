@@ -0,0 +1,105 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class _Channel:
+    __slots__ = ("version", "status", "changed", "waiters", "touched")
+
+    def __init__(self):
+        self.version = 0
+        self.status: Optional[dict] = None
+        self.changed = asyncio.Event()
+        self.waiters = 0
+        self.touched = time.monotonic()
+
+
+class ReadinessBroker:
+    """Per-user channels announcing recommendation status changes.
+
+    ``publish`` bumps the user's version and wakes every waiter by setting
+    the channel's current Event, then swaps in a fresh one. Waiters pass the
+    last version they saw, so a change published between two waits is never
+    missed. All calls must happen on the event loop thread.
+
+    Channels are kept in least-recently-used order; one nobody waits on is
+    dropped once it has been idle for ``idle_ttl`` seconds, or sooner when
+    there are more than ``max_channels``, so arbitrary user ids cannot grow
+    the map without bound. Versions come from one broker-wide counter, so a
+    dropped and recreated channel never goes back to a version a waiter has
+    already seen.
+    """
+
+    def __init__(self, idle_ttl: float = 60.0, max_channels: int = 10000):
+        self.idle_ttl = idle_ttl
+        self.max_channels = max_channels
+        self._channels: "OrderedDict[str, _Channel]" = OrderedDict()
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, user_id: str, status: dict):
+        channel = self._channel(user_id)
+        self.published += 1
+        channel.version = self.published
+        channel.status = status
+        changed, channel.changed = channel.changed, asyncio.Event()
+        changed.set()
+
+    def current(self, user_id: str) -> Tuple[int, Optional[dict]]:
+        channel = self._channels.get(user_id)
+        if channel is None:
+            return 0, None
+        return channel.version, channel.status
+
+    async def wait(self, user_id: str, after_version: int,
+                   timeout: float) -> Tuple[int, Optional[dict]]:
+        """Wait until the user's version exceeds ``after_version`` or ``timeout`` passes.
+
+        Returns the current ``(version, status)`` either way; callers compare
+        the version to tell a change from a timeout.
+        """
+        channel = self._channel(user_id)
+        if channel.version > after_version:
+            return channel.version, channel.status
+        channel.waiters += 1
+        try:
+            await asyncio.wait_for(channel.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            channel.waiters -= 1
+            channel.touched = time.monotonic()
+        return channel.version, channel.status
+
+    def stats(self) -> dict:
+        return {
+            "channels": len(self._channels),
+            "waiters": sum(c.waiters for c in self._channels.values()),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+    def _channel(self, user_id: str) -> _Channel:
+        now = time.monotonic()
+        channel = self._channels.get(user_id)
+        if channel is None:
+            self._prune(now)
+            channel = self._channels[user_id] = _Channel()
+        else:
+            self._channels.move_to_end(user_id)
+            channel.touched = now
+        return channel
+
+    def _prune(self, now: float):
+        """Drop idle channels from the least recently used end."""
+        # Channels with waiters are moved to the back, so each is looked at once
+        for _ in range(len(self._channels)):
+            user_id, channel = next(iter(self._channels.items()))
+            if len(self._channels) < self.max_channels and now - channel.touched < self.idle_ttl:
+                return
+            if channel.waiters:
+                self._channels.move_to_end(user_id)
+                continue
+            del self._channels[user_id]
+            self.dropped += 1
@@ -0,0 +1,87 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+
+class RecommendationJobs:
+    """Per-user recommendation refreshes as asyncio tasks.
+
+    At most ``max_concurrency`` jobs run at once (the rest wait on a
+    semaphore), so a burst of logins cannot crowd out other work. Each user
+    has at most one live job: submitting the same ``key`` again joins the
+    running job, while a different key cancels the superseded one first.
+    """
+
+    def __init__(self, max_concurrency: int = 4):
+        self.max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._jobs: Dict[str, Tuple[str, asyncio.Task]] = {}
+        self.waiting = 0
+        self.running = 0
+        self.started = 0
+        self.deduplicated = 0
+        self.cancelled = 0
+
+    def submit(self, user_id: str, key: str,
+               job: Callable[[], Awaitable[None]]) -> asyncio.Task:
+        """Start ``job()`` for ``user_id`` unless the same ``key`` is already running."""
+        current = self._jobs.get(user_id)
+        if current is not None and not current[1].done():
+            if current[0] == key:
+                self.deduplicated += 1
+                return current[1]
+            current[1].cancel()
+            self.cancelled += 1
+        task = asyncio.get_running_loop().create_task(self._run(job))
+        self._jobs[user_id] = (key, task)
+        task.add_done_callback(lambda t, user_id=user_id: self._forget(user_id, t))
+        self.started += 1
+        return task
+
+    def running_key(self, user_id: str) -> Optional[str]:
+        """Key of the user's live job, or None if there is none."""
+        current = self._jobs.get(user_id)
+        return current[0] if current is not None and not current[1].done() else None
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "waiting": self.waiting,
+            "started": self.started,
+            "deduplicated": self.deduplicated,
+            "cancelled": self.cancelled,
+        }
+
+    async def cancel_all(self):
+        tasks = [task for _, task in self._jobs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one concurrency slot for work that isn't a submitted job (e.g. a stream)."""
+        if self._semaphore is None:
+            # Created lazily so it binds to the running event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+
+    async def _run(self, job: Callable[[], Awaitable[None]]):
+        async with self.slot():
+            await job()
+
+    def _forget(self, user_id: str, task: asyncio.Task):
+        current = self._jobs.get(user_id)
+        if current is not None and current[1] is task:
+            del self._jobs[user_id]
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from result_store import Namespace
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# (user_data, user_message, cluster_type), as returned by build_user_request
+Target = Tuple[dict, str, str]
+
+
+class PregenScheduler:
+    """Warm pools of ranked message sets per profile prompt, generated ahead of logins.
+
+    ``targets()`` returns ``{key: (user_data, user_message, cluster_type)}``
+    for every profile in the catalog (keys as in the generation cache), and
+    ``generate(*target)`` makes one new ranked set. Each pool holds up to
+    ``size`` sets; once it is full, its oldest set is replaced every
+    ``interval / size`` seconds, so a set lives about ``interval`` seconds
+    and Bedrock sees one call at a time at a steady rate. Every delay is
+    jittered by +/- ``jitter`` so pools don't come due together.
+
+    A pool is one value in the result store and is replaced with one write,
+    so readers see either the old pool or the new one. ``take`` hands the
+    sets out in turn, so consecutive logins for one profile get different
+    messages. With a shared store, only the worker holding the flock on
+    ``lock_path`` refreshes; the others just read.
+    """
+
+    def __init__(self, pools: Namespace, generate: Callable[..., Awaitable[List[dict]]],
+                 targets: Callable[[], Dict[str, Target]], size: int = 4,
+                 interval: float = 900.0, jitter: float = 0.2, fill_delay: float = 2.0,
+                 lock_path: Optional[str] = None, seed: Optional[int] = None):
+        self.pools = pools
+        self.generate = generate
+        self.targets = targets
+        self.size = size
+        self.interval = interval
+        self.step = interval / size
+        self.jitter = jitter
+        self.fill_delay = fill_delay
+        self.lock_path = lock_path
+        self.rng = random.Random(seed)
+        self._due: Dict[str, float] = {}
+        self._cursor: Dict[str, int] = {}
+        self._lock_fd: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.failures = 0
+        self.served = 0
+        self.misses = 0
+
+    async def take(self, key: str) -> Optional[List[dict]]:
+        """The next ranked set from the key's pool, or None if it is empty."""
+        pool = await self.pools.aget(key)
+        if not pool or not pool["sets"]:
+            self.misses += 1
+            return None
+        i = self._cursor.get(key, self.rng.randrange(len(pool["sets"])))
+        self._cursor[key] = i + 1
+        self.served += 1
+        return pool["sets"][i % len(pool["sets"])]
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _jittered(self, delay: float) -> float:
+        return delay * (1.0 + self.rng.uniform(-self.jitter, self.jitter))
+
+    def _lead(self) -> bool:
+        """True if this process should refresh (it holds, or just took, the scheduler lock)."""
+        if self._lock_fd is not None or self.lock_path is None or fcntl is None:
+            return True
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        logger.info("Pre-generation scheduler running in process %d", os.getpid())
+        return True
+
+    async def _schedule(self, targets: Dict[str, Target], now: float):
+        for key in targets:
+            if key in self._due:
+                continue
+            pool = await self.pools.aget(key)
+            if pool and len(pool["sets"]) >= self.size:
+                # Already warm (e.g. filled by a previous leader)
+                self._due[key] = now + self.rng.uniform(0, self.step)
+            else:
+                # Spread the first fill so a restart doesn't burst
+                self._due[key] = now + self.rng.uniform(0, self.fill_delay * len(targets))
+        for key in [k for k in self._due if k not in targets]:
+            del self._due[key]
+            await self.pools.adelete(key)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._lead():
+                await asyncio.sleep(self._jittered(self.step))
+                continue
+            targets = self.targets()
+            await self._schedule(targets, loop.time())
+            key = min(self._due, key=self._due.get, default=None)
+            delay = self._due[key] - loop.time() if key is not None else self.fill_delay
+            if delay > 0:
+                # Wake at least every few seconds to notice catalog changes
+                await asyncio.sleep(min(delay, 5.0))
+                continue
+            self._due[key] = loop.time() + await self.refresh(key, targets[key])
+
+    async def refresh(self, key: str, target: Target) -> float:
+        """Add one new set to the key's pool; returns the delay until its next refresh."""
+        try:
+            ranked = await self.generate(*target)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            logger.warning("Pre-generation for %s failed: %s", target[2], e)
+            return self._jittered(self.step)
+        pool = await self.pools.aget(key) or {"sets": [], "refreshed": []}
+        sets = (pool["sets"] + [ranked])[-self.size:]
+        refreshed = (pool["refreshed"] + [time.time()])[-self.size:]
+        await self.pools.aset(key, {"cluster_type": target[2], "sets": sets, "refreshed": refreshed})
+        self.refreshes += 1
+        logger.debug("Pre-generated a set for %s (%d in pool)", target[2], len(sets))
+        return self._jittered(self.step if len(sets) >= self.size else self.fill_delay)
+
+    def pool_summary(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        summary = []
+        for key, target in self.targets().items():
+            pool = self.pools.get(key) or {"sets": [], "refreshed": []}
+            summary.append({
+                "key": key,
+                "cluster_type": target[2],
+                "sets": len(pool["sets"]),
+                "oldest_age_seconds": round(now - pool["refreshed"][0], 1) if pool["refreshed"] else None,
+            })
+        return summary
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "interval_seconds": self.interval,
+            "leader": self._lock_fd is not None or self.lock_path is None,
+            "scheduled": len(self._due),
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "served": self.served,
+            "misses": self.misses,
+        }
@@ -1,34 +1,78 @@
-import torch
-import torch.nn.functional as F
+import numpy as np
+from typing import List, Optional, Sequence, Tuple
 
-def rank_by_cosine(ref_vec, cand_vecs, candidate_texts):
+
+def as_matrix(vecs) -> np.ndarray:
+    """Candidate vectors as a 2-D float32 array.
+
+    A float32 ndarray (e.g. a memmap from the embedding store) is used as is;
+    a list of rows is stacked once.
+    """
+    if isinstance(vecs, np.ndarray) and vecs.dtype == np.float32:
+        return vecs if vecs.ndim == 2 else vecs.reshape(1, -1)
+    mat = np.asarray(vecs, dtype=np.float32)
+    return mat if mat.ndim == 2 else mat.reshape(1, -1)
+
+
+def normalize_rows(vecs) -> np.ndarray:
+    """Unit-length float32 rows; zero vectors stay zero (similarity 0)."""
+    mat = as_matrix(vecs)
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    return np.divide(mat, norms, out=np.zeros_like(mat), where=norms > 0)
+
+
+def top_k(scores: np.ndarray, k: Optional[int] = None) -> np.ndarray:
+    """Indices of the ``k`` highest scores, best first (all when k is None)."""
+    n = scores.shape[-1]
+    if k is None or k >= n:
+        return np.argsort(-scores, axis=-1, kind="stable")
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=-1), axis=-1, kind="stable")
+    return np.take_along_axis(part, order, axis=-1)
+
+
+def cosine_scores(ref_vec, cand_vecs, normalized: bool = False) -> np.ndarray:
+    """Cosine similarity of every candidate to ``ref_vec`` (one mat-vec product).
+
+    Pass ``normalized=True`` when the candidates are already unit-length rows
+    from ``normalize_rows`` so they aren't normalized again.
+    """
+    cands = as_matrix(cand_vecs) if normalized else normalize_rows(cand_vecs)
+    ref = normalize_rows(ref_vec)[0]
+    return cands @ ref
+
+
+def rank_many(ref_vecs, cand_vecs, k: Optional[int] = None,
+              normalized: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Rank the candidates for many references at once.
+
+    Returns ``(indices, scores)``, both shaped (n_refs, k), best first.
+    """
+    cands = as_matrix(cand_vecs) if normalized else normalize_rows(cand_vecs)
+    scores = normalize_rows(ref_vecs) @ cands.T
+    idx = top_k(scores, k)
+    return idx, np.take_along_axis(scores, idx, axis=1)
+
+
+def rank_by_cosine(ref_vec, cand_vecs, candidate_texts: Sequence[str],
+                   k: Optional[int] = None) -> List[dict]:
     """
     Rank candidate vectors by their cosine similarity to the reference vector.
-    
+
     Args:
         ref_vec (list or np.array): The reference embedding vector.
-        cand_vecs (list of list or np.array): List of candidate embedding vectors.
-        cand_texts (list of str): List of candidate texts corresponding to cand_vecs.
-        
+        cand_vecs (list of list or np.array): Candidate embedding vectors, or a
+            2-D float32 array (used without copying).
+        candidate_texts (list of str): List of candidate texts corresponding to cand_vecs.
+        k (int, optional): Only return the k most similar candidates.
+
     Returns:
-        ranked_texts (list of str): Candidate texts ranked by similarity to ref_vec.
+        List of {"index", "message", "cosine_similarity"} dicts, most similar first.
     """
-    ref_tensor = torch.tensor(ref_vec).unsqueeze(0)  # Shape: (1, dim)
-    candidate_tensors = torch.tensor(cand_vecs)           # Shape: (N, dim)
-    
-    # Compute cosine similarities
-    similarities = F.cosine_similarity(ref_tensor, candidate_tensors)  # Shape: (N,)
-    
-	# Create result items with similarity scores
-    items = []
-    for i, (sim, text) in enumerate(zip(similarities.tolist(), candidate_texts)):
-        items.append({
-			"index": i,
-			"message": text,
-			"cosine_similarity": sim,
-		})
-	
-	# Sort by similarity in descending order
-    items.sort(key=lambda x: x["cosine_similarity"], reverse=True)
-    # print('##### CONFIRM AS A LIST - Ranked Messages by Cosine Similarity: ', type(items))
-    return items
\ No newline at end of file
+    scores = cosine_scores(ref_vec, cand_vecs)
+    order = top_k(scores, k)
+    sims = scores[order].tolist()
+    return [
+        {"index": i, "message": candidate_texts[i], "cosine_similarity": sim}
+        for i, sim in zip(order.tolist(), sims)
+    ]
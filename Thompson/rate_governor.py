@@ -0,0 +1,219 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import metrics
+
+THROTTLE_CODES = ("ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException")
+TRANSIENT_CODES = ("InternalServerException", "ModelNotReadyException", "ServiceException")
+
+
+class RateLimitTimeout(RuntimeError):
+    """No permit became available within the acquire timeout."""
+
+
+def classify_error(error: Exception) -> Optional[str]:
+    """``"throttle"``, ``"transient"`` (worth retrying) or None for a botocore/boto3 error."""
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        code = (response.get("Error") or {}).get("Code")
+        status = (response.get("ResponseMetadata") or {}).get("HTTPStatusCode")
+        if code in THROTTLE_CODES or status in (429, 503):
+            return "throttle"
+        if code in TRANSIENT_CODES or status in (500, 502, 504):
+            return "transient"
+        return None
+    # Connection failures and read timeouts (botocore's ConnectionError and
+    # HTTPClientError families; matched by name so botocore stays optional)
+    if isinstance(error, ConnectionError) or any(
+            cls.__name__ in ("ConnectionError", "HTTPClientError") for cls in type(error).__mro__):
+        return "transient"
+    return None
+
+
+class ModelLimiter:
+    """Token bucket plus an AIMD concurrency limit for one model id.
+
+    ``limit`` calls may be in flight; each success adds ``1 / limit`` (about
+    one more slot per round of calls) up to ``max_limit``, and a throttle
+    halves it, at most once per ``cooldown`` seconds so a burst of throttles
+    from one overload counts once (and successes in that window don't
+    regrow it). Other errors leave it alone: a failed call says nothing
+    about spare capacity. With a ``max_rate`` the bucket also caps
+    requests per second; its rate follows the same additive-increase,
+    multiplicative-decrease rule between ``min_rate`` and ``max_rate``.
+    """
+
+    def __init__(self, max_limit: int, max_rate: Optional[float] = None, burst: Optional[float] = None,
+                 initial_limit: Optional[int] = None, min_limit: int = 1, decrease: float = 0.5,
+                 cooldown: float = 1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(min(initial_limit or max_limit, max_limit))
+        self.max_rate = max_rate
+        self.min_rate = max_rate / 20.0 if max_rate else None
+        self.rate = max_rate
+        self.burst = burst if burst is not None else max(max_rate or 0.0, 1.0)
+        self.tokens = self.burst
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._refilled = time.monotonic()
+        self._decreased = 0.0
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.successes = 0
+        self.throttles = 0
+        self.errors = 0
+        self.decreases = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+
+    def _refill(self, now: float):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self, timeout: Optional[float] = None):
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    slot_free = self.in_flight < int(self.limit)
+                    if slot_free and (not self.rate or self.tokens >= 1.0):
+                        break
+                    # Wait for a release, or for the next token
+                    wait = None if not slot_free or not self.rate else (1.0 - self.tokens) / self.rate
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise RateLimitTimeout(f"no permit within {timeout:.1f}s "
+                                                   f"(limit {int(self.limit)}, rate {self.rate})")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+                if self.rate:
+                    self.tokens -= 1.0
+                self.in_flight += 1
+            finally:
+                self.waiting -= 1
+            self.wait_seconds += time.monotonic() - started
+
+    def release(self, outcome: str = "ok"):
+        """Return a permit; ``outcome`` is ``"ok"``, ``"throttle"`` or ``"error"``."""
+        with self._cond:
+            self.in_flight -= 1
+            if outcome == "throttle":
+                self.throttles += 1
+                now = time.monotonic()
+                if now - self._decreased >= self.cooldown:
+                    self._decreased = now
+                    self.decreases += 1
+                    self.limit = max(float(self.min_limit), self.limit * self.decrease)
+                    if self.rate:
+                        self.rate = max(self.min_rate, self.rate * self.decrease)
+            elif outcome == "error":
+                self.errors += 1
+            else:
+                self.successes += 1
+                if time.monotonic() - self._decreased < self.cooldown:
+                    # Calls that started before the cut finishing; don't regrow yet
+                    self._cond.notify_all()
+                    return
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+                if self.rate:
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 20.0 / max(self.rate, 1.0))
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "max_limit": self.max_limit,
+            "rate_per_sec": round(self.rate, 3) if self.rate else None,
+            "max_rate_per_sec": self.max_rate,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "successes": self.successes,
+            "throttles": self.throttles,
+            "errors": self.errors,
+            "decreases": self.decreases,
+            "timeouts": self.timeouts,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+
+class RateGovernor:
+    """Process-wide Bedrock admission: one ModelLimiter per model id, plus retries.
+
+    ``call`` waits for a permit, makes the call, feeds the outcome back to
+    the limiter and retries throttled or transient failures with jittered
+    exponential backoff, taking a new permit for every attempt. The SDK's
+    own retries should be off so every attempt goes through here.
+
+    Permits are taken on the thread making the call (a Bedrock executor
+    thread), so a model at its limit holds back only that model's callers.
+    """
+
+    def __init__(self, max_concurrency: int = 8, initial_concurrency: int = 4,
+                 rates: Optional[Dict[str, float]] = None, retries: int = 3,
+                 base_backoff: float = 0.5, acquire_timeout: float = 60.0):
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = initial_concurrency
+        self.rates = dict(rates or {})
+        self.retries = retries
+        self.base_backoff = base_backoff
+        self.acquire_timeout = acquire_timeout
+        self._limiters: Dict[str, ModelLimiter] = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, model_id: str) -> ModelLimiter:
+        with self._lock:
+            limiter = self._limiters.get(model_id)
+            if limiter is None:
+                limiter = self._limiters[model_id] = ModelLimiter(
+                    self.max_concurrency, max_rate=self.rates.get(model_id),
+                    initial_limit=self.initial_concurrency)
+            return limiter
+
+    def call(self, model_id: str, operation: str, fn: Callable, *args,
+             retries: Optional[int] = None, base_backoff: Optional[float] = None, **kwargs):
+        retries = self.retries if retries is None else retries
+        base_backoff = self.base_backoff if base_backoff is None else base_backoff
+        limiter = self.limiter(model_id)
+        attempt = 0
+        while True:
+            limiter.acquire(self.acquire_timeout)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                kind = classify_error(e)
+                limiter.release("throttle" if kind == "throttle" else "error")
+                if kind is None or attempt >= retries:
+                    raise
+                time.sleep(base_backoff * (2 ** attempt) + random.uniform(0, 0.25))
+                attempt += 1
+                metrics.BEDROCK_RETRIES.inc(operation)
+                continue
+            limiter.release()
+            return result
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {model_id: limiter.stats() for model_id, limiter in limiters.items()}
+
+
+def parse_rates(spec: str) -> Dict[str, float]:
+    """``"model-a=5,model-b=20"`` -> ``{"model-a": 5.0, "model-b": 20.0}`` (requests per second)."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model_id, _, rate = item.rpartition("=")
+        if not model_id:
+            raise ValueError(f"expected model_id=requests_per_second, got {item!r}")
+        rates[model_id] = float(rate)
+    return rates
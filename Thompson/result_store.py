@@ -0,0 +1,316 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class ResultStore:
+    """Key/value store for per-user results, with a TTL and a byte budget.
+
+    Keys live in namespaces (e.g. ``"messages"`` and ``"status"``); values
+    are anything JSON-serializable and are counted by their encoded size.
+    When the budget is exceeded the least recently used entries go first.
+
+    ``shared`` tells callers whether other processes see the same entries,
+    in which case a change written by another worker only shows up by
+    reading the store again. ``blocking`` stores do I/O that can wait on
+    other processes, so coroutines use a Namespace's ``aget``/``aset``/
+    ``adelete``, which run such calls on the default executor. An external
+    KV (e.g. Redis with ``SET .. EX`` and an ``allkeys-lru`` policy) fits
+    by implementing ``get``, ``set``, ``delete`` and ``stats``.
+    """
+
+    shared = False
+    blocking = False
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    def delete(self, namespace: str, key: str):
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def namespace(self, name: str, ttl: Optional[float] = None) -> "Namespace":
+        return Namespace(self, name, ttl)
+
+
+class Namespace:
+    """One namespace of a ResultStore with a dict-like ``get`` (and async variants)."""
+
+    def __init__(self, store: ResultStore, name: str, ttl: Optional[float] = None):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self.store.get(self.name, key)
+        return default if value is None else value
+
+    def set(self, key: str, value: Any):
+        self.store.set(self.name, key, value, self.ttl)
+
+    def delete(self, key: str):
+        self.store.delete(self.name, key)
+
+    async def aget(self, key: str, default: Any = None) -> Any:
+        return await self._call(self.get, key, default)
+
+    async def aset(self, key: str, value: Any):
+        await self._call(self.set, key, value)
+
+    async def adelete(self, key: str):
+        await self._call(self.delete, key)
+
+    async def _call(self, fn: Callable, *args):
+        if not self.store.blocking:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+def _encode(value: Any) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+class MemoryResultStore(ResultStore):
+    """In-process store: an LRU-ordered dict of encoded values. Not shared between workers."""
+
+    def __init__(self, ttl: float = 3600.0, max_bytes: int = 64 << 20):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # (namespace, key) -> (expires, encoded value), least recently used first
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        k = (namespace, key)
+        with self._lock:
+            entry = self._entries.get(k)
+            if entry is not None and entry[0] <= time.time():
+                self._remove(k)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(k)
+            self.hits += 1
+        return json.loads(entry[1])
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        k = (namespace, key)
+        data = _encode(value)
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._remove(k)
+            self._entries[k] = (expires, data)
+            self._bytes += len(key) + len(data)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+                self.evicted += 1
+
+    def delete(self, namespace: str, key: str):
+        with self._lock:
+            self._remove((namespace, key))
+
+    def _remove(self, k: Tuple[str, str]):
+        entry = self._entries.pop(k, None)
+        if entry is not None:
+            self._bytes -= len(k[1]) + len(entry[1])
+
+    def stats(self) -> Dict:
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    ns TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (ns, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    entries INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO usage VALUES (0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE usage SET entries = entries + 1, bytes = bytes + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE usage SET entries = entries - 1, bytes = bytes - OLD.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_resize AFTER UPDATE OF size ON entries BEGIN
+    UPDATE usage SET bytes = bytes - OLD.size + NEW.size WHERE id = 0;
+END;
+"""
+
+
+class SQLiteResultStore(ResultStore):
+    """Store in one SQLite file in WAL mode, shared by every worker on the host.
+
+    Readers never block writers under WAL, but a write waits up to
+    ``busy_timeout`` seconds for another worker's write transaction, and
+    one that crosses the budget evicts in batches, so the store is
+    ``blocking``: keep its calls off the event loop.
+
+    Triggers keep the total size in a one-row ``usage`` table, so checking
+    the budget after a write is one lookup; when it is exceeded, expired
+    entries are purged and then the least recently accessed ones deleted
+    in batches. Reads refresh an entry's access time at most once per
+    ``touch_interval`` seconds to keep them from turning into writes.
+
+    Each thread gets its own connection; the page cache is capped, so
+    memory does not grow with the number of users.
+    """
+
+    shared = True
+    blocking = True
+
+    def __init__(self, path: str, ttl: float = 3600.0, max_bytes: int = 64 << 20,
+                 touch_interval: float = 1.0, purge_interval: float = 60.0,
+                 busy_timeout: float = 5.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.purge_interval = purge_interval
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA cache_size=-2048")  # KiB
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute("SELECT value, expires, accessed FROM entries WHERE ns = ? AND key = ?",
+                           (namespace, key)).fetchone()
+        if row is None or row[1] <= now:
+            # Expired rows are left for the next purge
+            self.misses += 1
+            return None
+        if now - row[2] >= self.touch_interval:
+            conn.execute("UPDATE entries SET accessed = ? WHERE ns = ? AND key = ?",
+                         (now, namespace, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        data = _encode(value)
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO entries (ns, key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+                "expires = excluded.expires, accessed = excluded.accessed",
+                (namespace, key, data, len(key) + len(data), expires, now))
+            if now >= self._next_purge or self._usage(conn)[1] > self.max_bytes:
+                self._next_purge = now + self.purge_interval
+                self._evict(conn, now)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _usage(self, conn: sqlite3.Connection) -> Tuple[int, int]:
+        return conn.execute("SELECT entries, bytes FROM usage WHERE id = 0").fetchone()
+
+    def _evict(self, conn: sqlite3.Connection, now: float, batch: int = 64):
+        """Purge expired entries, then drop LRU ones until under budget (inside a write transaction)."""
+        self.expired += conn.execute("DELETE FROM entries WHERE expires <= ?", (now,)).rowcount
+        entries, size = self._usage(conn)
+        while size > self.max_bytes and entries > 1:
+            n = min(batch, entries - 1)
+            self.evicted += conn.execute(
+                "DELETE FROM entries WHERE (ns, key) IN "
+                "(SELECT ns, key FROM entries ORDER BY accessed LIMIT ?)", (n,)).rowcount
+            entries, size = self._usage(conn)
+
+    def delete(self, namespace: str, key: str):
+        self._conn().execute("DELETE FROM entries WHERE ns = ? AND key = ?", (namespace, key))
+
+    def stats(self) -> Dict:
+        entries, size = self._usage(self._conn())
+        return {
+            "backend": "sqlite",
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            # Counted by this process only
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+
+def open_result_store(backend: str, path: str, ttl: float, max_bytes: int) -> ResultStore:
+    """``backend`` is ``"sqlite"`` (shared by the workers on a host) or ``"memory"``."""
+    if backend == "sqlite":
+        return SQLiteResultStore(path, ttl=ttl, max_bytes=max_bytes)
+    if backend == "memory":
+        return MemoryResultStore(ttl=ttl, max_bytes=max_bytes)
+    raise ValueError(f"unknown result store backend {backend!r}")
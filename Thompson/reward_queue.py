@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import time
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+from bandit import ThompsonBandit
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when accepting a batch would exceed the aggregator's capacity."""
+
+
+class RewardAggregator:
+    """In-process asyncio queue that folds reward events into per-arm deltas.
+
+    Batches are queued as ``(slots, rewards, timestamps, user_ids)``. Every
+    ``flush_window`` seconds the flush task drains the queue, merges the
+    events with ``np.bincount`` and applies them to the bandit with
+    ``apply_deltas``, so a burst of N clicks costs one state mutation
+    instead of N. The update runs on an executor thread, since it takes
+    every stripe lock (and, with shared state, their flocks).
+
+    With an adapting bandit, events are applied in ``time_resolution``
+    buckets stamped with their own time, so a late batch is decayed from
+    when the rewards happened rather than from the flush. Events that name
+    a user are also passed to ``on_user_rewards(user_ids, arm_ids, rewards)``
+    for per-user models (segments, contextual).
+
+    Backpressure: at most ``max_pending`` events may wait for a flush;
+    ``submit`` raises ``QueueFull`` beyond that so the endpoint can answer 429.
+    """
+
+    def __init__(self, bandit: ThompsonBandit, flush_window: float = 0.5,
+                 max_pending: int = 100_000, time_resolution: float = 1.0,
+                 on_user_rewards: Optional[Callable[[List[str], List[str], List[int]], None]] = None):
+        self.bandit = bandit
+        self.flush_window = flush_window
+        self.max_pending = max_pending
+        self.time_resolution = time_resolution
+        self.on_user_rewards = on_user_rewards
+        self._queue: "asyncio.Queue[tuple]" = asyncio.Queue()
+        self._pending = 0
+        self._task: Optional[asyncio.Task] = None
+        self._applying: Optional[asyncio.Future] = None
+        self.accepted_events = 0
+        self.rejected_events = 0
+        self.flushes = 0
+        self.last_flush_events = 0
+        self.last_flush_seconds = 0.0
+        self.last_ingest_lag_seconds = 0.0
+
+    def submit(self, slots: np.ndarray, rewards: np.ndarray, timestamps: np.ndarray,
+               user_ids: Optional[Sequence[Optional[str]]] = None, force: bool = False) -> int:
+        """Queue one batch of events; returns the queue depth afterwards.
+
+        ``force`` skips the backpressure check, for events the server itself
+        produces (e.g. expired impressions) that have nowhere to be retried.
+        """
+        n = len(slots)
+        if not force and self._pending + n > self.max_pending:
+            self.rejected_events += n
+            raise QueueFull(f"{self._pending} events already pending")
+        self._queue.put_nowait((slots, rewards, timestamps, user_ids))
+        self._pending += n
+        self.accepted_events += n
+        return self._pending
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush task and apply whatever is still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._applying is not None:
+            # A cancelled flush's update keeps running on its thread; let it finish
+            await asyncio.gather(self._applying, return_exceptions=True)
+        await self.flush()
+
+    async def flush(self) -> int:
+        """Drain the queue and apply it on an executor thread; returns events applied."""
+        batches = []
+        while not self._queue.empty():
+            batches.append(self._queue.get_nowait())
+        if not batches:
+            return 0
+        self._pending -= sum(len(b[0]) for b in batches)
+        self._applying = asyncio.get_running_loop().run_in_executor(None, self.apply, batches)
+        return await asyncio.shield(self._applying)
+
+    def apply(self, batches: List[tuple]) -> int:
+        """Fold queued batches into the bandit (and per-user models); returns events applied."""
+        start = time.perf_counter()
+        slots = np.concatenate([b[0] for b in batches])
+        rewards = np.concatenate([b[1] for b in batches])
+        timestamps = np.concatenate([b[2] for b in batches])
+        n_arms = len(self.bandit.arm_ids)
+        if self.bandit.forgetting is None:
+            groups = [(slice(None), None)]
+        else:
+            order = np.argsort(timestamps, kind="stable")
+            slots, rewards, timestamps = slots[order], rewards[order], timestamps[order]
+            buckets = np.floor(timestamps / self.time_resolution)
+            bounds = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1, [len(slots)]))
+            groups = [(slice(lo, hi), float(timestamps[hi - 1])) for lo, hi in zip(bounds[:-1], bounds[1:])]
+        for group, t in groups:
+            successes = np.bincount(slots[group], weights=rewards[group], minlength=n_arms)
+            failures = np.bincount(slots[group], minlength=n_arms) - successes
+            self.bandit.apply_deltas(successes, failures, t)
+        if self.on_user_rewards is not None:
+            self._apply_user_rewards(batches)
+        self.flushes += 1
+        self.last_flush_events = len(slots)
+        self.last_flush_seconds = time.perf_counter() - start
+        self.last_ingest_lag_seconds = max(time.time() - float(timestamps.min()), 0.0)
+        return len(slots)
+
+    def _apply_user_rewards(self, batches: List[tuple]):
+        user_ids, arm_ids, rewards = [], [], []
+        for slots, batch_rewards, _, batch_users in batches:
+            if batch_users is None:
+                continue
+            for slot, reward, user_id in zip(slots.tolist(), batch_rewards.tolist(), batch_users):
+                if user_id is not None:
+                    user_ids.append(user_id)
+                    arm_ids.append(self.bandit.arm_ids[slot])
+                    rewards.append(int(reward))
+        if user_ids:
+            self.on_user_rewards(user_ids, arm_ids, rewards)
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self._pending,
+            "queued_batches": self._queue.qsize(),
+            "max_pending": self.max_pending,
+            "utilization": self._pending / self.max_pending if self.max_pending else 0.0,
+            "flush_window_seconds": self.flush_window,
+            "accepted_events": self.accepted_events,
+            "rejected_events": self.rejected_events,
+            "flushes": self.flushes,
+            "last_flush_events": self.last_flush_events,
+            "last_flush_seconds": self.last_flush_seconds,
+            "last_ingest_lag_seconds": self.last_ingest_lag_seconds,
+        }
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_window)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Error flushing reward batch: %s", e)
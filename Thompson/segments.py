@@ -0,0 +1,211 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentedBandit:
+    """Independent Beta-Bernoulli posteriors per segment in one float32 table.
+
+    Row ``r`` of ``table`` (shape ``(segments, 2 * arms)``) holds segment r's
+    alpha values in its first half and beta values in the second, so memory
+    is 8 bytes per segment-arm and sampling a segment is one vectorized
+    ``Generator.beta`` over just the eligible arm slots. Unknown segments
+    get a new row (from the prior) on first use; capacity doubles as needed.
+
+    The table is saved to a single ``.npz`` file (table, arm ids, segment
+    names) every ``snapshot_every`` rewards and on close. Several workers
+    share the file: a save takes an flock, adds the rewards this process
+    got since its last save to what is on disk and writes the sum, then
+    adopts it. Each worker samples from its own copy, so it sees the
+    others' rewards from its next save on.
+    """
+    STATE_FILE = "segmented_state.npz"
+    PRIOR = 1.0
+
+    def __init__(self, arm_ids: List[str], segments: Sequence[str] = (),
+                 seed: Optional[int] = None, backup_dir: Optional[str] = "bandit_backup",
+                 snapshot_every: int = 1000):
+        self.arm_ids: List[str] = list(arm_ids)
+        self.arms: Dict[str, int] = {aid: i for i, aid in enumerate(self.arm_ids)}
+        self.rng = np.random.default_rng(seed)
+        self.snapshot_every = snapshot_every
+        self.path = os.path.join(backup_dir, self.STATE_FILE) if backup_dir else None
+        self._lock = threading.Lock()
+        self._rewards_since_snapshot = 0
+        self._slot_cache: Dict[tuple, np.ndarray] = {}
+        self.segments: Dict[str, int] = {}
+        self.table = np.full((max(len(segments), 1), 2 * len(self.arm_ids)), self.PRIOR,
+                             dtype=np.float32)
+        # The table as last read from or merged into the file; table - _saved
+        # is what this process has not saved yet
+        self._saved = self.table.copy()
+        self.load_state()
+        for segment in segments:
+            self.segment_row(segment)
+
+    @property
+    def n_arms(self) -> int:
+        return len(self.arm_ids)
+
+    def segment_row(self, segment: str) -> int:
+        row = self.segments.get(segment)
+        if row is not None:
+            return row
+        with self._lock:
+            row = self.segments.get(segment)
+            if row is None:
+                row = len(self.segments)
+                if row >= self.table.shape[0]:
+                    grown = np.full((2 * self.table.shape[0], self.table.shape[1]), self.PRIOR,
+                                    dtype=np.float32)
+                    grown[:row] = self.table[:row]
+                    self.table = grown
+                    saved = np.full_like(grown, self.PRIOR)
+                    saved[:row] = self._saved[:row]
+                    self._saved = saved
+                self.segments[segment] = row
+        return row
+
+    def slots(self, arm_ids: Sequence[str]) -> np.ndarray:
+        """Slot array for an (immutable) tuple of arm ids, cached."""
+        key = tuple(arm_ids)
+        slots = self._slot_cache.get(key)
+        if slots is None:
+            slots = np.array([self.arms[a] for a in key], dtype=np.intp)
+            self._slot_cache[key] = slots
+        return slots
+
+    def sample(self, segment: str, slots: Optional[np.ndarray] = None) -> np.ndarray:
+        row = self.table[self.segment_row(segment)]
+        alpha, beta = row[:self.n_arms], row[self.n_arms:]
+        if slots is not None:
+            alpha, beta = alpha[slots], beta[slots]
+        return self.rng.beta(alpha, beta)
+
+    def choose(self, segment: str, arm_ids: Optional[Sequence[str]] = None) -> str:
+        """Best sampled arm for ``segment``, among ``arm_ids`` if given."""
+        if arm_ids is None:
+            return self.arm_ids[int(np.argmax(self.sample(segment)))]
+        slots = self.slots(arm_ids)
+        return self.arm_ids[int(slots[np.argmax(self.sample(segment, slots))])]
+
+    def reward(self, segment: str, arm_id: str, reward: int):
+        row = self.segment_row(segment)
+        i = self.arms[arm_id]
+        with self._lock:
+            # alpha counts successes, beta failures
+            self.table[row, i if reward else self.n_arms + i] += 1
+            self._rewards_since_snapshot += 1
+            due = self._rewards_since_snapshot >= self.snapshot_every
+        if due:
+            self.save_state()
+
+    def apply_deltas(self, segments: Sequence[str], arm_ids: Sequence[str], rewards: Sequence[int]):
+        """Apply many rewards at once (one unbuffered scatter-add)."""
+        rows = np.array([self.segment_row(s) for s in segments], dtype=np.intp)
+        slots = self.slots(arm_ids)
+        cols = np.where(np.asarray(rewards) > 0, slots, slots + self.n_arms)
+        with self._lock:
+            np.add.at(self.table, (rows, cols), 1)
+            self._rewards_since_snapshot += len(rows)
+            due = self._rewards_since_snapshot >= self.snapshot_every
+        if due:
+            self.save_state()
+
+    def state(self, segment: str) -> Dict[str, dict]:
+        row = self.table[self.segment_row(segment)].astype(np.float64)
+        alpha, beta = row[:self.n_arms].tolist(), row[self.n_arms:].tolist()
+        return {aid: {
+                "alpha": alpha[i],
+                "beta": beta[i],
+                "num_pulls": int(alpha[i] + beta[i] - 2 * self.PRIOR),
+            } for i, aid in enumerate(self.arm_ids)}
+
+    def save_state(self):
+        """Merge this process's rewards since its last save into the file, then adopt the result."""
+        if self.path is None:
+            return
+        with self._lock:
+            n = len(self.segments)
+            snapshot = self.table[:n].copy()
+            delta = snapshot - self._saved[:n]
+            self._rewards_since_snapshot = 0
+        with self._file_lock():
+            on_disk = self._read()
+            m = len(self.segments)
+            merged = np.full((m, 2 * self.n_arms), self.PRIOR, dtype=np.float32)
+            if on_disk is not None:
+                merged[:on_disk.shape[0]] = on_disk
+            merged[:n] += delta
+            names = sorted(self.segments, key=self.segments.get)[:m]
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, table=merged, arm_ids=np.array(self.arm_ids, dtype=str),
+                         segments=np.array(names, dtype=str))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        with self._lock:
+            # Add what other workers saved; rewards that arrived meanwhile stay unsaved
+            self.table[:n] += merged[:n] - snapshot
+            self.table[n:m] += merged[n:] - self._saved[n:m]
+            self._saved[:m] = merged
+
+    def load_state(self) -> bool:
+        if self.path is None:
+            return False
+        with self._file_lock():
+            on_disk = self._read()
+        if on_disk is None:
+            return False
+        with self._lock:
+            m = on_disk.shape[0]
+            self.table[:m] = on_disk
+            self._saved[:m] = on_disk
+        logger.info("Loaded segmented bandit state from %s (%d segments)", self.path, m)
+        return True
+
+    def _read(self) -> Optional[np.ndarray]:
+        """The saved table laid out like ours (unknown segments get rows), or None if there is none."""
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path) as data:
+            saved = data["table"]
+            saved_arms = data["arm_ids"].tolist()
+            names = data["segments"].tolist()
+        rows = np.array([self.segment_row(name) for name in names], dtype=np.intp)
+        table = np.full((len(self.segments), 2 * self.n_arms), self.PRIOR, dtype=np.float32)
+        # Map saved columns onto current arm slots; arms no longer present are dropped
+        cur = [self.arms.get(a) for a in saved_arms]
+        keep = [j for j, i in enumerate(cur) if i is not None]
+        dst = np.array([cur[j] for j in keep], dtype=np.intp)
+        src = np.array(keep, dtype=np.intp)
+        m = len(saved_arms)
+        table[np.ix_(rows, dst)] = saved[:, src]
+        table[np.ix_(rows, dst + self.n_arms)] = saved[:, src + m]
+        return table
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive flock on ``<path>.lock``, serializing saves across workers."""
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.save_state()
@@ -0,0 +1,203 @@
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Named process-wide locks, alongside the stripe lock files
+INIT_LOCK = "init"
+COMPACT_LOCK = "compact"
+
+MAGIC = b"TSBANDIT"
+PAGE = 4096
+
+
+def _header_size(json_length: int) -> int:
+    raw = len(MAGIC) + 8 + json_length
+    return (raw + PAGE - 1) // PAGE * PAGE
+
+
+class StripedLock:
+    """Fixed pool of locks where arm slot ``i`` maps to stripe ``i % n``.
+
+    Each stripe is a ``threading.Lock``; when ``lock_dir`` is given it is also
+    backed by an ``flock`` on a per-stripe file in that directory so the same
+    stripe is exclusive across processes. The thread lock is always taken
+    first, since flock is held per open file and threads share the descriptor.
+    """
+
+    def __init__(self, n_stripes: int = 16, lock_dir: Optional[str] = None):
+        self.n_stripes = max(1, n_stripes)
+        self._locks = [threading.Lock() for _ in range(self.n_stripes)]
+        self._lock_dir = lock_dir
+        self._fds: List[int] = []
+        self._named: Dict[str, threading.Lock] = {}
+        if lock_dir is not None:
+            if fcntl is None:
+                raise RuntimeError("cross-process locking requires fcntl (POSIX)")
+            os.makedirs(lock_dir, exist_ok=True)
+            self._fds = [self._open(f"stripe-{s}") for s in range(self.n_stripes)]
+
+    def _open(self, name: str) -> int:
+        return os.open(os.path.join(self._lock_dir, name), os.O_RDWR | os.O_CREAT, 0o644)
+
+    @contextmanager
+    def stripe(self, i: int):
+        s = i % self.n_stripes
+        with self._locks[s]:
+            if not self._fds:
+                yield
+                return
+            fcntl.flock(self._fds[s], fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fds[s], fcntl.LOCK_UN)
+
+    @contextmanager
+    def all(self):
+        """Hold every stripe, e.g. to take a consistent snapshot."""
+        for lock in self._locks:
+            lock.acquire()
+        held = []
+        try:
+            for fd in self._fds:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                held.append(fd)
+            yield
+        finally:
+            for fd in reversed(held):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            for lock in reversed(self._locks):
+                lock.release()
+
+    @contextmanager
+    def exclusive(self, name: str):
+        """Process-wide named lock such as INIT_LOCK or COMPACT_LOCK."""
+        lock = self._named.setdefault(name, threading.Lock())
+        with lock:
+            if self._lock_dir is None:
+                yield
+                return
+            fd = self._open(name)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+
+class SharedArmTable:
+    """Per-arm float64 columns in a memory-mapped file shared by every worker.
+
+    The file starts with a page-aligned JSON header recording the arm ids and
+    field names, followed by a ``(fields, arms)`` float64 matrix. Each worker maps
+    the same file, so an update made by one uvicorn worker is immediately
+    visible to the others; callers serialize writes with a ``StripedLock``
+    built on a shared ``lock_dir``.
+
+    ``on_create`` is called, still under the init lock, only in the process
+    that created the file, so it can seed it (e.g. from the last snapshot)
+    before any other worker attaches.
+    """
+
+    def __init__(self, path: str, arm_ids: List[str], fields: List[str], locks: StripedLock,
+                 defaults: Optional[Dict[str, float]] = None,
+                 on_create: Optional[Callable[["SharedArmTable"], None]] = None):
+        self.path = path
+        self.arm_ids = list(arm_ids)
+        self.fields = list(fields)
+        self.defaults = defaults or {}
+        self.created = False
+        with locks.exclusive(INIT_LOCK):
+            header = self._read_header()
+            if header is None:
+                self._create(path)
+                self.created = True
+            elif header["arms"] != self.arm_ids or header["fields"] != self.fields:
+                self._migrate(header)
+            self._data = np.memmap(path, dtype=np.float64, mode="r+",
+                                   offset=self._read_header()["size"],
+                                   shape=(len(self.fields), len(self.arm_ids)))
+            if self.created and on_create is not None:
+                on_create(self)
+        self._flusher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def column(self, field: str) -> np.ndarray:
+        """Writable view of one field across all arms."""
+        return self._data[self.fields.index(field)]
+
+    def flush(self):
+        """msync the mapping so updates survive an OS crash."""
+        self._data.flush()
+
+    def start_flusher(self, interval: float, on_flush: Optional[Callable[[], None]] = None):
+        """Flush every ``interval`` seconds on a daemon thread."""
+        def _run():
+            while not self._stop.wait(interval):
+                try:
+                    self.flush()
+                    if on_flush is not None:
+                        on_flush()
+                except Exception as e:
+                    logger.error("Error flushing shared bandit state: %s", e)
+        self._flusher = threading.Thread(target=_run, name="shared-state-flush", daemon=True)
+        self._flusher.start()
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    def _read_header(self) -> Optional[dict]:
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < PAGE:
+            return None
+        with open(self.path, "rb") as f:
+            prefix = f.read(len(MAGIC) + 8)
+            if not prefix.startswith(MAGIC):
+                return None
+            length = int.from_bytes(prefix[len(MAGIC):], "little")
+            header = json.loads(f.read(length))
+        header["size"] = _header_size(length)
+        return header
+
+    def _create(self, path: str, values: Optional[Dict[str, Dict[str, float]]] = None):
+        header = json.dumps({"arms": self.arm_ids, "fields": self.fields}).encode()
+        data = np.zeros((len(self.fields), len(self.arm_ids)), dtype=np.float64)
+        for k, field in enumerate(self.fields):
+            data[k] = self.defaults.get(field, 0.0)
+        if values:
+            for j, aid in enumerate(self.arm_ids):
+                for k, field in enumerate(self.fields):
+                    if aid in values and field in values[aid]:
+                        data[k, j] = values[aid][field]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            raw = MAGIC + len(header).to_bytes(8, "little") + header
+            f.write(raw.ljust(_header_size(len(header)), b"\0"))
+            f.write(data.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _migrate(self, header: dict):
+        """Rewrite the file for a changed arm/field list, keeping known values."""
+        old = np.memmap(self.path, dtype=np.float64, mode="r", offset=header["size"],
+                        shape=(len(header["fields"]), len(header["arms"])))
+        values = {aid: {f: float(old[k, j]) for k, f in enumerate(header["fields"])}
+                  for j, aid in enumerate(header["arms"])}
+        del old
+        logger.info("Migrating shared bandit state at %s to %d arms", self.path, len(self.arm_ids))
+        self._create(self.path, values)
@@ -0,0 +1,323 @@
+"""Offline simulation, replay and benchmarks for the Thompson sampling bandit.
+
+    python simulate.py sim --steps 5000 --replicas 1000
+    python simulate.py replay bandit_backup/bandit_journal.jsonl
+    python simulate.py bench --compare benchmarks/baseline.json
+
+``sim`` runs many independent bandits side by side against Bernoulli arms
+with known click rates and reports regret and convergence. ``replay`` feeds
+a logged event stream through ``ThompsonBandit`` and estimates its click
+rate. ``bench`` times ``choose``, ``reward`` and ``save_state`` on the real
+engine (in a temporary directory) and, with ``--compare``, fails when
+throughput or regret is worse than the tracked baseline.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CATALOG = os.path.join(HERE, "catalog.json")
+DEFAULT_BASELINE = os.path.join(HERE, "benchmarks", "baseline.json")
+
+
+def catalog_arm_ids(path: str = DEFAULT_CATALOG) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [arm["id"] for arm in json.load(f)["arms"]]
+
+
+def click_rates(n_arms: int, seed: int = 0, low: float = 0.01, high: float = 0.10) -> np.ndarray:
+    """Made-up click-through rates, one per arm, with a single best arm."""
+    return np.random.default_rng(seed).uniform(low, high, n_arms)
+
+
+def simulate(probs: Sequence[float], steps: int, replicas: int = 1000, seed: int = 0,
+             half_life: Optional[float] = None, drift_every: int = 0,
+             threshold: float = 0.9, window: int = 100) -> dict:
+    """Run ``replicas`` independent bandits for ``steps`` decisions each.
+
+    Every step is one vectorized draw of shape ``(replicas, arms)``, so a
+    step costs about as much as a single ``ThompsonBandit.choose``. The
+    update rule is the engine's: alpha counts successes, beta failures,
+    both starting at 1; ``half_life`` (in steps) decays evidence like
+    ``adaptation="discounted"``. With ``drift_every`` the click rates are
+    shuffled every that many steps.
+
+    Regret is the expected (pseudo-)regret, ``max(p) - p[chosen]``,
+    averaged over replicas. ``converged_step`` is the first step at which
+    at least ``threshold`` of the decisions over the last ``window`` steps
+    went to the best arm.
+    """
+    rng = np.random.default_rng(seed)
+    probs = np.array(probs, dtype=np.float64)
+    n = len(probs)
+    alpha = np.ones((replicas, n))
+    beta = np.ones((replicas, n))
+    rows = np.arange(replicas)
+    gamma = 0.5 ** (1.0 / half_life) if half_life else None
+    regret = np.zeros(steps)
+    best_share = np.zeros(steps)
+    started = time.perf_counter()
+    for step in range(steps):
+        if drift_every and step and step % drift_every == 0:
+            probs = rng.permutation(probs)
+        best = int(np.argmax(probs))
+        arms = np.argmax(rng.beta(alpha, beta), axis=1)
+        clicks = rng.random(replicas) < probs[arms]
+        if gamma is not None:
+            alpha = 1.0 + (alpha - 1.0) * gamma
+            beta = 1.0 + (beta - 1.0) * gamma
+        alpha[rows, arms] += clicks
+        beta[rows, arms] += ~clicks
+        regret[step] = probs[best] - probs[arms].mean()
+        best_share[step] = np.count_nonzero(arms == best) / replicas
+    elapsed = time.perf_counter() - started
+
+    cumulative = np.cumsum(regret)
+    trailing = np.convolve(best_share, np.ones(window) / window, mode="valid")
+    hits = np.flatnonzero(trailing >= threshold)
+    checkpoints = sorted({min(steps, 10 ** e) for e in range(1, 10) if 10 ** e <= steps} | {steps})
+    return {
+        "arms": n,
+        "steps": steps,
+        "replicas": replicas,
+        "events": steps * replicas,
+        "events_per_sec": steps * replicas / elapsed if elapsed > 0 else float("inf"),
+        "cumulative_regret": float(cumulative[-1]),
+        "regret_at": {str(c): float(cumulative[c - 1]) for c in checkpoints},
+        "final_best_arm_share": float(best_share[-window:].mean()),
+        "converged_step": int(hits[0]) + window if hits.size else None,
+    }
+
+
+def read_events(path: str, arm_ids: Sequence[str]) -> Iterator[Tuple[str, int]]:
+    """(arm_id, reward) pairs from a JSON-lines log.
+
+    Understands the reward journal (``{"a": ..., "r": ...}`` lines and
+    batched ``{"d": {arm: [successes, failures]}}`` lines) and plain
+    ``{"arm_id": ..., "reward": ...}`` lines; anything else is skipped.
+    """
+    known = set(arm_ids)
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if "d" in event:
+                for arm_id, (successes, failures) in event["d"].items():
+                    if arm_id in known:
+                        yield from [(arm_id, 1)] * int(successes)
+                        yield from [(arm_id, 0)] * int(failures)
+                continue
+            arm_id = event.get("a", event.get("arm_id"))
+            reward = event.get("r", event.get("reward"))
+            if arm_id in known and reward is not None:
+                yield arm_id, int(reward)
+
+
+def replay(bandit, events: Sequence[Tuple[str, int]], batch: int = 256) -> dict:
+    """Offline evaluation by rejection sampling (Li et al., 2011).
+
+    Logged events are walked in order in micro-batches. For each one the
+    bandit makes a decision; only events where it picks the logged arm
+    count, and those rewards are applied with one ``apply_deltas`` per
+    batch (the same path the reward queue uses). With uniformly random
+    logging the matched click rate is an unbiased estimate of the policy's.
+    """
+    slots = np.array([bandit.arms[a] for a, _ in events], dtype=np.intp)
+    rewards = np.array([r for _, r in events], dtype=np.float64)
+    n_arms = len(bandit.arm_ids)
+    matched = 0
+    clicks = 0.0
+    logged_rate = float(rewards.mean()) if len(rewards) else 0.0
+    started = time.perf_counter()
+    for start in range(0, len(slots), batch):
+        s = slots[start:start + batch]
+        r = rewards[start:start + batch]
+        chosen = np.argmax(bandit.sample(len(s)), axis=1)
+        hit = chosen == s
+        successes = np.bincount(s[hit], weights=r[hit], minlength=n_arms)
+        failures = np.bincount(s[hit], weights=1.0 - r[hit], minlength=n_arms)
+        if hit.any():
+            bandit.apply_deltas(successes, failures)
+        matched += int(hit.sum())
+        clicks += float(r[hit].sum())
+    elapsed = time.perf_counter() - started
+    return {
+        "events": len(slots),
+        "matched": matched,
+        "logged_click_rate": logged_rate,
+        "policy_click_rate": clicks / matched if matched else None,
+        "events_per_sec": len(slots) / elapsed if elapsed > 0 else float("inf"),
+    }
+
+
+def scratch_bandit(arm_ids: Sequence[str], directory: str, **kwargs):
+    """A ``ThompsonBandit`` whose journal and snapshots live in ``directory``.
+
+    Its start-up report goes to stderr so stdout stays valid JSON.
+    """
+    from bandit import ThompsonBandit
+
+    cls = type("ScratchBandit", (ThompsonBandit,), {"BACKUP_DIR": directory})
+    kwargs.setdefault("flush_interval", 3600.0)
+    kwargs.setdefault("flush_events", 1 << 30)
+    with contextlib.redirect_stdout(sys.stderr):
+        return cls(list(arm_ids), **kwargs)
+
+
+def _rate(fn, n: int, repeat: int = 3) -> float:
+    """Calls per second, best of ``repeat`` runs (the least disturbed one)."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(n)
+        best = min(best, time.perf_counter() - started)
+    return n / best if best > 0 else float("inf")
+
+
+def benchmark(arm_ids: Sequence[str], n: int = 100_000, seed: int = 0,
+              adaptation: Optional[str] = None, save_calls: int = 20) -> Dict[str, float]:
+    """Calls per second for the engine's hot paths on a fresh bandit."""
+    n_arms = len(arm_ids)
+    rng = np.random.default_rng(seed)
+    picks = [arm_ids[i] for i in rng.integers(n_arms, size=n)]
+    clicks = (rng.random(n) < 0.05).astype(int).tolist()
+    batch = 256
+    with tempfile.TemporaryDirectory() as directory:
+        bandit = scratch_bandit(arm_ids, directory, seed=seed, adaptation=adaptation,
+                                snapshot_every=1 << 62)
+        try:
+            def choose(k):
+                for _ in range(k):
+                    bandit.choose()
+
+            def choose_many(k):
+                for _ in range(k // batch):
+                    bandit.choose_many(batch)
+
+            def reward(k):
+                for arm_id, r in zip(picks[:k], clicks[:k]):
+                    bandit.reward(arm_id, r)
+
+            def apply_deltas(k):
+                ones = np.ones(n_arms)
+                for _ in range(k // batch):
+                    bandit.apply_deltas(ones, ones)
+
+            def save_state(k):
+                for _ in range(k):
+                    bandit.save_state()
+
+            return {
+                "choose_per_sec": _rate(choose, n // 10),
+                "choose_many_decisions_per_sec": _rate(choose_many, n),
+                "reward_per_sec": _rate(reward, n),
+                "apply_deltas_batches_per_sec": _rate(apply_deltas, n) / batch,
+                "save_state_per_sec": _rate(save_state, save_calls),
+            }
+        finally:
+            bandit.close()
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressions of ``current`` against ``baseline``.
+
+    Throughputs (``*_per_sec``) may drop by at most ``tolerance`` (a
+    fraction); the simulated regret is deterministic for a given seed, so it
+    may grow by at most 1%.
+    """
+    problems = []
+    for key, base in baseline.get("throughput", {}).items():
+        now = current.get("throughput", {}).get(key)
+        if now is not None and now < base * (1.0 - tolerance):
+            problems.append(f"{key}: {now:,.0f} < {base:,.0f} (-{1 - now / base:.0%})")
+    base = baseline.get("sim", {}).get("cumulative_regret")
+    now = current.get("sim", {}).get("cumulative_regret")
+    if base is not None and now is not None and now > base * 1.01:
+        problems.append(f"cumulative_regret: {now:.3f} > {base:.3f}")
+    return problems
+
+
+def _print_json(data):
+    print(json.dumps(data, indent=2))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG, help="arms come from this catalog")
+    parser.add_argument("--seed", type=int, default=0)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sim = sub.add_parser("sim", help="regret and convergence against synthetic arms")
+    sim.add_argument("--steps", type=int, default=5000)
+    sim.add_argument("--replicas", type=int, default=1000)
+    sim.add_argument("--probs", help="comma-separated click rates (default: random per arm)")
+    sim.add_argument("--half-life", type=float, help="discount evidence with this half-life (steps)")
+    sim.add_argument("--drift-every", type=int, default=0, help="shuffle click rates every N steps")
+
+    rep = sub.add_parser("replay", help="evaluate the bandit on a logged event stream")
+    rep.add_argument("path", help="JSON-lines log, e.g. bandit_backup/bandit_journal.jsonl")
+    rep.add_argument("--batch", type=int, default=256)
+    rep.add_argument("--adaptation", choices=["discounted", "window"])
+
+    bench = sub.add_parser("bench", help="engine throughput plus a short simulation")
+    bench.add_argument("-n", type=int, default=100_000, help="calls per measurement")
+    bench.add_argument("--adaptation", choices=["discounted", "window"])
+    bench.add_argument("--compare", metavar="BASELINE", help="fail on regressions against this file")
+    bench.add_argument("--tolerance", type=float, default=0.3, help="allowed throughput drop")
+    bench.add_argument("--save", metavar="BASELINE", help="write the results as the new baseline")
+
+    args = parser.parse_args(argv)
+    arm_ids = catalog_arm_ids(args.catalog)
+
+    if args.command == "sim":
+        probs = ([float(p) for p in args.probs.split(",")] if args.probs
+                 else click_rates(len(arm_ids), args.seed))
+        _print_json(simulate(probs, args.steps, args.replicas, args.seed,
+                             half_life=args.half_life, drift_every=args.drift_every))
+        return 0
+
+    if args.command == "replay":
+        events = list(read_events(args.path, arm_ids))
+        with tempfile.TemporaryDirectory() as directory:
+            bandit = scratch_bandit(arm_ids, directory, seed=args.seed, adaptation=args.adaptation)
+            try:
+                _print_json(replay(bandit, events, args.batch))
+            finally:
+                bandit.close()
+        return 0
+
+    results = {
+        "arms": len(arm_ids),
+        "numpy": np.__version__,
+        "python": sys.version.split()[0],
+        "throughput": benchmark(arm_ids, args.n, args.seed, args.adaptation),
+        "sim": simulate(click_rates(len(arm_ids), args.seed), 2000, 500, args.seed),
+    }
+    # Simulated events/sec is a throughput too
+    results["throughput"]["sim_events_per_sec"] = results["sim"].pop("events_per_sec")
+    _print_json(results)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION {problem}", file=sys.stderr)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import contextlib
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Modules the request path should not need; reported so a regression in
+# import laziness shows up in /debug/startup
+HEAVY_MODULES = ("boto3", "botocore", "pandas", "yaml", "torch")
+
+
+def _process_started() -> Optional[float]:
+    """Wall-clock start of this process (Linux), or None if unknown."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Field 22, after the parenthesized command name (which may contain spaces)
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class StartupReport:
+    """Durations of the start-up phases, from process start to first warm-up.
+
+    ``mark(name)`` closes the phase that ran since the previous mark. The
+    first phase starts at process start where the OS tells us (so it covers
+    interpreter and uvicorn start-up plus imports), otherwise when this
+    module was imported.
+    """
+
+    def __init__(self):
+        now = time.time()
+        started = _process_started()
+        self.started = started if started is not None and started <= now else now
+        self._last = self.started
+        self.phases: List[Tuple[str, float, int]] = []  # (name, seconds, modules loaded)
+        self.ready_after: Optional[float] = None
+
+    def mark(self, name: str):
+        now = time.time()
+        self.phases.append((name, now - self._last, len(sys.modules)))
+        self._last = now
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Time a phase that runs on its own (e.g. a background warm-up)."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - started, len(sys.modules)))
+
+    def ready(self):
+        """The app is about to accept traffic."""
+        self.mark("startup hooks")
+        self.ready_after = self._last - self.started
+
+    def report(self) -> Dict:
+        return {
+            "phases_ms": {name: round(seconds * 1000, 1) for name, seconds, _ in self.phases},
+            "modules_after_phase": {name: n for name, _, n in self.phases},
+            "ready_after_ms": round(self.ready_after * 1000, 1) if self.ready_after is not None else None,
+            "heavy_modules_loaded": [m for m in HEAVY_MODULES if m in sys.modules],
+        }
+
+    def summary(self) -> str:
+        phases = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds, _ in self.phases)
+        return f"Startup: {phases}"
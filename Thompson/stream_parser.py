@@ -0,0 +1,48 @@
+import json
+from typing import List
+
+
+class JSONStringArrayParser:
+    """Incrementally extract the strings of a JSON array from streamed text.
+
+    ``feed`` accepts arbitrary chunks (e.g. LLM token deltas) and returns the
+    array elements completed by that chunk, so each message can be used as
+    soon as its closing quote arrives. Text before the opening ``[`` (such as
+    a ```json fence) is skipped, as is anything after the closing ``]``.
+    """
+
+    def __init__(self):
+        self._state = "before"  # before -> array -> string -> array ... -> done
+        self._buf: List[str] = []
+        self._escaped = False
+
+    @property
+    def done(self) -> bool:
+        return self._state == "done"
+
+    def feed(self, chunk: str) -> List[str]:
+        items = []
+        for ch in chunk:
+            state = self._state
+            if state == "before":
+                if ch == "[":
+                    self._state = "array"
+            elif state == "array":
+                if ch == '"':
+                    self._state = "string"
+                    self._buf = ['"']
+                elif ch == "]":
+                    self._state = "done"
+            elif state == "string":
+                self._buf.append(ch)
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    items.append(json.loads("".join(self._buf)))
+                    self._buf = []
+                    self._state = "array"
+            else:
+                break
+        return items